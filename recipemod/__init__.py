@@ -33,15 +33,74 @@ def create_app():
     if not SECRET_KEY:
         raise ValueError("No SECRET_KEY environment variable found")
     DATABASE = os.environ.get("DATABASE_URL")
-    app.config.from_mapping(SECRET_KEY=SECRET_KEY, DATABASE=DATABASE)
+    app.config.from_mapping(
+        SECRET_KEY=SECRET_KEY,
+        DATABASE=DATABASE,
+        METRICS_ENABLED=os.environ.get("METRICS_ENABLED", "").lower()
+        in ("1", "true", "yes"),
+        PARSE_CACHE_BACKEND=os.environ.get("PARSE_CACHE_BACKEND", "memory"),
+        PARSE_CACHE_SIZE=int(os.environ.get("PARSE_CACHE_SIZE", 1024)),
+        PARSE_CACHE_TTL=float(os.environ.get("PARSE_CACHE_TTL", 24 * 60 * 60)),
+        PARSE_CACHE_PATH=os.environ.get("PARSE_CACHE_PATH"),
+    )
+
+    from . import serialization
+
+    serialization.init_app(app)
 
     from . import db
 
     db.init_app(app)
 
+    from . import cache
+
+    cache.init_app(app)
+
+    from . import fetcher
+
+    fetcher.init_app(app)
+
     from . import migrations
 
     app.cli.add_command(migrations.create_modifications_table_command)
+    app.cli.add_command(migrations.create_import_jobs_table_command)
+    app.cli.add_command(migrations.create_recipes_user_created_index_command)
+    app.cli.add_command(migrations.add_import_jobs_trace_columns_command)
+    app.cli.add_command(migrations.create_import_jobs_running_index_command)
+    app.cli.add_command(migrations.create_page_archive_table_command)
+    app.cli.add_command(migrations.add_recipes_search_columns_command)
+    app.cli.add_command(migrations.add_parsed_ingredients_column_command)
+    app.cli.add_command(migrations.add_recipe_dedupe_columns_command)
+    app.cli.add_command(migrations.add_modification_deltas_command)
+    app.cli.add_command(migrations.add_users_session_version_column_command)
+
+    from . import archive
+
+    archive.init_app(app)
+
+    from . import imports
+
+    imports.init_app(app)
+
+    from . import bulk
+
+    bulk.init_app(app)
+
+    from . import reparse
+
+    reparse.init_app(app)
+
+    from . import dedupe
+
+    dedupe.init_app(app)
+
+    from . import history
+
+    history.init_app(app)
+
+    from . import metrics
+
+    metrics.init_app(app)
 
     from . import auth
 
@@ -1,82 +1,251 @@
-from enum import Enum
+import base64
+from datetime import datetime
+import hashlib
 import json
 import logging
 
-from flask import Blueprint, g, request
-import requests
+from flask import Blueprint, current_app, g, request
 
 from recipemod.auth import login_required
-from recipemod import repository, parsing
-from recipemod.models import Modification, Recipe
+from recipemod import bulk, cache, db, history, imports, ingredients, repository
+from recipemod.models import Error, Recipe
 
 bp = Blueprint("api", __name__)
 
 logger = logging.getLogger(__name__)
 
 
-class Error(Enum):
-    NOT_FOUND = "NOT_FOUND"
-    REQUEST_FAILED = "REQUEST_FAILED"
-    MISSING_URL = "MISSING_URL"
-    PARSE_FAILED = "PARSE_FAILED"
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_LIST_FIELDS = ["id", "name", "description", "image_url", "url", "created"]
+MAX_PAGE_SIZE = 200
+# Browsers may keep recipes but must check they're current before using them
+CACHE_CONTROL = "private, no-cache"
+
+
+def encode_cursor(recipe: Recipe) -> str:
+    cursor = f"{recipe.created.isoformat()},{recipe.id}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    created, recipe_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+    return datetime.fromisoformat(created), int(recipe_id)
+
+
+def encode_search_cursor(rank: float, recipe: Recipe) -> str:
+    cursor = f"{rank!r},{recipe.id}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    rank, recipe_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+    return float(rank), int(recipe_id)
+
+
+def conditional_response(etag: str, make_data):
+    """Respond 304 Not Modified if the client has the version of the data with
+    this ETag, and with make_data() otherwise."""
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(make_data())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
+
+
+def page_etag(fields: list[str], recipes: list[Recipe]) -> str:
+    """The ETag of a page of recipes, from the fields sent and the id and
+    timestamps of each recipe on it."""
+    versions = [(recipe.id, recipe.created, recipe.updated) for recipe in recipes]
+    return hashlib.sha1(repr((fields, versions)).encode()).hexdigest()
 
 
-@login_required
 @bp.get("/api/recipes")
+@login_required
 def recipes():
-    """Get all recipes for this user."""
-    recipes = repository.get_recipes_by_user(g.user["id"])
-    return {"recipes": [recipe.to_json() for recipe in recipes]}
+    """Get a page of recipes for this user, newest first.
+
+    Takes optional limit, cursor (the next value from the previous page) and
+    fields (comma-separated recipe fields to include) query parameters.
+    """
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        cursor = request.args.get("cursor")
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": "Invalid limit or cursor",
+        }, 400
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else DEFAULT_LIST_FIELDS
+    unknown = set(fields) - set(repository.RECIPE_COLUMNS)
+    if unknown or limit < 1:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": f"Unknown fields {sorted(unknown)}" if unknown else "Invalid limit",
+        }, 400
+
+    # A client that has a page only needs its versions read to tell whether
+    # it's still current
+    if request.if_none_match:
+        versions = repository.get_recipes_by_user(
+            g.user["id"], limit=limit + 1, after=after, fields=["updated"]
+        )
+        etag = page_etag(fields, versions)
+        if request.if_none_match.contains(etag):
+            return conditional_response(etag, None)
+
+    recipes = repository.get_recipes_by_user(
+        g.user["id"], limit=limit + 1, after=after, fields=[*fields, "updated"]
+    )
+    next_cursor = encode_cursor(recipes[limit - 1]) if len(recipes) > limit else None
+    # The ETag describes the rows actually sent
+    return conditional_response(
+        page_etag(fields, recipes),
+        lambda: {
+            "recipes": [recipe.to_json(fields) for recipe in recipes[:limit]],
+            "next": next_cursor,
+        },
+    )
 
 
+@bp.get("/api/recipes/search")
 @login_required
+def search():
+    """Search this user's recipes, best matches first.
+
+    Takes q (words to find in the name, keywords, ingredients or
+    description), any number of ingredient parameters that must all be in
+    the ingredient list, and the same limit, cursor and fields parameters as
+    /api/recipes.
+    """
+    query = request.args.get("q", "").strip()
+    ingredients = [
+        ingredient.strip()
+        for ingredient in request.args.getlist("ingredient")
+        if ingredient.strip()
+    ]
+    if not query and not ingredients:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": "No search query or ingredients provided",
+        }, 400
+    try:
+        limit = min(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        cursor = request.args.get("cursor")
+        after = decode_search_cursor(cursor) if cursor else None
+    except ValueError:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": "Invalid limit or cursor",
+        }, 400
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else DEFAULT_LIST_FIELDS
+    unknown = set(fields) - set(repository.RECIPE_COLUMNS)
+    if unknown or limit < 1:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": f"Unknown fields {sorted(unknown)}" if unknown else "Invalid limit",
+        }, 400
+
+    results = repository.search_recipes(
+        g.user["id"],
+        query=query,
+        ingredients=ingredients,
+        limit=limit + 1,
+        after=after,
+        fields=fields,
+    )
+    next_cursor = (
+        encode_search_cursor(results[limit - 1][1], results[limit - 1][0])
+        if len(results) > limit
+        else None
+    )
+    return {
+        "recipes": [recipe.to_json(fields) for recipe, _ in results[:limit]],
+        "next": next_cursor,
+    }
+
+
 @bp.post("/api/recipes/add")
+@login_required
 def add_recipe():
+    """Queue an import of the recipe at a URL and return the job to poll. With
+    "debug": true, the parser's decisions are saved on the job if it fails."""
     data = json.loads(request.data.decode())
     url = data["url"]
     if not url:
         return {"error": Error.MISSING_URL.value, "msg": "No URL provided"}, 400
 
-    resp = requests.get(url, headers={"User-Agent": request.headers["User-Agent"]})
-    if not resp:
-        logger.info("Request to URL '%s' failed with status %s", url, resp.status_code)
+    job = imports.enqueue(
+        url,
+        g.user["id"],
+        request.headers.get("User-Agent"),
+        debug=bool(data.get("debug")),
+    )
+    return {"job": job.to_json()}, 202
+
+
+@bp.post("/api/recipes/bulk-add")
+@login_required
+def bulk_add_recipes():
+    """Start importing a list of URLs in the background with bulk.bulk_import,
+    and return the jobs to poll, one per distinct URL in the order given."""
+    data = json.loads(request.data.decode())
+    urls = list(dict.fromkeys(url.strip() for url in data.get("urls") or []))
+    urls = [url for url in urls if url]
+    if not urls:
+        return {"error": Error.MISSING_URL.value, "msg": "No URLs provided"}, 400
+    max_urls = current_app.config["BULK_MAX_URLS"]
+    if len(urls) > max_urls:
         return {
-            "error": Error.REQUEST_FAILED.value,
-            "msg": f"Request failed with error {resp.status_code}: \n {resp.text}",
-        }, 500
+            "error": Error.TOO_MANY_URLS.value,
+            "msg": f"At most {max_urls} URLs can be imported at once",
+        }, 400
 
+    jobs = bulk.enqueue(urls, g.user["id"], request.headers.get("User-Agent"))
+    return {"jobs": [job.to_json() for job in jobs]}, 202
+
+
+@bp.get("/api/imports/<int:job_id>")
+@login_required
+def get_import_job(job_id):
+    """Get the status of an import job, with the recipe once it's done."""
     try:
-        recipe = parsing.parse_recipe_html(resp.text)
-    except parsing.ParseError as error:
-        logger.error(
-            "Error parsing recipe data from URL '%s', message: '%s'", url, error
-        )
+        job = repository.get_import_job(job_id, g.user["id"])
+    except repository.NotFoundError:
         return {
-            "error": Error.PARSE_FAILED.value,
-            "msg": "Unable to extract recipe data",
-        }, 500
+            "error": Error.NOT_FOUND.value,
+            "msg": f"Import job {job_id} does not exist.",
+        }, 404
 
-    if not recipe.url:
-        recipe.url = url
+    data = {"job": job.to_json()}
+    if job.status == "done" and job.recipe_id:
+        data["recipe"] = repository.get_recipe_detail(job.recipe_id).to_json()
+    return data
 
-    recipe.user_id = g.user["id"]
-    recipe = repository.save_recipe(recipe)
 
-    logger.info(
-        "Saved recipe from URL '%s' with name '%s' as %d for user ID %s ",
-        url,
-        recipe.name,
-        recipe.id,
-        recipe.user_id,
-    )
-    return {"recipe": recipe}
+@bp.get("/api/stats/parse-cache")
+@login_required
+def parse_cache_stats():
+    """Hit and miss counts of the parsed-recipe cache, for monitoring."""
+    return cache.get_cache().stats()
 
 
+@bp.get("/api/stats/db-pool")
 @login_required
+def db_pool_stats():
+    """Connection pool usage of this worker process, for monitoring."""
+    return db.get_pool().stats()
+
+
 @bp.get("/api/recipes/<int:recipe_id>")
+@login_required
 def get_recipe_data(recipe_id):
-    recipe = repository.get_recipe_detail(recipe_id)
-    if not recipe:
+    version = repository.get_recipe_version(recipe_id)
+    if not version:
         logger.error(
             "Unable to load recipe ID %s for user ID %s as it does not exist",
             recipe_id,
@@ -86,11 +255,101 @@ def get_recipe_data(recipe_id):
             "error": Error.NOT_FOUND.value,
             "msg": f"Recipe {recipe_id} does not exist.",
         }, 404
-    return {"recipe": recipe.to_json()}
+
+    created, updated = version
+    etag = f"{recipe_id}-{created.timestamp()}-{updated.timestamp() if updated else 0}"
+    return conditional_response(
+        etag,
+        lambda: {"recipe": repository.get_recipe_detail(recipe_id).to_json()},
+    )
+
+
+@bp.get("/api/recipes/<int:recipe_id>/scaled")
+@login_required
+def scaled_ingredients(recipe_id):
+    """The recipe's parsed ingredients with their quantities scaled, either to
+    make servings servings or by factor."""
+    servings = request.args.get("servings", type=float)
+    factor = request.args.get("factor", type=float)
+    if not ((servings and servings > 0) or (factor and factor > 0)):
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": "Provide a positive number of servings or factor",
+        }, 400
+    try:
+        recipe = repository.get_recipe_ingredients(recipe_id, g.user["id"])
+    except repository.NotFoundError:
+        return {
+            "error": Error.NOT_FOUND.value,
+            "msg": f"Recipe {recipe_id} does not exist.",
+        }, 404
+
+    recipe_servings = ingredients.parse_yield(recipe.yield_)
+    if servings:
+        if not recipe_servings:
+            return {
+                "error": Error.INVALID_PARAMETER.value,
+                "msg": f"Recipe {recipe_id} has no yield to scale from",
+            }, 400
+        factor = servings / recipe_servings
+    # Recipes saved before ingredients were parsed on import
+    parsed = recipe.parsed_ingredients
+    if parsed is None:
+        parsed = ingredients.parse_ingredients(recipe.ingredients) or []
+    return {
+        "yield": recipe.yield_,
+        "servings": recipe_servings and recipe_servings * factor,
+        "factor": factor,
+        "ingredients": ingredients.scale_ingredients(parsed, factor),
+    }
+
+
+@bp.get("/api/recipes/<int:recipe_id>/history")
+@login_required
+def recipe_history(recipe_id):
+    """The recipe's edits, newest first. Each one's created time, in ISO format,
+    gets the version it made from /history/<created>."""
+    if not repository.get_recipe_version(recipe_id, g.user["id"]):
+        return {
+            "error": Error.NOT_FOUND.value,
+            "msg": f"Recipe {recipe_id} does not exist.",
+        }, 404
+    return {
+        "modifications": [
+            {
+                "id": mod.id,
+                "created": mod.created.isoformat(),
+                "fields": list(mod.changed_fields),
+                "meta": mod.meta,
+            }
+            for mod in repository.get_modifications(recipe_id)
+        ]
+    }
 
 
+@bp.get("/api/recipes/<int:recipe_id>/history/<at>")
 @login_required
+def recipe_at(recipe_id, at):
+    """The recipe as it was at an ISO format time."""
+    try:
+        at = datetime.fromisoformat(at)
+    except ValueError:
+        return {
+            "error": Error.INVALID_PARAMETER.value,
+            "msg": f"Invalid time '{at}', expected ISO format",
+        }, 400
+    try:
+        recipe = history.recipe_at(recipe_id, at, g.user["id"])
+    except repository.NotFoundError:
+        return {
+            "error": Error.NOT_FOUND.value,
+            "msg": f"Recipe {recipe_id} does not exist.",
+        }, 404
+    return {"recipe": recipe}
+
+
 @bp.delete("/api/recipes/<int:recipe_id>")
+@login_required
 def delete(recipe_id):
     try:
         repository.delete_recipe(recipe_id)
@@ -106,23 +365,28 @@ def delete(recipe_id):
     return {"msg": "Recipe deleted"}
 
 
-@login_required
 @bp.put("/api/recipes/<int:recipe_id>")
+@login_required
 def update(recipe_id):
     recipe = Recipe.from_json(json.loads(request.data.decode())["recipe"])
+    recipe.id = recipe_id
     try:
-        old_recipe = repository.get_recipe_detail(recipe_id)
+        mod = repository.update_recipe(
+            recipe, current_app.config["HISTORY_SNAPSHOT_INTERVAL"]
+        )
     except repository.NotFoundError:
         return {
             "msg": f"Unable to modify recipe with ID {recipe_id} as not found.",
             "error": Error.NOT_FOUND.value,
         }, 404
-    mod = Modification.from_recipes(old_recipe, recipe)
+    except repository.ConflictError:
+        return {
+            "msg": f"Recipe with ID {recipe_id} changed while saving, try again.",
+            "error": Error.CONFLICT.value,
+        }, 409
 
     if mod.changed_fields:
-        logger.info("Updating recipe ID %s with changes: %s", recipe.id, mod)
-        repository.update_recipe(recipe)
-        repository.save_modification(mod)
+        logger.info("Updated recipe ID %s with changes: %s", recipe.id, mod)
     else:
         logger.info(
             "Received request to update recipe ID %s but no changes found", recipe.id
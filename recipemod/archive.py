@@ -0,0 +1,326 @@
+"""Archive of the raw pages recipes were imported from, so parse bugs can be
+reproduced and recipes re-parsed later without fetching them again.
+
+Pages are stored compressed under the SHA-256 of their text, so a page
+imported by many users is kept once, and recipes record the hash in
+page_hash. Pages are compressed with zstd when the zstandard package is
+installed and gzip otherwise. Archived pages are read back as decompressing
+streams, so they never need to be held in memory compressed and decompressed
+at once. Pages no recipe refers to are pruned after a retention period.
+"""
+import gzip
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+from typing import BinaryIO
+
+import click
+import psycopg2.errors
+from flask import current_app
+from flask.cli import with_appcontext
+
+from recipemod import repository
+from recipemod.db import get_db
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "ARCHIVE_BACKEND": "none",
+    "ARCHIVE_PATH": "",
+    "ARCHIVE_RETENTION_DAYS": 90.0,
+}
+CHUNK_SIZE = 256 * 1024
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def compress(data: bytes) -> tuple[bytes, str]:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(data), "zstd"
+    return gzip.compress(data, compresslevel=6), "gzip"
+
+
+class _GzipReader(gzip.GzipFile):
+    """GzipFile that also closes the stream it reads from."""
+
+    def close(self):
+        raw = self.fileobj
+        try:
+            super().close()
+        finally:
+            if raw is not None:
+                raw.close()
+
+
+def decompressing_reader(raw: BinaryIO, compression: str) -> BinaryIO:
+    """Wrap a stream of compressed bytes in a stream of the page's bytes."""
+    if compression == "gzip":
+        return _GzipReader(fileobj=raw, mode="rb")
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Reading zstd archives needs the zstandard package")
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(raw, closefd=True), CHUNK_SIZE
+        )
+    raise ValueError(f"Unknown compression '{compression}'")
+
+
+class PageArchive:
+    """Base class for archive backends."""
+
+    def put(self, text: str) -> str | None:
+        """Archive a page and return its hash."""
+        data = text.encode("utf8")
+        key = hashlib.sha256(data).hexdigest()
+        if not self._touch(key):
+            self._put(key, *compress(data))
+        return key
+
+    def open(self, key: str) -> BinaryIO:
+        """Open an archived page as a stream of UTF-8 bytes. Raises KeyError if
+        it isn't in the archive."""
+        raise NotImplementedError
+
+    def read(self, key: str) -> str:
+        with self.open(key) as page:
+            return page.read().decode("utf8")
+
+    def prune(self, older_than: float) -> int:
+        """Remove pages archived or last imported more than older_than seconds
+        ago that no recipe refers to, returning how many were removed."""
+        raise NotImplementedError
+
+    def _touch(self, key: str) -> bool:
+        """Mark a page as just imported, returning False if it isn't archived."""
+        raise NotImplementedError
+
+    def _put(self, key: str, content: bytes, compression: str) -> None:
+        raise NotImplementedError
+
+
+class NullArchive(PageArchive):
+    """Archive that keeps nothing, used when archiving is switched off."""
+
+    def put(self, text):
+        return None
+
+    def open(self, key):
+        raise KeyError(key)
+
+    def prune(self, older_than):
+        return 0
+
+
+class FileArchive(PageArchive):
+    """Pages stored as files under root, e.g. root/ab/abcd....gz, with the
+    modification time recording when the page was last imported."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str, compression: str) -> str:
+        return os.path.join(self.root, key[:2], key + SUFFIXES[compression])
+
+    def _find(self, key: str) -> tuple[str, str] | None:
+        for compression in SUFFIXES:
+            path = self._path(key, compression)
+            if os.path.exists(path):
+                return path, compression
+        return None
+
+    def _touch(self, key):
+        found = self._find(key)
+        if found:
+            os.utime(found[0])
+        return found is not None
+
+    def _put(self, key, content, compression):
+        path = self._path(key, compression)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as outfile:
+            outfile.write(content)
+        os.replace(tmp_path, path)
+
+    def open(self, key):
+        found = self._find(key)
+        if not found:
+            raise KeyError(key)
+        path, compression = found
+        return decompressing_reader(open(path, "rb"), compression)
+
+    def _candidates(self, cutoff: float):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key, suffix = os.path.splitext(filename)
+                if suffix in SUFFIXES.values() and os.path.getmtime(path) < cutoff:
+                    yield key, path
+
+    def prune(self, older_than):
+        removed = 0
+        candidates = list(self._candidates(time.time() - older_than))
+        for start in range(0, len(candidates), 1000):
+            batch = dict(candidates[start : start + 1000])
+            for key in batch.keys() - repository.find_referenced_page_hashes(
+                list(batch)
+            ):
+                os.remove(batch[key])
+                removed += 1
+        return removed
+
+
+class _ByteaReader(io.RawIOBase):
+    """Read a bytea value in chunks, rather than as one huge value."""
+
+    def __init__(self, key: str, size: int):
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        with get_db().cursor() as c:
+            c.execute(
+                "SELECT substring(content FROM %s FOR %s) FROM page_archive "
+                "WHERE sha256 = %s;",
+                (self.position + 1, len(buffer), self.key),
+            )
+            chunk = bytes(c.fetchone()[0])
+        buffer[: len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+
+class PostgresArchive(PageArchive):
+    """Pages stored in the page_archive table. The content column's storage is
+    EXTERNAL, since the pages are compressed already, so reading it in chunks
+    only reads the chunks asked for."""
+
+    def _touch(self, key):
+        with get_db().cursor() as c:
+            try:
+                c.execute(
+                    "UPDATE page_archive SET last_used = CURRENT_TIMESTAMP "
+                    "WHERE sha256 = %s;",
+                    (key,),
+                )
+            except psycopg2.errors.Error:
+                logger.exception("Error updating archived page %s", key)
+                raise
+            return c.rowcount > 0
+
+    def _put(self, key, content, compression):
+        with get_db().cursor() as c:
+            try:
+                c.execute(
+                    "INSERT INTO page_archive (sha256, compression, size, content) "
+                    "VALUES (%s, %s, %s, %s) ON CONFLICT (sha256) DO UPDATE "
+                    "SET last_used = CURRENT_TIMESTAMP;",
+                    (key, compression, len(content), psycopg2.Binary(content)),
+                )
+            except psycopg2.errors.Error:
+                logger.exception("Error archiving page %s", key)
+                raise
+
+    def open(self, key):
+        with get_db().cursor() as c:
+            c.execute(
+                "SELECT compression, size FROM page_archive WHERE sha256 = %s;", (key,)
+            )
+            row = c.fetchone()
+        if not row:
+            raise KeyError(key)
+        compression, size = row
+        raw = io.BufferedReader(_ByteaReader(key, size), CHUNK_SIZE)
+        return decompressing_reader(raw, compression)
+
+    def prune(self, older_than):
+        with get_db().cursor() as c:
+            try:
+                c.execute(
+                    "DELETE FROM page_archive p "
+                    "WHERE last_used < CURRENT_TIMESTAMP - make_interval(secs => %s) "
+                    "AND NOT EXISTS "
+                    "(SELECT 1 FROM recipes r WHERE r.page_hash = p.sha256);",
+                    (older_than,),
+                )
+            except psycopg2.errors.Error:
+                logger.exception("Error pruning page archive")
+                raise
+            return c.rowcount
+
+
+def create_archive(config) -> PageArchive:
+    backend = config.get("ARCHIVE_BACKEND", "none")
+    if backend == "filesystem":
+        path = config.get("ARCHIVE_PATH") or os.path.join(
+            current_app.instance_path, "page_archive"
+        )
+        os.makedirs(path, exist_ok=True)
+        return FileArchive(path)
+    elif backend == "postgres":
+        return PostgresArchive()
+    elif backend == "none":
+        return NullArchive()
+    raise ValueError(f"Unknown page archive backend '{backend}'")
+
+
+def get_archive() -> PageArchive:
+    return current_app.extensions["page_archive"]
+
+
+def store(text: str) -> str | None:
+    """Archive a page, returning its hash, or None if archiving is off or
+    failed. A failure to archive never fails the import."""
+    try:
+        return get_archive().put(text)
+    except Exception:
+        logger.exception("Failed to archive page")
+        return None
+
+
+@click.command("prune-page-archive")
+@click.option("--days", type=float, help="Retention period (ARCHIVE_RETENTION_DAYS)")
+@with_appcontext
+def prune_page_archive_command(days):
+    """Remove archived pages that no recipe refers to."""
+    days = days if days is not None else current_app.config["ARCHIVE_RETENTION_DAYS"]
+    removed = get_archive().prune(float(days) * 24 * 60 * 60)
+    click.echo(f"Removed {removed} archived pages")
+
+
+@click.command("show-archived-page")
+@click.argument("page_hash")
+@with_appcontext
+def show_archived_page_command(page_hash):
+    """Write an archived page to stdout."""
+    try:
+        page = get_archive().open(page_hash)
+    except KeyError:
+        raise click.ClickException(f"No archived page {page_hash}")
+    out = click.get_binary_stream("stdout")
+    with page:
+        while chunk := page.read(CHUNK_SIZE):
+            out.write(chunk)
+
+
+def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
+    with app.app_context():
+        app.extensions["page_archive"] = create_archive(app.config)
+    app.cli.add_command(prune_page_archive_command)
+    app.cli.add_command(show_archived_page_command)
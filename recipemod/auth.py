@@ -16,6 +16,31 @@ from recipemod.db import get_db
 bp = Blueprint("auth", __name__, url_prefix="/auth")
 
 
+def _remember_user(user):
+    """Keep the fields requests need in the signed session, so requests that
+    don't need a login don't have to look the user up."""
+    session["user_id"] = user["id"]
+    session["username"] = user["username"]
+    session["session_version"] = user["session_version"]
+
+
+def _session_current() -> bool:
+    """Whether the logged-in user still exists and their sessions haven't been
+    ended since this one started, e.g. by a password change in another
+    session. Clears the session if not."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "SELECT session_version FROM users WHERE id = %s;", (session["user_id"],)
+        )
+        user = c.fetchone()
+    if user and user["session_version"] == session.get("session_version"):
+        return True
+    session.clear()
+    g.user = None
+    return False
+
+
 @bp.route("/register", methods=("GET", "POST"))
 def register():
     if request.method == "POST":
@@ -66,7 +91,7 @@ def login():
                 error = {"type": "danger", "text": "Incorrect password"}
             if not error:
                 session.clear()
-                session["user_id"] = user["id"]
+                _remember_user(user)
                 return redirect(url_for("serve_app"))
 
             flash(error)
@@ -80,12 +105,9 @@ def load_logged_in_user():
 
     if not user_id:
         g.user = None
-    else:
-        db = get_db()
-        with db.cursor() as c:
-            c.execute("SELECT * FROM users WHERE id = %s;", (user_id,))
-            user = c.fetchone()
-        g.user = user
+        return
+
+    g.user = {"id": user_id, "username": session["username"]}
 
 
 @bp.route("/logout")
@@ -97,7 +119,7 @@ def logout():
 def login_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if not g.user:
+        if not g.user or not _session_current():
             return redirect(url_for("auth.login"))
 
         return view(**kwargs)
@@ -106,11 +128,18 @@ def login_required(view):
 
 
 @bp.route("/change_password", methods=("GET", "POST"))
+@login_required
 def change_password():
     if request.method == "POST":
         message = None
-        user = g.user
-        print(request.form)
+        db = get_db()
+        with db.cursor() as c:
+            c.execute(
+                "SELECT id, username, password, session_version FROM users "
+                "WHERE id = %s;",
+                (g.user["id"],),
+            )
+            user = c.fetchone()
         current_password = request.form["current-password"]
         new_password = request.form["new-password"]
         if not new_password == request.form["confirm-new-password"]:
@@ -119,13 +148,18 @@ def change_password():
             message = {"type": "danger", "text": "Incorrect current password"}
 
         if not message:
-            db = get_db()
+            password_hash = generate_password_hash(new_password)
             with db.cursor() as c:
+                # Ends every other session of this user
                 c.execute(
-                    "UPDATE users SET password = %(password)s " "WHERE id = %(id)s;",
-                    {"password": generate_password_hash(password), "id": user["id"]},
+                    "UPDATE users SET password = %(password)s, "
+                    "session_version = session_version + 1 "
+                    "WHERE id = %(id)s RETURNING session_version;",
+                    {"password": password_hash, "id": user["id"]},
                 )
+                session_version = c.fetchone()["session_version"]
             db.commit()
+            _remember_user({**user, "session_version": session_version})
             message = {"type": "success", "text": "Password successfully changed"}
         flash(message)
     return render_template("auth/change_password.html")
@@ -0,0 +1,324 @@
+"""Bulk import of many recipe URLs at once, e.g. when migrating bookmarks from
+another recipe manager.
+
+Pages are fetched concurrently by a thread pool, with a limit on concurrent
+requests to each host, and parsed by a process pool since parsing is CPU-bound.
+All recipes are then saved with a single multi-row insert, or one at a time if
+that fails, so one bad row doesn't lose the rest.
+
+URLs the user has already saved aren't fetched, and recipes that duplicate one
+the user already has, or one earlier in the same import, aren't saved; their
+report entries have the status "duplicate" and the id of the existing recipe.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import logging
+import multiprocessing
+import os
+import threading
+import urllib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from recipemod import archive, cache, dedupe, imports, parsing, repository
+from recipemod.models import Error, ImportJob
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "BULK_FETCH_WORKERS": 8,
+    "BULK_PER_HOST": 2,
+    "BULK_PARSE_PROCESSES": os.cpu_count() or 1,
+    "BULK_MAX_URLS": 100,
+}
+
+
+class HostLimiter:
+    """Limit the number of concurrent requests to each host."""
+
+    def __init__(self, per_host: int):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def limit(self, url: str):
+        host = urllib.parse.urlsplit(url).netloc.lower()
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                host, threading.Semaphore(self.per_host)
+            )
+        with semaphore:
+            yield
+
+
+def _fetch(app, limiter: HostLimiter, url: str, user_agent: str | None):
+    with app.app_context(), limiter.limit(url):
+        return imports.fetch_page(url, user_agent)
+
+
+def _failed(url: str, error: Error, msg: str) -> dict:
+    return {"url": url, "status": "failed", "error": error.value, "msg": msg}
+
+
+def _duplicate(url: str, recipe_id: int) -> dict:
+    return {"url": url, "status": "duplicate", "recipe_id": recipe_id}
+
+
+def _save(recipes: dict, report: dict) -> dict:
+    """Save recipes by URL with one insert or, if that fails, one at a time,
+    reporting the ones that can't be saved. Returns the saved recipes by URL."""
+    try:
+        return dict(zip(recipes, repository.save_recipes(list(recipes.values()))))
+    except Exception:
+        logger.exception("Error saving %s recipes, saving one at a time", len(recipes))
+    saved = {}
+    for url, recipe in recipes.items():
+        try:
+            saved[url] = repository.save_recipe(recipe)
+        except Exception:
+            logger.exception("Error saving recipe from URL '%s'", url)
+            report[url] = _failed(url, Error.SAVE_FAILED, "Unable to save recipe")
+    return saved
+
+
+def bulk_import(urls: list[str], user_id: int, user_agent: str | None = None):
+    """Import recipes from many URLs for a user, returning a report entry for
+    each distinct URL in the order given."""
+    app = current_app._get_current_object()
+    config = app.config
+    urls = list(dict.fromkeys(url.strip() for url in urls if url.strip()))
+    report = {}
+    recipes = {}
+    page_hashes = {}
+    parse_cache = cache.get_cache()
+    limiter = HostLimiter(int(config["BULK_PER_HOST"]))
+    parse_pool = None
+    # Keyed by recipe id for saved recipes and by URL for this import's
+    index = dedupe.DuplicateIndex(repository.get_recipe_identities(user_id))
+    duplicates = {}
+    to_fetch = []
+    for url in urls:
+        existing = index.find(dedupe.canonical_url(url), None)
+        if existing is None:
+            to_fetch.append(url)
+        else:
+            report[url] = _duplicate(url, existing)
+
+    try:
+        with ThreadPoolExecutor(int(config["BULK_FETCH_WORKERS"])) as fetch_pool:
+            fetches = {
+                fetch_pool.submit(_fetch, app, limiter, url, user_agent): url
+                for url in to_fetch
+            }
+            parses = {}
+            for future in as_completed(fetches):
+                url = fetches[future]
+                try:
+                    page = future.result()
+                except imports.ImportFailed as failure:
+                    report[url] = _failed(url, failure.error, failure.msg)
+                    continue
+                except Exception:
+                    logger.exception("Unexpected error fetching URL '%s'", url)
+                    report[url] = _failed(url, Error.REQUEST_FAILED, "Request failed")
+                    continue
+
+                text = page.text
+                page_hashes[url] = archive.store(text)
+                cache_key = cache.make_key(url, page.headers, page.content)
+                recipe = parse_cache.get(cache_key)
+                if recipe:
+                    recipes[url] = recipe
+                    continue
+                if parse_pool is None:
+                    # Spawn rather than fork, since this process has threads
+                    parse_pool = ProcessPoolExecutor(
+                        int(config["BULK_PARSE_PROCESSES"]),
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                future = parse_pool.submit(parsing.parse_recipe_html, text)
+                parses[future] = (url, cache_key)
+
+        for future in as_completed(parses):
+            url, cache_key = parses[future]
+            try:
+                recipe = future.result()
+            except parsing.ParseError as error:
+                logger.error(
+                    "Error parsing recipe data from URL '%s' (archived as %s), "
+                    "message: '%s'",
+                    url,
+                    page_hashes[url],
+                    error,
+                )
+                report[url] = _failed(
+                    url, Error.PARSE_FAILED, "Unable to extract recipe data"
+                )
+                continue
+            except Exception:
+                logger.exception(
+                    "Unexpected error parsing URL '%s' (archived as %s)",
+                    url,
+                    page_hashes[url],
+                )
+                report[url] = _failed(
+                    url, Error.PARSE_FAILED, "Unable to extract recipe data"
+                )
+                continue
+            parse_cache.set(cache_key, recipe)
+            recipes[url] = recipe
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown(cancel_futures=True)
+
+    # In the order given, so the first of duplicates within the import is saved
+    new = {}
+    for url in urls:
+        if url not in recipes:
+            continue
+        recipe = recipes[url]
+        if not recipe.url:
+            recipe.url = url
+        recipe.user_id = user_id
+        recipe.page_hash = page_hashes[url]
+        imports.identify(url, recipe)
+        existing = index.find(recipe.canonical_url, recipe.fingerprint)
+        if existing is None:
+            new[url] = recipe
+            index.add(url, recipe.canonical_url, recipe.fingerprint)
+        else:
+            duplicates[url] = existing
+    saved = _save(new, report)
+    for url, recipe in saved.items():
+        report[url] = {"url": url, "status": "saved", "recipe_id": recipe.id}
+    for url, existing in duplicates.items():
+        if existing in new:
+            if existing not in saved:
+                report[url] = {**report[existing], "url": url}
+                continue
+            existing = saved[existing].id
+        report[url] = _duplicate(url, existing)
+
+    logger.info(
+        "Bulk imported %s of %s URLs for user ID %s", len(saved), len(urls), user_id
+    )
+    return [report[url] for url in urls]
+
+
+_runner: ThreadPoolExecutor | None = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def _get_runner() -> ThreadPoolExecutor:
+    """The thread running this (forked) process's bulk imports, one at a time."""
+    global _runner, _runner_pid
+    with _runner_lock:
+        if _runner_pid != os.getpid():
+            _runner = ThreadPoolExecutor(1, thread_name_prefix="bulk-import")
+            _runner_pid = os.getpid()
+    return _runner
+
+
+def enqueue(
+    urls: list[str], user_id: int, user_agent: str | None = None
+) -> list[ImportJob]:
+    """Create an import job for each distinct URL and run them all in the
+    background with bulk_import, returning the jobs to poll.
+
+    The jobs are created running, so the import workers leave them alone
+    unless this process stops updating them for IMPORT_STALE_AFTER seconds.
+    """
+    app = current_app._get_current_object()
+    urls = list(dict.fromkeys(urls))
+    jobs = repository.create_import_jobs(
+        [
+            ImportJob(
+                url=url,
+                user_id=user_id,
+                user_agent=user_agent,
+                status="running",
+                attempts=1,
+                max_attempts=int(app.config["IMPORT_MAX_ATTEMPTS"]),
+            )
+            for url in urls
+        ]
+    )
+    logger.info("Started %s bulk import jobs for user ID %s", len(jobs), user_id)
+    _get_runner().submit(run_jobs, app, jobs)
+    return jobs
+
+
+def _keep_alive(app, job_ids: list[int], stop: threading.Event):
+    interval = float(app.config["IMPORT_STALE_AFTER"]) / 3
+    while not stop.wait(interval):
+        try:
+            with app.app_context():
+                repository.touch_import_jobs(job_ids)
+        except Exception:
+            logger.exception("Unable to mark bulk import jobs as running")
+
+
+def run_jobs(app, jobs: list[ImportJob]):
+    """Import the jobs' URLs with bulk_import and save each job's outcome. If
+    the import as a whole fails, the jobs are queued again for the import
+    workers to run one at a time."""
+    stop = threading.Event()
+    threading.Thread(
+        target=_keep_alive, args=(app, [job.id for job in jobs], stop), daemon=True
+    ).start()
+    with app.app_context():
+        try:
+            results = bulk_import(
+                [job.url for job in jobs], jobs[0].user_id, jobs[0].user_agent
+            )
+        except Exception:
+            logger.exception("Bulk import of %s jobs failed, queueing them", len(jobs))
+            for job in jobs:
+                job.status = "queued"
+                repository.finish_import_job(job)
+            return
+        finally:
+            stop.set()
+        by_url = {result["url"]: result for result in results}
+        for job in jobs:
+            result = by_url[job.url]
+            if result["status"] == "failed":
+                job.status, job.error, job.msg = (
+                    "failed",
+                    result["error"],
+                    result["msg"],
+                )
+            else:
+                job.status, job.recipe_id = "done", result["recipe_id"]
+            repository.finish_import_job(job)
+
+
+@click.command("bulk-import")
+@click.argument("username")
+@click.argument("url_file", type=click.File())
+@with_appcontext
+def bulk_import_command(username, url_file):
+    """Import recipes for USERNAME from URL_FILE, one URL per line ('-' for
+    stdin)."""
+    user = repository.get_user_by_username(username)
+    if not user:
+        raise click.ClickException(f"No user named '{username}'")
+    urls = [line for line in url_file if not line.startswith("#")]
+    results = bulk_import(urls, user["id"])
+    for result in results:
+        if result["status"] in ("saved", "duplicate"):
+            click.echo(f"{result['status']}\t{result['recipe_id']}\t{result['url']}")
+        else:
+            click.echo(f"failed\t{result['error']}\t{result['url']}\t{result['msg']}")
+    saved = sum(result["status"] == "saved" for result in results)
+    click.echo(f"Imported {saved} of {len(results)} URLs")
+
+
+def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
+    app.cli.add_command(bulk_import_command)
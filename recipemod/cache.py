@@ -0,0 +1,281 @@
+"""Cache of parsed recipes, so popular pages aren't parsed again on every import.
+
+Entries are keyed on the normalized page URL plus its ETag/Last-Modified
+validators, or a hash of the page body when the site sends neither.
+"""
+
+from collections import OrderedDict
+import copy
+from dataclasses import asdict
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib
+
+from flask import current_app
+
+from recipemod.models import Recipe
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url: str) -> str:
+    """Lowercase the scheme and host, drop the fragment and sort the query."""
+    parts = urllib.parse.urlsplit(url.strip())
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query)))
+    return urllib.parse.urlunsplit(
+        (parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, "")
+    )
+
+
+def make_key(url: str, headers, body: bytes) -> str:
+    """Build a cache key from the URL and the response validators or body."""
+    validator = headers.get("ETag") or headers.get("Last-Modified")
+    if validator:
+        validator = "v:" + validator
+    else:
+        validator = "h:" + hashlib.sha256(body).hexdigest()
+    return f"{normalize_url(url)} {validator}"
+
+
+class ParseCache:
+    """Base class for cache backends, which store recipes as plain dicts."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 24 * 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def get(self, key: str) -> Recipe | None:
+        data = self._get(key)
+        self._count("hits" if data is not None else "misses")
+        if data is None:
+            return None
+        return Recipe(**data)
+
+    def set(self, key: str, recipe: Recipe) -> None:
+        self._set(key, asdict(recipe))
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+    def _get(self, key: str) -> dict | None:
+        raise NotImplementedError
+
+    def _set(self, key: str, data: dict) -> None:
+        raise NotImplementedError
+
+    def _count(self, name: str) -> None:
+        raise NotImplementedError
+
+
+class NullCache(ParseCache):
+    """Cache that never stores anything, used when caching is switched off."""
+
+    def __init__(self):
+        super().__init__(max_size=0, ttl=0)
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"backend": "none", "hits": 0, "misses": self.misses, "size": 0}
+
+    def _get(self, key):
+        return None
+
+    def _set(self, key, data):
+        pass
+
+    def _count(self, name):
+        self.misses += 1
+
+
+class LRUCache(ParseCache):
+    """In-process LRU cache. Each gunicorn worker gets its own."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 24 * 60 * 60):
+        super().__init__(max_size, ttl)
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", **self._counts, "size": len(self._entries)}
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        # A copy, so callers changing the recipe don't change the entry
+        return copy.deepcopy(data)
+
+    def _set(self, key, data):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+
+
+class SQLiteCache(ParseCache):
+    """Cache in a local SQLite file, shared by all workers on the machine.
+
+    Each thread keeps its own connection, opened again in a forked process, so
+    the cache is safe to use after gunicorn forks its workers. Hits only read:
+    when entries were last used and the hit and miss counts are kept in memory
+    and written with the next entry stored, or when they pile up, so eviction
+    goes by the uses each worker has written so far.
+    """
+
+    # Pending uses and counts written at most this many lookups apart
+    flush_every = 100
+
+    def __init__(self, path: str, max_size: int = 1024, ttl: float = 24 * 60 * 60):
+        super().__init__(max_size, ttl)
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._used: dict[str, float] = {}
+        self._counts = {"hits": 0, "misses": 0}
+        self._pid = os.getpid()
+        conn = self._connection()
+        # WAL is kept in the file, so it only needs setting once
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.executescript(
+            """
+CREATE TABLE IF NOT EXISTS entries (
+    key text PRIMARY KEY,
+    data text NOT NULL,
+    expires real NOT NULL,
+    used real NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_used_idx ON entries(used);
+CREATE TABLE IF NOT EXISTS counts (
+    name text PRIMARY KEY,
+    value integer NOT NULL
+);
+INSERT OR IGNORE INTO counts (name, value) VALUES ('hits', 0), ('misses', 0);
+"""
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            # Forked: the parent writes what was pending before the fork
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self._take_pending()
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _take_pending(self) -> tuple[dict, dict]:
+        with self._lock:
+            used, counts = self._used, self._counts
+            self._used, self._counts = {}, {"hits": 0, "misses": 0}
+        return used, counts
+
+    def _write_pending(self) -> None:
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            self._flush(conn)
+
+    def _flush(self, conn: sqlite3.Connection) -> None:
+        """Write the pending uses and counts, inside a transaction."""
+        used, counts = self._take_pending()
+        if used:
+            conn.executemany(
+                "UPDATE entries SET used = max(used, ?) WHERE key = ?;",
+                [(when, key) for key, when in used.items()],
+            )
+        conn.executemany(
+            "UPDATE counts SET value = value + ? WHERE name = ?;",
+            [(value, name) for name, value in counts.items() if value],
+        )
+
+    def stats(self) -> dict:
+        self._write_pending()
+        conn = self._connection()
+        counts = dict(conn.execute("SELECT name, value FROM counts;"))
+        (size,) = conn.execute("SELECT count(*) FROM entries;").fetchone()
+        return {"backend": "sqlite", **counts, "size": size}
+
+    def _get(self, key):
+        now = time.time()
+        row = (
+            self._connection()
+            .execute("SELECT data, expires FROM entries WHERE key = ?;", (key,))
+            .fetchone()
+        )
+        if row is None or row[1] < now:
+            # Expired entries are removed by the next _set
+            return None
+        with self._lock:
+            self._used[key] = now
+        return json.loads(row[0])
+
+    def _set(self, key, data):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE;")
+            self._flush(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, data, expires, used) "
+                "VALUES (?, ?, ?, ?);",
+                (key, json.dumps(data), now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM entries WHERE expires < ?;", (now,))
+            conn.execute(
+                "DELETE FROM entries WHERE key IN ("
+                "SELECT key FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?);",
+                (self.max_size,),
+            )
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] += 1
+            pending = sum(self._counts.values())
+        if pending >= self.flush_every:
+            self._write_pending()
+
+
+def create_cache(config) -> ParseCache:
+    backend = config.get("PARSE_CACHE_BACKEND", "memory")
+    max_size = int(config.get("PARSE_CACHE_SIZE", 1024))
+    ttl = float(config.get("PARSE_CACHE_TTL", 24 * 60 * 60))
+    if backend == "memory":
+        return LRUCache(max_size=max_size, ttl=ttl)
+    elif backend == "sqlite":
+        path = config.get("PARSE_CACHE_PATH") or os.path.join(
+            current_app.instance_path, "parse_cache.sqlite3"
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SQLiteCache(path, max_size=max_size, ttl=ttl)
+    elif backend == "none":
+        return NullCache()
+    raise ValueError(f"Unknown parse cache backend '{backend}'")
+
+
+def get_cache() -> ParseCache:
+    return current_app.extensions["parse_cache"]
+
+
+def init_app(app):
+    with app.app_context():
+        app.extensions["parse_cache"] = create_cache(app.config)
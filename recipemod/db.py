@@ -1,20 +1,178 @@
+from collections import deque
 import logging
+import os
+import threading
+import time
 
 import click
 import psycopg2
+import psycopg2.extensions
 from flask import current_app, g
 from flask.cli import with_appcontext
 from psycopg2.extras import DictCursor
 
 logger = logging.getLogger(__name__)
 
+DEFAULTS = {
+    "DB_POOL_MIN": 1,
+    "DB_POOL_MAX": 10,
+    "DB_POOL_TIMEOUT": 10.0,
+    "DB_POOL_MAX_LIFETIME": 3600.0,
+    "DB_POOL_CHECK_AFTER": 30.0,
+}
+
+
+class PoolTimeout(Exception):
+    """No connection became free in time"""
+
+
+class ConnectionPool:
+    """Per-process pool of autocommit connections.
+
+    At most max_size connections are open at once, and callers wait up to
+    timeout for one to be returned. Connections idle for longer than
+    check_after are pinged before being handed out, and connections older than
+    max_lifetime are replaced.
+    """
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int,
+        max_size: int,
+        timeout: float,
+        max_lifetime: float,
+        check_after: float,
+    ):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_after = check_after
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        # (connection, created, returned) tuples, most recently returned last
+        self._idle = deque()
+        self._in_use = {}
+        self._stats = {"checkouts": 0, "waits": 0, "opened": 0, "discarded": 0}
+        now = time.monotonic()
+        for _ in range(min_size):
+            self._idle.append((self._connect(), now, now))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=DictCursor)
+        conn.autocommit = True
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _usable(self, conn, created: float, returned: float) -> bool:
+        now = time.monotonic()
+        if conn.closed or now - created > self.max_lifetime:
+            return False
+        if now - returned > self.check_after:
+            try:
+                with conn.cursor() as c:
+                    c.execute("SELECT 1;")
+            except psycopg2.Error:
+                return False
+        return True
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                raise PoolTimeout(f"No database connection free after {self.timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn, created = self._connect(), time.monotonic()
+                    break
+                conn, created, returned = entry
+                if self._usable(conn, created, returned):
+                    break
+                logger.info("Replacing stale database connection")
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use[id(conn)] = created
+            self._stats["checkouts"] += 1
+        return conn
+
+    def putconn(self, conn):
+        with self._lock:
+            created = self._in_use.pop(id(conn))
+        if not conn.closed and (
+            conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        ):
+            try:
+                conn.rollback()
+                conn.autocommit = True
+            except psycopg2.Error:
+                conn.close()
+        if conn.closed:
+            self._discard(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, created, time.monotonic()))
+        self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+            }
+
+
+_pool = None
+_pool_pid = None
+# Pools inherited from a parent process are kept referenced rather than closed,
+# since closing them would also close the parent's connections.
+_inherited_pools = []
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Return this process's pool, creating a new one after a fork."""
+    global _pool, _pool_pid
+    if _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                if _pool is not None:
+                    _inherited_pools.append(_pool)
+                config = current_app.config
+                logger.info("Creating database connection pool")
+                _pool = ConnectionPool(
+                    config["DATABASE"],
+                    min_size=int(config["DB_POOL_MIN"]),
+                    max_size=int(config["DB_POOL_MAX"]),
+                    timeout=float(config["DB_POOL_TIMEOUT"]),
+                    max_lifetime=float(config["DB_POOL_MAX_LIFETIME"]),
+                    check_after=float(config["DB_POOL_CHECK_AFTER"]),
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
 
 def get_db():
     if "db" not in g:
-        logger.info("Creating database")
-        db_url = current_app.config["DATABASE"]
-        g.db = psycopg2.connect(db_url, cursor_factory=DictCursor)
-        g.db.set_session(autocommit=True)
+        g.db = get_pool().getconn()
 
     return g.db
 
@@ -23,7 +181,7 @@ def close_db(e=None):
     db = g.pop("db", None)
 
     if db is not None:
-        db.close()
+        get_pool().putconn(db)
 
 
 def init_db():
@@ -43,5 +201,7 @@ def init_db_command():
 
 
 def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
@@ -0,0 +1,229 @@
+"""Finding recipes a user has already saved.
+
+Two recipes are the same if their canonical URLs match, or if the SimHash
+fingerprints of their names and ingredients are within FINGERPRINT_DISTANCE
+bits of each other. The canonical URL drops what varies between links to the
+same page: tracking parameters, AMP variants, "www." and the fragment. Where a
+page names its own <link rel="canonical">, that URL is used instead.
+
+Imports look for a recipe with the same canonical URL before fetching the
+page, and for one with a close fingerprint after parsing it, and
+`flask dedupe-recipes` merges duplicates already saved.
+"""
+from collections import defaultdict
+import hashlib
+import re
+import urllib.parse
+
+import click
+from flask.cli import with_appcontext
+
+from recipemod import repository
+
+FINGERPRINT_BITS = 64
+FINGERPRINT_DISTANCE = 3
+# Fingerprints of very short recipes are too coarse to compare
+MIN_FINGERPRINT_FEATURES = 8
+
+TRACKING_PARAMS = {
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "yclid",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "_ga",
+    "_gl",
+    "ref",
+    "ref_src",
+    "share",
+    "amp",
+    "outputtype",
+}
+HOST_PREFIXES = ("www.", "amp.", "m.")
+amp_path_regex = re.compile(r"(?:/amp)+/?$|^/amp(?=/)", re.IGNORECASE)
+token_regex = re.compile(r"[^\W_]+")
+
+
+def canonical_url(url: str) -> str:
+    """The URL with everything that varies between links to the same page
+    removed, for comparing URLs rather than fetching them."""
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.endswith(":443") or host.endswith(":80"):
+        host = host.rsplit(":", 1)[0]
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix) :]
+            break
+    path = amp_path_regex.sub("", parts.path).rstrip("/") or "/"
+    query = urllib.parse.urlencode(
+        sorted(
+            (key, value)
+            for key, value in urllib.parse.parse_qsl(
+                parts.query, keep_blank_values=True
+            )
+            if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+        )
+    )
+    # http and https links are the same recipe
+    return urllib.parse.urlunsplit(("https", host, path, query, ""))
+
+
+def _features(name: str | None, ingredients: list[str] | None) -> list[str]:
+    """Word pairs of the name and each ingredient line."""
+    features = []
+    for text in [name or "", *(ingredients or [])]:
+        tokens = token_regex.findall(str(text).lower())
+        features += tokens[:1] + [" ".join(pair) for pair in zip(tokens, tokens[1:])]
+    return features
+
+
+def fingerprint(name: str | None, ingredients: list[str] | None) -> int | None:
+    """SimHash of a recipe's name and ingredients, as a signed 64-bit integer
+    to fit a bigint column, or None if there's too little to go on."""
+    features = _features(name, ingredients)
+    if len(features) < MIN_FINGERPRINT_FEATURES:
+        return None
+    weights = [0] * FINGERPRINT_BITS
+    for feature in features:
+        digest = hashlib.blake2b(feature.encode("utf8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    value = sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a: int, b: int) -> int:
+    return ((a ^ b) & ((1 << 64) - 1)).bit_count()
+
+
+class DuplicateIndex:
+    """Recipes by canonical URL and fingerprint, for finding the ones a new
+    recipe duplicates without comparing it to all of them.
+
+    Fingerprints within FINGERPRINT_DISTANCE bits share at least one of
+    FINGERPRINT_DISTANCE + 1 bands of bits exactly, so only recipes sharing a
+    band, or the URL, are compared.
+    """
+
+    bands = FINGERPRINT_DISTANCE + 1
+    band_bits = FINGERPRINT_BITS // bands
+
+    def __init__(self, recipes: list[tuple] = ()):
+        self._urls = {}
+        self._buckets = defaultdict(list)
+        for key, url, print_ in recipes:
+            self.add(key, url, print_)
+
+    def _band_keys(self, print_: int):
+        mask = (1 << self.band_bits) - 1
+        return [
+            (band, print_ >> (band * self.band_bits) & mask)
+            for band in range(self.bands)
+        ]
+
+    def add(self, key, url: str | None, print_: int | None):
+        if url:
+            self._urls.setdefault(url, key)
+        if print_ is not None:
+            for band_key in self._band_keys(print_):
+                self._buckets[band_key].append((key, print_))
+
+    def matches(self, url: str | None, print_: int | None) -> list:
+        """Keys of the recipes added with the same URL, first, or a close
+        fingerprint."""
+        found = {}  # ordered and without repeats
+        if url in self._urls:
+            found[self._urls[url]] = None
+        if print_ is not None:
+            for band_key in self._band_keys(print_):
+                for key, other in self._buckets[band_key]:
+                    if distance(print_, other) <= FINGERPRINT_DISTANCE:
+                        found[key] = None
+        return list(found)
+
+    def find(self, url: str | None, print_: int | None):
+        """The key of a recipe the given one duplicates, preferring a URL
+        match, or None."""
+        matches = self.matches(url, print_)
+        return matches[0] if matches else None
+
+
+def duplicate_groups(recipes: list[tuple]) -> list[list[int]]:
+    """Group (id, canonical_url, fingerprint) rows of one user's recipes into
+    sets of duplicates, each listed oldest (lowest id) first."""
+    parent = {recipe_id: recipe_id for recipe_id, _, _ in recipes}
+
+    def find(recipe_id):
+        while parent[recipe_id] != recipe_id:
+            parent[recipe_id] = parent[parent[recipe_id]]
+            recipe_id = parent[recipe_id]
+        return recipe_id
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    index = DuplicateIndex()
+    for recipe_id, url, print_ in recipes:
+        for other_id in index.matches(url, print_):
+            union(other_id, recipe_id)
+        index.add(recipe_id, url, print_)
+
+    groups = defaultdict(list)
+    for recipe_id in sorted(parent):
+        groups[find(recipe_id)].append(recipe_id)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+@click.command("dedupe-recipes")
+@click.option("--yes", is_flag=True, help="Delete the duplicates found")
+@with_appcontext
+def dedupe_recipes_command(yes):
+    """List recipes that duplicate one the same user saved earlier, and delete
+    them with --yes. The earliest copy is kept, unless only a later one has
+    been edited. Edited copies are never deleted, so their history is kept."""
+    removed = skipped = 0
+    for user_id in repository.get_user_ids():
+        for group in duplicate_groups(repository.get_recipe_identities(user_id)):
+            edited = repository.find_modified_recipe_ids(group)
+            keep = next(
+                (recipe_id for recipe_id in group if recipe_id in edited), group[0]
+            )
+            duplicates = [
+                recipe_id
+                for recipe_id in group
+                if recipe_id != keep and recipe_id not in edited
+            ]
+            kept_edited = [
+                recipe_id
+                for recipe_id in group
+                if recipe_id != keep and recipe_id in edited
+            ]
+            click.echo(
+                f"{user_id}\t{keep}\t{', '.join(map(str, duplicates))}"
+                + (
+                    f"\tedited, kept: {', '.join(map(str, kept_edited))}"
+                    if kept_edited
+                    else ""
+                )
+            )
+            if yes and duplicates:
+                repository.delete_recipes(duplicates)
+            removed += len(duplicates)
+            skipped += len(kept_edited)
+    click.echo(
+        f"{'Removed' if yes else 'Found'} {removed} duplicate recipes, "
+        f"kept {skipped} edited duplicates"
+    )
+    if not yes and removed:
+        click.echo("Run again with --yes to delete them")
+
+
+def init_app(app):
+    app.cli.add_command(dedupe_recipes_command)
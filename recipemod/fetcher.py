@@ -0,0 +1,272 @@
+"""Outbound HTTP fetching of recipe pages.
+
+Each worker process keeps one pooled requests Session, so repeat imports from
+the same site reuse kept-alive connections. Responses are bounded in time and
+size, and pages fetched before are revalidated with If-None-Match and
+If-Modified-Since instead of being downloaded again.
+"""
+from collections import OrderedDict
+import codecs
+from dataclasses import dataclass, field
+import logging
+import os
+import re
+import threading
+import time
+
+from charset_normalizer import detect
+from flask import current_app
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+import urllib3.exceptions
+
+from recipemod.cache import normalize_url
+
+try:
+    import brotli  # noqa: F401 - lets urllib3 decode br responses
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+else:
+    ACCEPT_ENCODING = "gzip, deflate, br"
+
+logger = logging.getLogger(__name__)
+
+# Small, so the total timeout is checked often even when the body trickles in
+READ_SIZE = 8 * 1024
+DEFAULTS = {
+    "FETCH_CONNECT_TIMEOUT": 5.0,
+    "FETCH_READ_TIMEOUT": 10.0,
+    "FETCH_TOTAL_TIMEOUT": 30.0,
+    "FETCH_MAX_BYTES": 5 * 1024 * 1024,
+    "FETCH_POOL_SIZE": 10,
+    "FETCH_REVALIDATE_SIZE": 256,
+    "FETCH_REVALIDATE_BYTES": 64 * 1024 * 1024,
+}
+
+
+header_charset_regex = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+meta_charset_regex = re.compile(
+    rb"<meta[^>]+charset\s*=\s*[\"']?\s*([\w.:-]+)", re.IGNORECASE
+)
+
+
+class FetchError(Exception):
+    """The page could not be fetched."""
+
+
+@dataclass
+class Page:
+    url: str
+    status_code: int
+    content: bytes
+    encoding: str | None
+    headers: CaseInsensitiveDict = field(default_factory=CaseInsensitiveDict)
+    revalidated: bool = False
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        """Decode the content the same way requests.Response.text does."""
+        try:
+            return str(self.content, self.encoding or "utf-8", errors="replace")
+        except LookupError:
+            return str(self.content, errors="replace")
+
+
+def _declared_charset(regex: re.Pattern, text: bytes | str) -> str | None:
+    """The codec name of a charset matched by regex, if Python knows it."""
+    match = regex.search(text)
+    if not match:
+        return None
+    charset = match.group(1)
+    if isinstance(charset, bytes):
+        charset = charset.decode("ascii", "replace")
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
+
+def choose_encoding(url: str, content_type: str, content: bytes) -> str | None:
+    """Pick the encoding to decode a page with.
+
+    requests falls back to ISO-8859-1 for text/html without a charset in the
+    Content-Type, and sites often send a charset that disagrees with the one in
+    their <meta> tag, which turns every accented letter and curly quote into
+    mojibake. Content that is valid UTF-8 is decoded as UTF-8 whatever it
+    declares, since text in another encoding almost never is, and otherwise
+    the declared charset is used, the header's first, or else a guess.
+    """
+    header_charset = _declared_charset(header_charset_regex, content_type)
+    meta_charset = _declared_charset(meta_charset_regex, content[:4096])
+    if header_charset and meta_charset and header_charset != meta_charset:
+        logger.info(
+            "Page at URL '%s' declares charset %s in its headers but %s in its HTML",
+            url,
+            header_charset,
+            meta_charset,
+        )
+    try:
+        content.decode("utf-8")
+    except UnicodeDecodeError:
+        pass
+    else:
+        return "utf-8"
+    for charset in (header_charset, meta_charset):
+        if charset and charset != "utf-8":
+            return charset
+    return detect(content)["encoding"]
+
+
+_local = threading.local()
+_pages: OrderedDict[str, Page] = OrderedDict()
+_pages_bytes = 0
+_pages_lock = threading.Lock()
+
+
+def _config(key):
+    try:
+        return current_app.config.get(key, DEFAULTS[key])
+    except RuntimeError:
+        return DEFAULTS[key]
+
+
+def get_session() -> requests.Session:
+    """Return this worker's Session, creating a fresh one after a fork."""
+    session = getattr(_local, "session", None)
+    if session is None or _local.pid != os.getpid():
+        session = requests.Session()
+        pool_size = int(_config("FETCH_POOL_SIZE"))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        _local.session = session
+        _local.pid = os.getpid()
+    return session
+
+
+def _remember(key: str, page: Page):
+    """Keep a page for revalidating, within FETCH_REVALIDATE_SIZE pages and
+    FETCH_REVALIDATE_BYTES of content, dropping the least recently fetched."""
+    global _pages_bytes
+    if not (page.headers.get("ETag") or page.headers.get("Last-Modified")):
+        return
+    max_pages = int(_config("FETCH_REVALIDATE_SIZE"))
+    max_bytes = int(_config("FETCH_REVALIDATE_BYTES"))
+    if len(page.content) > max_bytes:
+        return
+    with _pages_lock:
+        old = _pages.pop(key, None)
+        if old:
+            _pages_bytes -= len(old.content)
+        _pages[key] = page
+        _pages_bytes += len(page.content)
+        while len(_pages) > max_pages or _pages_bytes > max_bytes:
+            _, dropped = _pages.popitem(last=False)
+            _pages_bytes -= len(dropped.content)
+
+
+def _set_socket_timeout(resp: requests.Response, timeout: float):
+    connection = getattr(resp.raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def _read_body(
+    resp: requests.Response, max_bytes: int, read_timeout: float, deadline: float
+) -> bytes:
+    """Read the decoded body, giving up if it's too big or too slow.
+
+    Each read returns as soon as any data arrives, with the socket timeout cut
+    to the time left, so a server sending a byte at a time can't keep the
+    download going past the deadline."""
+    declared = resp.headers.get("Content-Length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise FetchError(f"Response of {declared} bytes exceeds limit of {max_bytes}")
+
+    chunks = []
+    size = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise FetchError("Response took too long to download")
+            _set_socket_timeout(resp, min(read_timeout, remaining))
+            chunk = resp.raw.read1(READ_SIZE, decode_content=True)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise FetchError(f"Response exceeds limit of {max_bytes} bytes")
+            chunks.append(chunk)
+    except (urllib3.exceptions.HTTPError, OSError) as error:
+        if time.monotonic() >= deadline:
+            raise FetchError("Response took too long to download") from error
+        raise FetchError(f"Reading response failed: {error}") from error
+    return b"".join(chunks)
+
+
+def fetch(url: str, user_agent: str | None = None) -> Page:
+    """Fetch a page, revalidating a copy fetched before where possible.
+
+    Raises FetchError on connection errors, timeouts or oversized responses.
+    Error statuses are returned as a falsy Page, like requests.Response.
+    """
+    key = normalize_url(url)
+    headers = {}
+    if user_agent:
+        headers["User-Agent"] = user_agent
+    with _pages_lock:
+        known = _pages.get(key)
+    if known:
+        if known.headers.get("ETag"):
+            headers["If-None-Match"] = known.headers["ETag"]
+        if known.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = known.headers["Last-Modified"]
+
+    read_timeout = float(_config("FETCH_READ_TIMEOUT"))
+    timeout = (float(_config("FETCH_CONNECT_TIMEOUT")), read_timeout)
+    deadline = time.monotonic() + float(_config("FETCH_TOTAL_TIMEOUT"))
+    try:
+        with get_session().get(
+            url, headers=headers, timeout=timeout, stream=True
+        ) as resp:
+            if resp.status_code == 304 and known:
+                logger.info("Page at URL '%s' not modified since last fetch", url)
+                return Page(
+                    url=known.url,
+                    status_code=200,
+                    content=known.content,
+                    encoding=known.encoding,
+                    headers=known.headers,
+                    revalidated=True,
+                )
+            content = _read_body(
+                resp, int(_config("FETCH_MAX_BYTES")), read_timeout, deadline
+            )
+            encoding = choose_encoding(
+                url, resp.headers.get("Content-Type", ""), content
+            )
+            page = Page(
+                url=resp.url,
+                status_code=resp.status_code,
+                content=content,
+                encoding=encoding,
+                headers=CaseInsensitiveDict(resp.headers),
+            )
+    except requests.RequestException as error:
+        raise FetchError(f"Request to '{url}' failed: {error}") from error
+
+    if page:
+        _remember(key, page)
+    return page
+
+
+def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
@@ -0,0 +1,124 @@
+"""Rebuilding past versions of a recipe from its modifications, and compacting
+old ones.
+
+Each modification holds patches turning the recipe's edited fields back into
+what they were before the edit, so a past version is rebuilt by starting from
+the current recipe and undoing the later edits, newest first. One in every
+HISTORY_SNAPSHOT_INTERVAL modifications also keeps the old values in full, and
+rebuilding starts from the nearest of those instead, so it never undoes more
+than that many edits.
+
+`flask compact-history` squashes the modifications of each recipe made more
+than HISTORY_COMPACT_AFTER_DAYS ago into one, keeping which fields the user
+changed but not the versions in between.
+"""
+from datetime import datetime
+import functools
+import logging
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from recipemod import repository
+from recipemod.ingredients import parse_ingredients
+from recipemod.models import VERSIONED_FIELDS, Modification, Recipe
+from recipemod.patches import apply_patch, make_patch
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "HISTORY_SNAPSHOT_INTERVAL": 10,
+    "HISTORY_COMPACT_AFTER_DAYS": 90,
+}
+
+
+def revert(fields: dict, mod: Modification) -> dict:
+    """The versioned fields as they were before mod, given them as they were
+    after it."""
+    if mod.snapshot is not None:
+        return dict(mod.snapshot)
+    fields = dict(fields)
+    for key, change in mod.changed_fields.items():
+        fields[key] = apply_patch(fields[key], change) if mod.delta else change
+    return fields
+
+
+def rebuild(fields: dict, modifications) -> dict:
+    """Undo modifications, given newest first."""
+    for mod in modifications:
+        fields = revert(fields, mod)
+    return fields
+
+
+def recipe_at(recipe_id: int, at: datetime, user_id: int | None = None) -> Recipe:
+    """The recipe with its versioned fields as they were at the given time.
+    Raises repository.NotFoundError if it doesn't exist or doesn't belong to
+    user_id, if given."""
+    recipe = repository.get_recipe_detail(recipe_id, user_id)
+    modifications = repository.get_modifications_after(recipe_id, at)
+    fields = rebuild(
+        {field: getattr(recipe, field) for field in VERSIONED_FIELDS}, modifications
+    )
+    for field, value in fields.items():
+        setattr(recipe, field, value)
+    if modifications:
+        recipe.parsed_ingredients = parse_ingredients(recipe.ingredients)
+    return recipe
+
+
+def squash(
+    fields: dict, modifications: list[Modification], before: datetime
+) -> tuple[list[int], Modification] | None:
+    """One modification replacing those made before before, given all of a
+    recipe's, oldest first, for repository.squash_modifications."""
+    old = [mod for mod in modifications if mod.created < before]
+    if not old or (len(old) == 1 and old[0].delta):
+        return None
+    after = rebuild(fields, reversed(modifications[len(old) :]))
+    original = rebuild(after, reversed(old))
+    # Fields edited and then put back are kept, with no changes, so that
+    # re-parsing still leaves them alone
+    changed = {key: None for mod in old for key in mod.changed_fields}
+    return [mod.id for mod in old], Modification(
+        recipe_id=old[-1].recipe_id,
+        changed_fields={key: make_patch(after[key], original[key]) for key in changed},
+        meta={**(old[-1].meta or {}), "squashed": len(old)},
+        id=old[-1].id,
+        created=old[-1].created,
+        delta=True,
+        # Keep rebuilding any version bounded by the snapshot interval
+        snapshot=original if any(mod.snapshot is not None for mod in old) else None,
+    )
+
+
+@click.command("compact-history")
+@click.option("--days", type=float, help="Age to compact (HISTORY_COMPACT_AFTER_DAYS)")
+@with_appcontext
+def compact_history_command(days):
+    """Squash each recipe's old modifications into one."""
+    days = (
+        days if days is not None else current_app.config["HISTORY_COMPACT_AFTER_DAYS"]
+    )
+    before, recipe_ids = repository.get_recipe_ids_to_compact(
+        float(days) * 24 * 60 * 60
+    )
+    recipes = removed = 0
+    for recipe_id in recipe_ids:
+        try:
+            count = repository.squash_modifications(
+                recipe_id, functools.partial(squash, before=before)
+            )
+        except repository.NotFoundError:
+            continue
+        recipes += 1
+        removed += count
+    logger.info("Compacted history of %s recipes", recipes)
+    click.echo(f"Compacted {recipes} recipes, removing {removed} modifications")
+
+
+def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
+    app.cli.add_command(compact_history_command)
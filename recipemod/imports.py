@@ -0,0 +1,269 @@
+"""Recipe import pipeline and the background workers that run queued imports.
+
+Imports are queued as rows in import_jobs. Worker threads claim due jobs with
+SELECT ... FOR UPDATE SKIP LOCKED, run fetch -> parse -> save, and either
+record the result or queue the job again with exponential backoff.
+"""
+from contextlib import nullcontext
+import logging
+import os
+import threading
+import urllib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from recipemod import archive, cache, dedupe, fetcher, metrics, parsing, repository
+from recipemod.models import Error, ImportJob, Recipe
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "IMPORT_WORKERS": 2,
+    "IMPORT_MAX_ATTEMPTS": 3,
+    "IMPORT_RETRY_BACKOFF": 5.0,
+    "IMPORT_POLL_INTERVAL": 2.0,
+    "IMPORT_STALE_AFTER": 300,
+}
+
+
+class ImportFailed(Exception):
+    """The recipe could not be imported. retry is set if trying again later
+    might succeed, e.g. after a timeout or a 5xx from the recipe site."""
+
+    def __init__(self, error: Error, msg: str, retry: bool = False):
+        super().__init__(msg)
+        self.error = error
+        self.msg = msg
+        self.retry = retry
+
+
+def fetch_page(url: str, user_agent: str | None = None) -> fetcher.Page:
+    try:
+        with metrics.stage("fetch"):
+            resp = fetcher.fetch(url, user_agent=user_agent)
+    except fetcher.FetchError as error:
+        logger.info("Request to URL '%s' failed: %s", url, error)
+        raise ImportFailed(
+            Error.REQUEST_FAILED, f"Request failed: {error}", retry=True
+        ) from error
+    if not resp:
+        logger.info("Request to URL '%s' failed with status %s", url, resp.status_code)
+        raise ImportFailed(
+            Error.REQUEST_FAILED,
+            f"Request failed with error {resp.status_code}",
+            retry=resp.status_code >= 500 or resp.status_code == 429,
+        )
+    return resp
+
+
+def parse_page(url: str, page: fetcher.Page) -> Recipe:
+    """Archive and parse a fetched page, using the parse cache where possible."""
+    text = page.text
+    page_hash = archive.store(text)
+    parse_cache = cache.get_cache()
+    cache_key = cache.make_key(url, page.headers, page.content)
+    recipe = parse_cache.get(cache_key)
+    if recipe:
+        logger.info("Using cached parse of URL '%s'", url)
+    else:
+        try:
+            recipe = parsing.parse_recipe_html(text)
+        except parsing.ParseError as error:
+            logger.error(
+                "Error parsing recipe data from URL '%s' (archived as %s), "
+                "message: '%s'",
+                url,
+                page_hash,
+                error,
+            )
+            raise ImportFailed(
+                Error.PARSE_FAILED, "Unable to extract recipe data"
+            ) from error
+        parse_cache.set(cache_key, recipe)
+
+    if not recipe.url:
+        recipe.url = url
+    recipe.page_hash = page_hash
+    identify(url, recipe)
+    return recipe
+
+
+def identify(url: str, recipe: Recipe):
+    """Set the canonical URL and fingerprint used to find duplicates, from the
+    recipe as imported."""
+    recipe.canonical_url = dedupe.canonical_url(
+        urllib.parse.urljoin(url, recipe.canonical_url or url)
+    )
+    recipe.fingerprint = dedupe.fingerprint(recipe.name, recipe.ingredients)
+
+
+def fetch_and_parse(url: str, user_agent: str | None = None) -> Recipe:
+    return parse_page(url, fetch_page(url, user_agent))
+
+
+def import_recipe(url: str, user_id: int, user_agent: str | None = None) -> Recipe:
+    """Fetch, parse and save the recipe at url for a user, logging how long
+    each stage took. If the user already has the recipe, that is returned
+    instead of saving it again."""
+    existing = repository.find_duplicate_recipe(user_id, dedupe.canonical_url(url))
+    if existing:
+        logger.info(
+            "URL '%s' already saved as %d for user ID %s", url, existing.id, user_id
+        )
+        return existing
+
+    with metrics.collect() as timings:
+        try:
+            recipe = fetch_and_parse(url, user_agent)
+            existing = repository.find_duplicate_recipe(
+                user_id,
+                recipe.canonical_url,
+                recipe.fingerprint,
+                dedupe.FINGERPRINT_DISTANCE,
+            )
+            if existing:
+                logger.info(
+                    "Recipe from URL '%s' duplicates %d for user ID %s",
+                    url,
+                    existing.id,
+                    user_id,
+                )
+                return existing
+            recipe.user_id = user_id
+            recipe = repository.save_recipe(recipe)
+        finally:
+            logger.info(
+                "Import timings for URL '%s' (path: %s): %s",
+                url,
+                timings.path or "none",
+                timings.format(),
+            )
+
+    logger.info(
+        "Saved recipe from URL '%s' with name '%s' as %d for user ID %s ",
+        url,
+        recipe.name,
+        recipe.id,
+        recipe.user_id,
+    )
+    return recipe
+
+
+_wakeup = threading.Event()
+_workers: list[threading.Thread] = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+def enqueue(
+    url: str, user_id: int, user_agent: str | None = None, debug: bool = False
+) -> ImportJob:
+    job = repository.create_import_job(
+        ImportJob(
+            url=url,
+            user_id=user_id,
+            user_agent=user_agent,
+            max_attempts=int(current_app.config["IMPORT_MAX_ATTEMPTS"]),
+            debug=debug,
+        )
+    )
+    logger.info("Queued import job %s for URL '%s'", job.id, url)
+    _wakeup.set()
+    return job
+
+
+def run_job(job: ImportJob):
+    try:
+        with parsing.trace() if job.debug else nullcontext() as trace:
+            recipe = import_recipe(job.url, job.user_id, job.user_agent)
+    except ImportFailed as failure:
+        job.error, job.msg, retry = failure.error.value, failure.msg, failure.retry
+    except Exception:
+        logger.exception("Unexpected error running import job %s", job.id)
+        job.error, job.msg, retry = None, "Unexpected error", True
+    else:
+        job.status, job.recipe_id, job.error, job.msg = "done", recipe.id, None, None
+        job.trace = None
+        repository.finish_import_job(job)
+        return
+
+    if job.debug:
+        job.trace = "\n".join(trace)
+
+    if retry and job.attempts < job.max_attempts:
+        delay = float(current_app.config["IMPORT_RETRY_BACKOFF"]) * 2 ** (
+            job.attempts - 1
+        )
+        logger.info(
+            "Import job %s failed on attempt %s, retrying in %ss",
+            job.id,
+            job.attempts,
+            delay,
+        )
+        job.status = "queued"
+        repository.finish_import_job(job, retry_in=delay)
+    else:
+        logger.info("Import job %s failed: %s", job.id, job.msg)
+        job.status = "failed"
+        repository.finish_import_job(job)
+
+
+def work(app, stop: threading.Event):
+    """Run due jobs until stop is set, waiting for work when the queue is empty."""
+    while not stop.is_set():
+        job = None
+        try:
+            with app.app_context():
+                job = repository.claim_import_job(int(app.config["IMPORT_STALE_AFTER"]))
+                if job:
+                    logger.info("Running import job %s for URL '%s'", job.id, job.url)
+                    run_job(job)
+        except Exception:
+            logger.exception("Import worker failed to claim or save a job")
+        if not job:
+            _wakeup.wait(float(app.config["IMPORT_POLL_INTERVAL"]))
+            _wakeup.clear()
+
+
+def start_workers(app, count: int, stop: threading.Event | None = None) -> list:
+    stop = stop or threading.Event()
+    threads = [
+        threading.Thread(
+            target=work, args=(app, stop), name=f"import-worker-{i}", daemon=True
+        )
+        for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def ensure_workers():
+    """Start this process's worker threads, once per (forked) process."""
+    global _workers, _workers_pid
+    count = int(current_app.config["IMPORT_WORKERS"])
+    if not count or _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid != os.getpid():
+            _workers = start_workers(current_app._get_current_object(), count)
+            _workers_pid = os.getpid()
+
+
+@click.command("import-worker")
+@click.option("--workers", default=2, help="Number of worker threads")
+@with_appcontext
+def import_worker_command(workers):
+    """Run queued recipe imports in a dedicated process."""
+    click.echo(f"Running {workers} import workers")
+    for thread in start_workers(current_app._get_current_object(), workers):
+        thread.join()
+
+
+def init_app(app):
+    for key, default in DEFAULTS.items():
+        app.config.setdefault(key, type(default)(os.environ.get(key, default)))
+    app.before_request(ensure_workers)
+    app.cli.add_command(import_worker_command)
@@ -0,0 +1,248 @@
+"""Parsing ingredient lines into quantity, unit, item and note, and scaling
+them to a different yield.
+
+"1 1/2 cups plain flour, sifted" parses to
+{"quantity": 1.5, "quantity_max": None, "unit": "cup", "item": "plain flour",
+"note": "sifted", "text": "1 1/2 cups plain flour, sifted"}. Ranges such as
+"2-3 cloves garlic" set quantity_max. The same lines turn up in many recipes,
+so parses are cached by the whitespace-normalized line.
+"""
+from fractions import Fraction
+import functools
+import json
+import re
+
+CACHE_SIZE = 8192
+
+VULGAR_FRACTIONS = {
+    "½": Fraction(1, 2),
+    "⅓": Fraction(1, 3),
+    "⅔": Fraction(2, 3),
+    "¼": Fraction(1, 4),
+    "¾": Fraction(3, 4),
+    "⅕": Fraction(1, 5),
+    "⅖": Fraction(2, 5),
+    "⅗": Fraction(3, 5),
+    "⅘": Fraction(4, 5),
+    "⅙": Fraction(1, 6),
+    "⅚": Fraction(5, 6),
+    "⅛": Fraction(1, 8),
+    "⅜": Fraction(3, 8),
+    "⅝": Fraction(5, 8),
+    "⅞": Fraction(7, 8),
+}
+NUMBER_WORDS = {
+    "one": 1,
+    "two": 2,
+    "three": 3,
+    "four": 4,
+    "five": 5,
+    "six": 6,
+    "seven": 7,
+    "eight": 8,
+    "nine": 9,
+    "ten": 10,
+    "eleven": 11,
+    "twelve": 12,
+    "dozen": 12,
+}
+# Canonical unit names and the ways recipes write them. Single letter
+# abbreviations are matched case-sensitively, as "T" is a tablespoon and "t" a
+# teaspoon.
+UNITS = {
+    "teaspoon": ["teaspoons", "teaspoon", "tsps", "tsp", "t"],
+    "tablespoon": [
+        "tablespoons",
+        "tablespoon",
+        "tbsps",
+        "tbsp",
+        "tbls",
+        "tbl",
+        "tbs",
+        "T",
+    ],
+    "cup": ["cups", "cup", "c", "C"],
+    "fluid ounce": ["fluid ounces", "fluid ounce", "fl. oz", "fl oz"],
+    "milliliter": ["millilitres", "milliliters", "millilitre", "milliliter", "ml"],
+    "centiliter": ["centilitres", "centiliters", "centilitre", "centiliter", "cl"],
+    "deciliter": ["decilitres", "deciliters", "decilitre", "deciliter", "dl"],
+    "liter": ["litres", "liters", "litre", "liter", "l", "L"],
+    "pint": ["pints", "pint", "pt"],
+    "quart": ["quarts", "quart", "qt"],
+    "gallon": ["gallons", "gallon", "gal"],
+    "milligram": ["milligrams", "milligram", "mg"],
+    "gram": ["grammes", "gramme", "grams", "gram", "gr", "g"],
+    "kilogram": ["kilograms", "kilogram", "kilos", "kilo", "kg"],
+    "ounce": ["ounces", "ounce", "oz"],
+    "pound": ["pounds", "pound", "lbs", "lb"],
+    "pinch": ["pinches", "pinch"],
+    "dash": ["dashes", "dash"],
+    "drop": ["drops", "drop"],
+    "clove": ["cloves", "clove"],
+    "can": ["cans", "can", "tins", "tin"],
+    "jar": ["jars", "jar"],
+    "package": ["packages", "package", "packets", "packet", "pkgs", "pkg"],
+    "stick": ["sticks", "stick"],
+    "slice": ["slices", "slice"],
+    "piece": ["pieces", "piece"],
+    "bunch": ["bunches", "bunch"],
+    "sprig": ["sprigs", "sprig"],
+    "stalk": ["stalks", "stalk"],
+    "head": ["heads", "head"],
+    "handful": ["handfuls", "handful"],
+    "knob": ["knobs", "knob"],
+    "sheet": ["sheets", "sheet"],
+}
+UNIT_ALIASES = {
+    alias if len(alias) == 1 else alias.lower(): unit
+    for unit, aliases in UNITS.items()
+    for alias in aliases
+}
+
+_fractions = "".join(VULGAR_FRACTIONS)
+_number = (
+    rf"\d+\s*[{_fractions}]"  # 1½
+    rf"|\d+\s+\d+\s*[/⁄]\s*\d+"  # 1 1/2
+    rf"|\d+\s*[/⁄]\s*\d+"  # 1/2
+    rf"|[{_fractions}]"
+    r"|\d+,\d{1,2}(?!\d)"  # 1,5
+    r"|\d*\.\d+|\d+"
+    rf"|(?i:{'|'.join(NUMBER_WORDS)})\b"
+)
+_unit = "|".join(
+    re.escape(alias) if len(alias) == 1 else f"(?i:{re.escape(alias)})"
+    for alias in sorted(
+        (alias for aliases in UNITS.values() for alias in aliases),
+        key=len,
+        reverse=True,
+    )
+)
+ingredient_regex = re.compile(
+    rf"(?P<quantity>{_number})"
+    rf"(?:\s*(?:-|–|—|to|or)\s*(?P<quantity_max>{_number}))?"
+    r"(?:\s*\((?P<size>[^)]*)\))?"  # 1 (14 oz) can
+    rf"\s*(?:(?P<unit>{_unit})(?![A-Za-z])\.?)?"
+    r"\s*(?:of\s+)?(?P<rest>.*)",
+    re.DOTALL,
+)
+# "a pinch of salt", but not "a few sprigs" or "an onion"
+article_regex = re.compile(
+    rf"(?i:an?)\s+(?P<unit>{_unit})(?![A-Za-z])\.?\s*(?:of\s+)?(?P<rest>.*)",
+    re.DOTALL,
+)
+number_regex = re.compile(_number)
+parentheses_regex = re.compile(r"\s*\(([^)]*)\)\s*")
+
+
+def parse_number(text: str) -> Fraction:
+    """The value of a number matched by number_regex."""
+    text = text.strip().lower()
+    if text in NUMBER_WORDS:
+        return Fraction(NUMBER_WORDS[text])
+    if text[-1] in VULGAR_FRACTIONS:
+        whole = text[:-1].strip()
+        return Fraction(int(whole or 0)) + VULGAR_FRACTIONS[text[-1]]
+    if "/" in text or "⁄" in text:
+        whole, _, fraction = re.sub(r"\s*[/⁄]\s*", "/", text).rpartition(" ")
+        numerator, denominator = fraction.split("/")
+        return int(whole or 0) + Fraction(int(numerator), int(denominator) or 1)
+    return Fraction(text.replace(",", "."))
+
+
+def _quantity(value: Fraction | None) -> float | None:
+    return None if value is None else round(float(value), 3)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def _parse_normalized(line: str) -> tuple:
+    quantity = quantity_max = unit = None
+    rest = line
+    notes = []
+    match = ingredient_regex.match(line) or article_regex.match(line)
+    if match:
+        groups = match.groupdict()
+        if groups.get("quantity"):
+            quantity = parse_number(groups["quantity"])
+        else:
+            quantity = Fraction(1)
+        if groups.get("quantity_max"):
+            quantity_max = parse_number(groups["quantity_max"])
+        if groups["unit"]:
+            alias = groups["unit"]
+            unit = UNIT_ALIASES[alias if len(alias) == 1 else alias.lower()]
+        if groups.get("size"):
+            notes.append(groups["size"])
+        rest = groups["rest"]
+
+    # Parenthesized sizes and asides go in the note
+    notes += parentheses_regex.findall(rest)
+    rest = parentheses_regex.sub(" ", rest).strip()
+    item, _, note = rest.partition(",")
+    notes.append(note)
+    note = ", ".join(part.strip() for part in notes if part.strip())
+    return (
+        _quantity(quantity),
+        _quantity(quantity_max),
+        unit,
+        item.strip(),
+        note or None,
+    )
+
+
+def parse_ingredient(line: str) -> dict:
+    quantity, quantity_max, unit, item, note = _parse_normalized(" ".join(line.split()))
+    return {
+        "text": line,
+        "quantity": quantity,
+        "quantity_max": quantity_max,
+        "unit": unit,
+        "item": item,
+        "note": note,
+    }
+
+
+def parse_ingredients(lines: list[str] | None) -> list[dict] | None:
+    """Parse a recipe's whole ingredient list."""
+    if lines is None:
+        return None
+    return [parse_ingredient(str(line)) for line in lines]
+
+
+def parse_yield(recipe_yield) -> float | None:
+    """The number of servings, or items, a recipe makes, e.g. 4 for
+    "Serves 4-6", or None if there's no number in it."""
+    if isinstance(recipe_yield, str) and recipe_yield.startswith("["):
+        try:
+            recipe_yield = json.loads(recipe_yield)
+        except ValueError:
+            pass
+    if isinstance(recipe_yield, list):
+        for value in recipe_yield:
+            servings = parse_yield(value)
+            if servings:
+                return servings
+        return None
+    if isinstance(recipe_yield, (int, float)):
+        return float(recipe_yield) or None
+    if not recipe_yield:
+        return None
+    match = number_regex.search(str(recipe_yield))
+    if not match:
+        return None
+    return float(parse_number(match.group())) or None
+
+
+def _scaled(value: float | None, factor: float) -> float | None:
+    return None if value is None else round(value * factor, 3)
+
+
+def scale_ingredients(parsed: list[dict], factor: float) -> list[dict]:
+    """Multiply the quantities of parsed ingredients by factor."""
+    return [
+        {
+            **ingredient,
+            "quantity": _scaled(ingredient["quantity"], factor),
+            "quantity_max": _scaled(ingredient["quantity_max"], factor),
+        }
+        for ingredient in parsed
+    ]
@@ -0,0 +1,147 @@
+"""Per-stage timings of the recipe import pipeline.
+
+Code wraps each stage in `stage(name)`. Inside `collect()`, i.e. while a
+single import runs, durations are added up per stage so the import can log
+them on one line, and are observed into histograms labelled with the parser
+path (ldjson or microdata) when the import finishes, so each stage is observed
+once per import however many times it ran. Stages run outside an import, such
+as the repository calls behind listing or searching recipes, aren't recorded.
+
+The histograms are per process and can be served in the Prometheus text
+format at /metrics by setting METRICS_ENABLED.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import threading
+import time
+
+from flask import Response
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Timings:
+    """Stage durations of one import, in seconds."""
+
+    def __init__(self):
+        self.stages = {}
+        self.path = ""
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def format(self) -> str:
+        return " ".join(
+            f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.stages.items()
+        )
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple[tuple[str, str], ...], value: float):
+        with self._lock:
+            series = self._series.setdefault(
+                labels, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                prefix = label_text + "," if label_text else ""
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+                lines.append(
+                    f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}'
+                )
+                lines.append(f"{self.name}_sum{{{label_text}}} {series['sum']}")
+                lines.append(f"{self.name}_count{{{label_text}}} {series['count']}")
+        return lines
+
+
+stage_seconds = Histogram(
+    "recipemod_import_stage_seconds",
+    "Time spent in each stage of recipe imports, by parser path",
+)
+_current: ContextVar[Timings | None] = ContextVar("import_timings", default=None)
+
+
+def _observe(name: str, path: str, seconds: float):
+    stage_seconds.observe((("path", path), ("stage", name)), seconds)
+
+
+@contextmanager
+def collect():
+    """Collect the stage timings of one import, and observe them into the
+    histograms with its parser path at the end."""
+    timings = Timings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+        for name, seconds in timings.stages.items():
+            _observe(name, timings.path, seconds)
+
+
+def set_path(path: str):
+    """Record which parser produced the recipe for the current import."""
+    timings = _current.get()
+    if timings is not None:
+        timings.path = path
+
+
+@contextmanager
+def stage(name: str):
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def timed(name: str):
+    """Decorator timing every call of a function made during an import as a
+    stage."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def render() -> str:
+    return "\n".join(stage_seconds.render()) + "\n"
+
+
+def init_app(app):
+    if app.config.get("METRICS_ENABLED"):
+
+        @app.route("/metrics")
+        def metrics():
+            return Response(render(), mimetype="text/plain; version=0.0.4")
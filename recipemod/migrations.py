@@ -1,7 +1,10 @@
 import click
 from flask.cli import with_appcontext
+from psycopg2.extras import Json, execute_values
 
+from recipemod import dedupe
 from recipemod.db import get_db
+from recipemod.ingredients import parse_ingredients
 
 
 def create_modifications_table():
@@ -34,6 +37,343 @@ def create_modifications_table_command():
         click.echo("Added modifications table")
 
 
+def create_import_jobs_table():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            """
+DROP TABLE IF EXISTS import_jobs;
+CREATE TABLE import_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id integer REFERENCES users(id) ON DELETE CASCADE,
+    url text NOT NULL,
+    user_agent text,
+    status text NOT NULL DEFAULT 'queued',
+    attempts integer NOT NULL DEFAULT 0,
+    max_attempts integer NOT NULL DEFAULT 3,
+    run_after timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    recipe_id integer REFERENCES recipes(id) ON DELETE SET NULL,
+    error text,
+    msg text,
+    debug boolean NOT NULL DEFAULT false,
+    trace text,
+    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX import_jobs_queued_idx ON import_jobs(run_after) WHERE status = 'queued';
+CREATE INDEX import_jobs_running_idx ON import_jobs(updated) WHERE status = 'running';
+"""
+        )
+
+
+@click.command("migrate-add-import-jobs-table")
+@with_appcontext
+def create_import_jobs_table_command():
+    try:
+        create_import_jobs_table()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added import_jobs table")
+
+
+def add_import_jobs_trace_columns():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "ALTER TABLE import_jobs "
+            "ADD COLUMN IF NOT EXISTS debug boolean NOT NULL DEFAULT false, "
+            "ADD COLUMN IF NOT EXISTS trace text;"
+        )
+
+
+@click.command("migrate-add-import-jobs-trace")
+@with_appcontext
+def add_import_jobs_trace_columns_command():
+    try:
+        add_import_jobs_trace_columns()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added debug and trace columns to import_jobs")
+
+
+def create_import_jobs_running_index():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS import_jobs_running_idx "
+            "ON import_jobs(updated) WHERE status = 'running';"
+        )
+
+
+@click.command("migrate-add-import-jobs-running-index")
+@with_appcontext
+def create_import_jobs_running_index_command():
+    try:
+        create_import_jobs_running_index()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added import_jobs running index")
+
+
+def create_page_archive_table():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            """
+ALTER TABLE recipes ADD COLUMN IF NOT EXISTS page_hash text;
+CREATE INDEX IF NOT EXISTS recipes_page_hash_idx ON recipes(page_hash);
+CREATE TABLE IF NOT EXISTS page_archive (
+    sha256 text PRIMARY KEY,
+    compression text NOT NULL,
+    size integer NOT NULL,
+    content bytea NOT NULL,
+    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_used timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+ALTER TABLE page_archive ALTER COLUMN content SET STORAGE EXTERNAL;
+"""
+        )
+
+
+@click.command("migrate-add-page-archive")
+@with_appcontext
+def create_page_archive_table_command():
+    try:
+        create_page_archive_table()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added page_archive table and recipes.page_hash column")
+
+
+def add_recipes_search_columns():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            """
+ALTER TABLE recipes
+    ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A')
+        || setweight(jsonb_to_tsvector('english', coalesce(keywords, '[]'), '["string"]'), 'B')
+        || setweight(jsonb_to_tsvector('english', coalesce(ingredients, '[]'), '["string"]'), 'C')
+        || setweight(to_tsvector('english', coalesce(description, '')), 'D')
+    ) STORED,
+    ADD COLUMN IF NOT EXISTS ingredients_vector tsvector GENERATED ALWAYS AS (
+        jsonb_to_tsvector('english', coalesce(ingredients, '[]'), '["string"]')
+    ) STORED;
+"""
+        )
+        # Built concurrently, and so one at a time, to keep recipes writable
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS recipes_search_vector_idx "
+            "ON recipes USING gin(search_vector);"
+        )
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS recipes_ingredients_vector_idx "
+            "ON recipes USING gin(ingredients_vector);"
+        )
+
+
+@click.command("migrate-add-recipes-search")
+@with_appcontext
+def add_recipes_search_columns_command():
+    try:
+        add_recipes_search_columns()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added recipes search columns and indexes")
+
+
+def create_recipes_user_created_index():
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS recipes_user_id_created_id_idx "
+            "ON recipes(user_id, created DESC, id DESC);"
+        )
+
+
+@click.command("migrate-add-recipes-user-created-index")
+@with_appcontext
+def create_recipes_user_created_index_command():
+    try:
+        create_recipes_user_created_index()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added recipes (user_id, created, id) index")
+
+
+def add_parsed_ingredients_column(batch_size: int = 500) -> int:
+    """Add recipes.parsed_ingredients and fill it in for existing recipes,
+    returning how many were parsed."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "ALTER TABLE recipes ADD COLUMN IF NOT EXISTS parsed_ingredients jsonb;"
+        )
+    done = 0
+    last_id = 0
+    while True:
+        with db.cursor() as c:
+            c.execute(
+                "SELECT id, ingredients FROM recipes WHERE id > %s "
+                "AND parsed_ingredients IS NULL AND ingredients IS NOT NULL "
+                "ORDER BY id LIMIT %s;",
+                (last_id, batch_size),
+            )
+            rows = c.fetchall()
+            if not rows:
+                return done
+            execute_values(
+                c,
+                "UPDATE recipes AS r SET parsed_ingredients = v.parsed "
+                "FROM (VALUES %s) AS v(id, parsed) WHERE r.id = v.id;",
+                [
+                    (recipe_id, Json(parse_ingredients(lines)))
+                    for recipe_id, lines in rows
+                ],
+                template="(%s, %s::jsonb)",
+                page_size=len(rows),
+            )
+        done += len(rows)
+        last_id = rows[-1][0]
+
+
+@click.command("migrate-add-parsed-ingredients")
+@with_appcontext
+def add_parsed_ingredients_column_command():
+    try:
+        done = add_parsed_ingredients_column()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo(f"Added recipes.parsed_ingredients and parsed {done} recipes")
+
+
+def add_recipe_dedupe_columns(batch_size: int = 500) -> int:
+    """Add recipes.canonical_url and recipes.fingerprint, fill them in for
+    existing recipes and index them, returning how many were filled in."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "ALTER TABLE recipes ADD COLUMN IF NOT EXISTS canonical_url text, "
+            "ADD COLUMN IF NOT EXISTS fingerprint bigint;"
+        )
+    done = 0
+    last_id = 0
+    while True:
+        with db.cursor() as c:
+            c.execute(
+                "SELECT id, url, name, ingredients FROM recipes WHERE id > %s "
+                "AND canonical_url IS NULL ORDER BY id LIMIT %s;",
+                (last_id, batch_size),
+            )
+            rows = c.fetchall()
+            if not rows:
+                break
+            execute_values(
+                c,
+                "UPDATE recipes AS r SET canonical_url = v.canonical_url, "
+                "fingerprint = v.fingerprint "
+                "FROM (VALUES %s) AS v(id, canonical_url, fingerprint) "
+                "WHERE r.id = v.id;",
+                [
+                    (
+                        recipe_id,
+                        dedupe.canonical_url(url) if url else None,
+                        dedupe.fingerprint(name, ingredients),
+                    )
+                    for recipe_id, url, name, ingredients in rows
+                ],
+                template="(%s, %s, %s::bigint)",
+                page_size=len(rows),
+            )
+        done += len(rows)
+        last_id = rows[-1][0]
+
+    with db.cursor() as c:
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "recipes_user_id_canonical_url_idx ON recipes(user_id, canonical_url);"
+        )
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "recipes_user_id_fingerprint_idx ON recipes(user_id, fingerprint);"
+        )
+    return done
+
+
+@click.command("migrate-add-recipe-dedupe")
+@with_appcontext
+def add_recipe_dedupe_columns_command():
+    try:
+        done = add_recipe_dedupe_columns()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo(
+            f"Added recipes.canonical_url and recipes.fingerprint for {done} recipes"
+        )
+
+
+def add_modification_deltas():
+    """Add the columns for patches and snapshots to modifications, and index
+    them by recipe and time. Existing modifications keep their old values in
+    full until `flask compact-history` rewrites them."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "ALTER TABLE modifications "
+            "ADD COLUMN IF NOT EXISTS delta boolean NOT NULL DEFAULT false, "
+            "ADD COLUMN IF NOT EXISTS snapshot jsonb;"
+        )
+        c.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+            "modifications_recipe_id_created_idx "
+            "ON modifications(recipe_id, created);"
+        )
+        # Covered by the new index
+        c.execute("DROP INDEX CONCURRENTLY IF EXISTS modifications_recipe_id_idx;")
+
+
+@click.command("migrate-add-modification-deltas")
+@with_appcontext
+def add_modification_deltas_command():
+    try:
+        add_modification_deltas()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added modifications.delta and modifications.snapshot")
+
+
+def add_users_session_version_column():
+    """Add the counter bumped to end all of a user's sessions."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "ALTER TABLE users "
+            "ADD COLUMN IF NOT EXISTS session_version integer NOT NULL DEFAULT 0;"
+        )
+
+
+@click.command("migrate-add-session-version")
+@with_appcontext
+def add_users_session_version_column_command():
+    try:
+        add_users_session_version_column()
+    except Exception as e:
+        click.echo(f"Failed: {e}")
+    else:
+        click.echo("Added users.session_version")
+
+
 def create_all_tables():
     with open("schema.sql") as infile:
         schema_sql = infile.read()
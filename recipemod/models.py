@@ -1,11 +1,28 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields as dataclass_fields
 from datetime import datetime
+from enum import Enum
 from typing import Any, Dict, List, Union, Optional
 
+from recipemod.patches import make_patch
+
 JSONDict = Dict[str, Any]
 
+# The fields users edit, whose history is kept in modifications
+VERSIONED_FIELDS = ["name", "ingredients", "instructions"]
+
+
+class Error(Enum):
+    NOT_FOUND = "NOT_FOUND"
+    REQUEST_FAILED = "REQUEST_FAILED"
+    MISSING_URL = "MISSING_URL"
+    PARSE_FAILED = "PARSE_FAILED"
+    INVALID_PARAMETER = "INVALID_PARAMETER"
+    TOO_MANY_URLS = "TOO_MANY_URLS"
+    SAVE_FAILED = "SAVE_FAILED"
+    CONFLICT = "CONFLICT"
+
 
-@dataclass
+@dataclass(slots=True)
 class Recipe:
     id: int | None = None
     name: str | None = None
@@ -16,18 +33,29 @@ class Recipe:
     authors: List[str] | None = None
     instructions: JSONDict | None = None
     ingredients: List[str] | None = None
+    parsed_ingredients: List[JSONDict] | None = None  # see ingredients.py
     times: JSONDict | None = None
     yield_: Union[List[str], int] | None = None
     categories: List[str] | None = None
     keywords: List[str] | None = None
     created: str | None = None  # for now
     updated: str | None = None
+    page_hash: str | None = None  # of the archived page it was parsed from
+    canonical_url: str | None = None  # see dedupe.py
+    fingerprint: int | None = None
 
-    def to_json(self):
-        return {
-            **asdict(self),
-            "yield": self.yield_,
+    def to_json(self, fields: List[str] | None = None):
+        # A shallow dict is enough as it's serialized straight away, and avoids
+        # asdict deep-copying every ingredient and instruction
+        data = {
+            field.name: getattr(self, field.name)
+            for field in dataclass_fields(self)
+            if field.name != "fingerprint"
         }
+        data["yield"] = self.yield_
+        if fields:
+            return {field: data[field] for field in fields}
+        return data
 
     @classmethod
     def from_json(cls, data: JSONDict) -> "Recipe":
@@ -35,19 +63,53 @@ class Recipe:
         return cls(**data)
 
 
-@dataclass
+@dataclass(slots=True)
 class Modification:
+    """An edit to a recipe. changed_fields maps each field it changed to a
+    patch turning the new value back into the old one or, if delta is false as
+    in modifications saved before patches were, to the old value itself. Some
+    also keep a snapshot of all VERSIONED_FIELDS as they were before the edit,
+    so past versions can be rebuilt without going through every later edit."""
+
     recipe_id: int
     changed_fields: JSONDict
     meta: Optional[JSONDict] = None
     id: Optional[int] = None
     created: Optional[datetime] = None
+    delta: bool = False
+    snapshot: Optional[JSONDict] = None
 
     @classmethod
     def from_recipes(cls, old_recipe: Recipe, new_recipe: Recipe) -> "Modification":
         changed_fields = {
-            key: getattr(old_recipe, key)
-            for key in ["name", "ingredients", "instructions"]
+            key: make_patch(getattr(new_recipe, key), getattr(old_recipe, key))
+            for key in VERSIONED_FIELDS
             if getattr(new_recipe, key) != getattr(old_recipe, key)
         }
-        return cls(changed_fields=changed_fields, recipe_id=old_recipe.id)
+        return cls(changed_fields=changed_fields, recipe_id=old_recipe.id, delta=True)
+
+
+@dataclass(slots=True)
+class ImportJob:
+    url: str
+    user_id: int
+    user_agent: Optional[str] = None
+    status: str = "queued"  # queued, running, done or failed
+    attempts: int = 0
+    max_attempts: int = 3
+    run_after: Optional[datetime] = None
+    recipe_id: Optional[int] = None
+    error: Optional[str] = None
+    msg: Optional[str] = None
+    debug: bool = False  # record the parse trace if the import fails
+    trace: Optional[str] = None
+    id: Optional[int] = None
+    created: Optional[datetime] = None
+    updated: Optional[datetime] = None
+
+    def to_json(self):
+        return {
+            field.name: getattr(self, field.name)
+            for field in dataclass_fields(self)
+            if field.name not in ("user_agent", "run_after")
+        }
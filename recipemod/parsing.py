@@ -1,28 +1,221 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import cached_property
+import html
+from itertools import islice
 import json
 from datetime import timedelta
+import logging
 import re
 from typing import Any
 import urllib
 
-from bs4 import BeautifulSoup, NavigableString
-from ftfy import fix_text
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag
+from ftfy import TextFixerConfig, fix_text
 
+from recipemod import metrics
 from recipemod.models import Recipe
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
 newline_regex = r"(\s*(\r|\n)\s*)+"
 
+# Matches the markup that lxml drops from text: script/style elements with their
+# contents, comments and tags (including an unterminated one at the very end).
+# A ">" inside a quoted attribute value doesn't end the tag.
+markup_regex = re.compile(
+    r"<(script|style)\b.*?</\1\s*>|<!--.*?(?:-->|$)"
+    r"|</?[a-zA-Z](?:=\s*(?:\"[^\"]*(?:\"|$)|'[^']*(?:'|$))|[^=>]+|=)*(?:>|$)",
+    re.DOTALL | re.IGNORECASE,
+)
+
+# Text ftfy could change without it being mojibake: anything but printable ASCII,
+# tabs and newlines, or an HTML entity.
+needs_fixing_regex = re.compile(r"[^\t\n\x0c\x20-\x7e]|&")
+
+# Mojibake from UTF-8 read as Latin-1 or Windows-1252: a lead byte followed by a
+# continuation byte, decoded as two characters instead of one, e.g. "Ã©" for "é".
+mojibake_regex = re.compile("[\xc2-\xf4][\x80-\xbfŒœŠšŸŽžƒˆ˜–—‘’‚“”„†‡•…‰‹›€™]")
+
+NO_ENCODING_FIX = TextFixerConfig(explain=False, fix_encoding=False)
+
+canonical_link_regex = re.compile(
+    r"<link\b[^>]*\brel\s*=\s*[\"']?canonical\b[^>]*>", re.IGNORECASE
+)
+href_regex = re.compile(
+    r"\bhref\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+))", re.IGNORECASE
+)
+
+# Only the ld+json script tags are kept when pre-scanning a page, so the rest of
+# the markup is never turned into a tree.
+ldjson_strainer = SoupStrainer("script", type="application/ld+json")
+
 
 class ParseError(Exception):
     pass
 
 
+_trace: ContextVar[list | None] = ContextVar("parse_trace", default=None)
+
+
+@contextmanager
+def trace():
+    """Capture the parser's debug messages in a list, whatever the log level,
+    e.g. to explain why an import failed."""
+    lines = []
+    token = _trace.set(lines)
+    try:
+        yield lines
+    finally:
+        _trace.reset(token)
+
+
+def _debug(msg: str, *args):
+    lines = _trace.get()
+    if lines is not None:
+        lines.append(msg % args)
+    logger.debug(msg, *args)
+
+
+_fix_encoding: ContextVar[bool] = ContextVar("fix_encoding", default=True)
+
+
+def has_mojibake(text: str) -> bool:
+    if "&" in text:
+        text = html.unescape(text)
+    return not text.isascii() and mojibake_regex.search(text) is not None
+
+
+@contextmanager
+def encoding_checked(source: str):
+    """Check a recipe's source for mojibake once, and only look for it in the
+    fields cleaned inside the block if there was some."""
+    token = _fix_encoding.set(has_mojibake(source))
+    try:
+        yield
+    finally:
+        _fix_encoding.reset(token)
+
+
+def repair_text(text: str) -> str:
+    """fix_text, skipping plain ASCII text, which it wouldn't change, and the
+    mojibake repair where the recipe's source was checked and had none."""
+    if not needs_fixing_regex.search(text):
+        return text
+    with metrics.stage("clean_text"):
+        if _fix_encoding.get():
+            return fix_text(text)
+        return fix_text(text, NO_ENCODING_FIX)
+
+
+def strip_markup(text: str) -> str:
+    """Remove tags and decode entities the way BeautifulSoup(text, "lxml").text
+    does, without building a document for every string."""
+    if "<" not in text and "&" not in text and "\r" not in text and "\x00" not in text:
+        return text
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\x00", "\ufffd")
+    if "<" in text:
+        text = markup_regex.sub("", text)
+    if "&" in text:
+        text = html.unescape(text)
+    return text
+
+
 def clean_text(text, remove_newlines=False) -> str:
-    cleaned = fix_text(BeautifulSoup(text, "lxml").text.strip())
+    cleaned = repair_text(strip_markup(text).strip())
     if remove_newlines:
         cleaned = re.sub(newline_regex, " ", cleaned)
     return cleaned
 
 
+def repair_texts(texts: list[str]) -> list[str]:
+    """repair_text for a list of texts, with the texts it could change joined
+    into lines and fixed with one fix_text call. fix_text fixes each line on
+    its own, except that a "<" stops it decoding entities for the rest of the
+    text, so a batch ends at each text with one. If fix_text adds line breaks,
+    e.g. for U+2028, the lines no longer match up and each text is repaired
+    separately."""
+    repaired = list(texts)
+    batch = []
+
+    def repair_batch():
+        if len(batch) == 1:
+            repaired[batch[0]] = repair_text(texts[batch[0]])
+        elif batch:
+            lines = repair_text("\n".join(texts[i] for i in batch)).split("\n")
+            counts = [texts[i].count("\n") + 1 for i in batch]
+            if len(lines) != sum(counts):
+                for i in batch:
+                    repaired[i] = repair_text(texts[i])
+            else:
+                start = 0
+                for i, count in zip(batch, counts):
+                    repaired[i] = "\n".join(lines[start : start + count])
+                    start += count
+        batch.clear()
+
+    for i, text in enumerate(texts):
+        if needs_fixing_regex.search(text):
+            batch.append(i)
+            if "<" in text:
+                repair_batch()
+    repair_batch()
+    return repaired
+
+
+def clean_texts(texts, remove_newlines=False) -> list[str]:
+    """clean_text for a whole list of fields, e.g. ingredients or steps,
+    repairing them together."""
+    cleaned = repair_texts([strip_markup(text).strip() for text in texts])
+    if remove_newlines:
+        cleaned = [re.sub(newline_regex, " ", text) for text in cleaned]
+    return cleaned
+
+
+def load_json(text: str):
+    """Decode JSON with orjson if it's installed, falling back to the json
+    module for what orjson rejects but json accepts, e.g. NaN or lone
+    surrogates."""
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+def walk_ldjson(data):
+    """Yield the Recipe nodes of an LD+JSON document in document order.
+
+    The walk is iterative and lazy, so a caller that only wants the first
+    recipe stops it there. Only arrays, mainEntity and @graph can lead to a
+    recipe, so no other property of a node is ever walked, e.g. the
+    breadcrumb lists and organization details of Yoast-style graphs."""
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if type(node) is list:
+            stack.extend(item for item in reversed(node) if type(item) in (dict, list))
+        elif type(node) is dict:
+            node_type = node.get("@type")
+            _debug("Found LD+JSON node of type %s", node_type)
+            # @type can be array of multiple types
+            if node_type == "Recipe" or (
+                type(node_type) is list and "Recipe" in node_type
+            ):
+                yield node
+            elif node.get("mainEntity"):
+                stack.append(node["mainEntity"])
+            elif node.get("@graph"):
+                stack.append(node["@graph"])
+
+
 def parse_iso_8601(iso_duration) -> timedelta:
     time = iso_duration.split("T")[1]
     args = {}
@@ -64,26 +257,28 @@ class MicrodataParser:
         else:
             return tag.text
 
-    def find_props(self, prop_name, verbose=False):
-        """Recursively parse webpages to find correct tag in Microdata
-        version of schema.org recipes."""
-
-        def digger(prop_name, tag, relevant_tags):
-            for child in tag.find_all(recursive=False):
-                if verbose:
-                    print(child.name, child.attrs, len(child.contents))
-                item_prop = child.attrs.get("itemprop")
-                if prop_name == item_prop:
-                    relevant_tags.append(child)
-                if "itemscope" in child.attrs:
-                    if verbose:
-                        print("skipping itemscope")
-                    continue
-                if child.contents:
-                    digger(prop_name, child, relevant_tags)
-            return relevant_tags
-
-        return digger(prop_name, self.tag, [])
+    @cached_property
+    def props(self) -> dict[str, list[Tag]]:
+        """Index of itemprop name to tags belonging to this item, in document
+        order. Built in one iterative walk that doesn't descend into nested
+        itemscopes."""
+        props = defaultdict(list)
+        stack = [child for child in reversed(self.tag.contents) if type(child) is Tag]
+        while stack:
+            tag = stack.pop()
+            item_prop = tag.attrs.get("itemprop")
+            if item_prop:
+                props[item_prop].append(tag)
+            if "itemscope" not in tag.attrs:
+                stack.extend(
+                    child for child in reversed(tag.contents) if type(child) is Tag
+                )
+        return props
+
+    def find_props(self, prop_name, limit=None):
+        """Find tags for a property in Microdata version of schema.org
+        recipes, returning at most limit tags."""
+        return self.props.get(prop_name, [])[:limit]
 
     def extract_text_props(self, prop_name, single_result=False, clean=True):
         tags = self.find_props(prop_name)
@@ -92,21 +287,21 @@ class MicrodataParser:
             for tag in tags
         ]
         if clean:
-            texts = [fix_text(text) for text in texts]
+            texts = [repair_text(text) for text in texts]
         if single_result:
             if texts:
                 if len(texts) > 1:
-                    print(f"Found {tags}, returning{tags[0]}")
+                    _debug("Found %s %s tags, using the first", len(tags), prop_name)
                 return texts[0]
             else:
-                print(f"No tags found for {prop_name}")
+                _debug("No %s tags found", prop_name)
                 return None
         return texts
 
     def get_times(self):
         times = {}
         for prop_name in ("cook", "prep", "total"):
-            time_tags = self.find_props(f"{prop_name}Time")
+            time_tags = self.find_props(f"{prop_name}Time", limit=1)
             if time_tags:
                 time_string = self.get_attr_text(time_tags[0], "datetime")
                 if time_string and time_string.startswith("P"):
@@ -114,7 +309,7 @@ class MicrodataParser:
         return times
 
     def get_image(self):
-        image_tags = self.find_props("image")
+        image_tags = self.find_props("image", limit=1)
         if image_tags:
             return self.get_attr_text(image_tags[0], attr="src")
 
@@ -126,7 +321,7 @@ class MicrodataParser:
                 step = [re.sub(newline_regex, " ", instructions_tag.text.strip())]
             else:
                 step = [
-                    fix_text(tag.text.strip())
+                    repair_text(tag.text.strip())
                     for tag in instructions_tag.find_all("li")
                     if not isinstance(tag, NavigableString)
                     and not tag.findChildren("li")
@@ -149,6 +344,10 @@ class MicrodataParser:
         return authors
 
     def get_recipe(self):
+        with encoding_checked(self.tag.get_text()):
+            return self.build_recipe()
+
+    def build_recipe(self):
         return Recipe(
             name=self.extract_text_props("name", single_result=True),
             description=self.extract_text_props("description", single_result=True),
@@ -168,38 +367,26 @@ class LDJSONParser:
     def __init__(self, script_tags):
         self.script_tags = script_tags
 
-    def extract_ldjson_recipe(self) -> list | None:
-        def parse_tree(data: dict[str, Any] | list[Any], recipes: list):
-            if type(data) == dict:
-                node_type = data.get("@type")
-                print(node_type)
-                # @type can be array of multiple types
-                if (type(node_type) == str and node_type == "Recipe") or (
-                    type(node_type) == list and "Recipe" in node_type
-                ):
-                    recipes.append(data)
-                elif data.get("mainEntity"):
-                    parse_tree(data["mainEntity"], recipes)
-                else:
-                    graph = data.get("@graph")
-                    if graph:
-                        parse_tree(graph, recipes)
-            elif type(data) == list:
-                for item in data:
-                    parse_tree(item, recipes)
-
-        recipes = []
+    def iter_ldjson_recipes(self):
+        """Yield the recipes in the script tags, decoding each tag only when
+        the walk gets to it. Tags that aren't valid JSON are skipped."""
         for tag in self.script_tags:
-            parse_tree(json.loads(tag.string), recipes)
-
-        if not recipes:
-            return None
-        elif len(recipes) > 1:
-            raise ParseError(
-                "This page contains more than one recipe:",
-                [recipe["name"] for recipe in recipes],
-            )
-        return recipes[0]
+            if not tag.string:
+                continue
+            try:
+                data = load_json(tag.string)
+            except ValueError as error:
+                _debug("Skipping LD+JSON script tag with invalid JSON: %s", error)
+                continue
+            yield from walk_ldjson(data)
+
+    def extract_ldjson_recipes(self, limit: int | None = None) -> list[dict]:
+        """The page's recipes, or at most limit of them."""
+        return list(islice(self.iter_ldjson_recipes(), limit))
+
+    def extract_ldjson_recipe(self) -> dict | None:
+        """The page's first recipe, without looking any further."""
+        return next(self.iter_ldjson_recipes(), None)
 
     @staticmethod
     def get_image_url(ldjson_recipe) -> str | None:
@@ -226,18 +413,15 @@ class LDJSONParser:
                 if type(first_step) == str:
                     return {
                         "type": "steps",
-                        "steps": [
-                            clean_text(step, remove_newlines=True) for step in steps
-                        ],
+                        "steps": clean_texts(steps, remove_newlines=True),
                     }
                 elif type(first_step) == dict:
                     if "HowToStep" in first_step["@type"]:
                         return {
                             "type": "steps",
-                            "steps": [
-                                clean_text(step["text"], remove_newlines=True)
-                                for step in steps
-                            ],
+                            "steps": clean_texts(
+                                [step["text"] for step in steps], remove_newlines=True
+                            ),
                         }
                     elif "HowToSection" in first_step["@type"]:
                         sections = []
@@ -255,10 +439,9 @@ class LDJSONParser:
                             sections += [
                                 {
                                     "name": section["name"],
-                                    "steps": [
-                                        clean_text(step, remove_newlines=True)
-                                        for step in substeps
-                                    ],
+                                    "steps": clean_texts(
+                                        substeps, remove_newlines=True
+                                    ),
                                 }
                             ]
                         return {"type": "sections", "sections": sections}
@@ -304,11 +487,22 @@ class LDJSONParser:
         elif type(categories) == list:
             return categories
 
-    def get_recipe(self):
+    def get_recipes(self, limit: int | None = None) -> list[Recipe]:
+        return [
+            self.build_recipe(ldjson_recipe)
+            for ldjson_recipe in self.extract_ldjson_recipes(limit)
+        ]
+
+    def get_recipe(self) -> Recipe | None:
         ldjson_recipe = self.extract_ldjson_recipe()
-        if not ldjson_recipe:
-            return
+        if ldjson_recipe:
+            return self.build_recipe(ldjson_recipe)
+
+    def build_recipe(self, ldjson_recipe) -> Recipe:
+        with encoding_checked(json.dumps(ldjson_recipe, ensure_ascii=False)):
+            return self._build_recipe(ldjson_recipe)
 
+    def _build_recipe(self, ldjson_recipe) -> Recipe:
         description = ldjson_recipe.get("description")
         return Recipe(
             name=clean_text(ldjson_recipe.get("name")),
@@ -317,9 +511,7 @@ class LDJSONParser:
             image_url=self.get_image_url(ldjson_recipe),
             yield_=ldjson_recipe.get("recipeYield"),
             instructions=self.get_instructions(ldjson_recipe),
-            ingredients=[
-                clean_text(item) for item in ldjson_recipe.get("recipeIngredient", [])
-            ],
+            ingredients=clean_texts(ldjson_recipe.get("recipeIngredient", [])),
             times=self.get_times(ldjson_recipe),
             authors=self.get_authors(ldjson_recipe),
             keywords=self.get_keywords(ldjson_recipe),
@@ -327,22 +519,62 @@ class LDJSONParser:
         )
 
 
-def parse_recipe_html(html: str, verbose: bool = False) -> Recipe:
-    soup = BeautifulSoup(html, "lxml")
+def find_canonical_link(page: str) -> str | None:
+    """The href of the page's <link rel="canonical">, as written."""
+    link = canonical_link_regex.search(page)
+    href = link and href_regex.search(link.group())
+    if not href:
+        return None
+    return html.unescape(next(group for group in href.groups() if group is not None))
+
+
+def parse_recipes_html(html: str, limit: int | None = None) -> list[Recipe]:
+    """Every recipe on a page, or at most limit of them, taken from LD+JSON if
+    the page has any there and from Microdata otherwise. Each recipe's
+    canonical_url is the page's <link rel="canonical">, if it has one."""
+    recipes = _parse_recipes_html(html, limit)
+    canonical_link = find_canonical_link(html)
+    for recipe in recipes:
+        recipe.canonical_url = canonical_link
+    return recipes
+
 
-    ldjson_tags = soup.find_all("script", type="application/ld+json")
+def _parse_recipes_html(html: str, limit: int | None) -> list[Recipe]:
+    if "application/ld+json" in html:
+        with metrics.stage("ldjson_prescan"):
+            ldjson_soup = BeautifulSoup(html, "lxml", parse_only=ldjson_strainer)
+            ldjson_tags = ldjson_soup.find_all("script", type="application/ld+json")
+    else:
+        ldjson_tags = []
+    _debug("Found %s LD+JSON script tags", len(ldjson_tags))
     if ldjson_tags:
         parser = LDJSONParser(ldjson_tags)
-        recipe = parser.get_recipe()
-        if recipe:
-            print("LD+JSON recipe found")
-            return recipe
-
-    recipe_microdata_elem = soup.find(itemtype=re.compile("https?://schema.org/Recipe"))
-    if recipe_microdata_elem:
-        if verbose:
-            print("Recipe microdata element found")
-        parser = MicrodataParser(recipe_microdata_elem)
-        return parser.get_recipe()
-
+        with metrics.stage("ldjson_extract"):
+            recipes = parser.get_recipes(limit)
+        if recipes:
+            _debug("Found %s LD+JSON recipes", len(recipes))
+            metrics.set_path("ldjson")
+            return recipes
+        _debug("No LD+JSON recipe found, looking for Microdata")
+
+    # No LD+JSON recipe, so fall back to building the full tree for Microdata
+    with metrics.stage("soup"):
+        soup = BeautifulSoup(html, "lxml")
+        recipe_microdata_elems = soup.find_all(
+            itemtype=re.compile("https?://schema.org/Recipe"), limit=limit
+        )
+    if recipe_microdata_elems:
+        _debug("Found %s recipe microdata elements", len(recipe_microdata_elems))
+        metrics.set_path("microdata")
+        with metrics.stage("microdata_extract"):
+            return [
+                MicrodataParser(elem).get_recipe() for elem in recipe_microdata_elems
+            ]
+
+    _debug("No recipe microdata element found")
     raise ParseError("No parsable recipe could be found.")
+
+
+def parse_recipe_html(html: str) -> Recipe:
+    """The first recipe on a page. Nothing after it is decoded or parsed."""
+    return parse_recipes_html(html, limit=1)[0]
@@ -0,0 +1,117 @@
+"""JSON-Patch style differences between JSON values, for storing the edits to
+a recipe compactly.
+
+make_patch(src, dst) returns a list of operations that turn src into dst, in
+the format of RFC 6902 but using only "add", "remove" and "replace":
+changing one word of the fourth ingredient gives
+[{"op": "replace", "path": "/3", "value": "2 cups milk"}]. Lists are compared
+after dropping their common start and end, so inserting or deleting items
+doesn't replace everything after them.
+"""
+import copy
+import json
+
+
+class PatchError(ValueError):
+    pass
+
+
+def _escape(key: str) -> str:
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def _diff(src, dst, path: str, ops: list):
+    if type(src) is type(dst) and isinstance(src, dict):
+        for key in src:
+            if key not in dst:
+                ops.append({"op": "remove", "path": f"{path}/{_escape(key)}"})
+        for key, value in dst.items():
+            if key not in src:
+                ops.append(
+                    {"op": "add", "path": f"{path}/{_escape(key)}", "value": value}
+                )
+            elif src[key] != value:
+                _diff(src[key], value, f"{path}/{_escape(key)}", ops)
+    elif type(src) is type(dst) and isinstance(src, list):
+        start = 0
+        while start < min(len(src), len(dst)) and src[start] == dst[start]:
+            start += 1
+        src_end, dst_end = len(src), len(dst)
+        while (
+            src_end > start and dst_end > start and src[src_end - 1] == dst[dst_end - 1]
+        ):
+            src_end -= 1
+            dst_end -= 1
+        common = min(src_end, dst_end) - start
+        for index in range(start, start + common):
+            _diff(src[index], dst[index], f"{path}/{index}", ops)
+        for index in range(start + common, dst_end):
+            ops.append({"op": "add", "path": f"{path}/{index}", "value": dst[index]})
+        for _ in range(start + common, src_end):
+            ops.append({"op": "remove", "path": f"{path}/{start + common}"})
+    elif src != dst or type(src) is not type(dst):
+        ops.append({"op": "replace", "path": path, "value": dst})
+
+
+def make_patch(src, dst) -> list[dict]:
+    """Operations turning src into dst, or a single replacement of the whole
+    value if that is no larger."""
+    ops = []
+    _diff(src, dst, "", ops)
+    whole = [{"op": "replace", "path": "", "value": dst}]
+    if ops and len(json.dumps(ops)) >= len(json.dumps(whole)):
+        return whole
+    return ops
+
+
+def _resolve(doc, path: str):
+    """The container holding the value at path, and its key or index."""
+    tokens = [_unescape(token) for token in path.split("/")[1:]]
+    parent = doc
+    for token in tokens[:-1]:
+        try:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        except (IndexError, KeyError, ValueError, TypeError) as error:
+            raise PatchError(f"No value at '{path}'") from error
+    key = tokens[-1]
+    if isinstance(parent, list):
+        try:
+            key = len(parent) if key == "-" else int(key)
+        except ValueError as error:
+            raise PatchError(f"Invalid list index in '{path}'") from error
+    elif not isinstance(parent, dict):
+        raise PatchError(f"No value at '{path}'")
+    return parent, key
+
+
+def apply_patch(doc, ops: list[dict]):
+    """A copy of doc with the operations applied."""
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        if op["path"] == "":
+            if op["op"] == "remove":
+                doc = None
+            else:
+                doc = copy.deepcopy(op["value"])
+            continue
+        parent, key = _resolve(doc, op["path"])
+        try:
+            if op["op"] == "add" and isinstance(parent, list):
+                if not 0 <= key <= len(parent):
+                    raise IndexError(key)
+                parent.insert(key, copy.deepcopy(op["value"]))
+            elif op["op"] in ("add", "replace"):
+                if isinstance(parent, list) and not 0 <= key < len(parent):
+                    raise IndexError(key)
+                parent[key] = copy.deepcopy(op["value"])
+            elif op["op"] == "remove":
+                del parent[key]
+            else:
+                raise PatchError(f"Unsupported operation '{op['op']}'")
+        except (IndexError, KeyError) as error:
+            raise PatchError(f"No value at '{op['path']}'") from error
+    return doc
@@ -0,0 +1,226 @@
+"""Re-parse recipes already in the database, so parser fixes also reach recipes
+imported before them.
+
+Recipes are streamed in batches with a server-side cursor. Each batch's pages
+are read from the page archive, or fetched again by a thread pool if they
+aren't archived, then parsed by a process pool, and only the fields whose
+extraction changed are updated. Fields the user has edited, as recorded in
+modifications, are never touched. The id of the last recipe done
+is saved after every batch, so an interrupted run carries on where it stopped.
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import dataclasses
+import json
+import logging
+import multiprocessing
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from recipemod import archive, imports, parsing, repository
+from recipemod.bulk import HostLimiter
+from recipemod.models import Recipe
+
+logger = logging.getLogger(__name__)
+
+# parsed_ingredients is updated along with ingredients, and the identity used
+# to find duplicates is worked out from the other fields
+REPARSE_FIELDS = [
+    attr
+    for attr in repository.RECIPE_UPDATE_COLUMNS
+    if attr not in ("parsed_ingredients", "canonical_url", "fingerprint")
+]
+
+
+def _stored(attr: str, value):
+    """The value as it reads back from the database, for comparison."""
+    if attr == "yield_" and value is not None and not isinstance(value, str):
+        # yield is a text column, so lists are stored as JSON and numbers as text
+        return json.dumps(value) if isinstance(value, (list, dict)) else str(value)
+    return value
+
+
+def changed_fields(old: Recipe, new: Recipe, modified: set[str]) -> dict:
+    """Fields of new that differ from old, leaving out fields the user has
+    modified and fields the new parse came up empty for."""
+    changes = {}
+    for attr in REPARSE_FIELDS:
+        if attr in modified or attr.rstrip("_") in modified:
+            continue
+        value = _stored(attr, getattr(new, attr))
+        if value in (None, "", [], {}):
+            continue
+        if value != getattr(old, attr):
+            changes[attr] = value
+    return changes
+
+
+def identity_changes(old: Recipe, new: Recipe, changes: dict) -> dict:
+    """The canonical URL and fingerprint that duplicates are found by, if they
+    differ once the changes are made: the URL from the page's canonical link,
+    and the fingerprint whenever the name or ingredients change."""
+    recipe = dataclasses.replace(old, **changes, canonical_url=new.canonical_url)
+    imports.identify(old.url, recipe)
+    identity = {}
+    if recipe.canonical_url != old.canonical_url:
+        identity["canonical_url"] = recipe.canonical_url
+    if "name" in changes or "ingredients" in changes:
+        identity["fingerprint"] = recipe.fingerprint
+    return identity
+
+
+def _load_page(app, limiter: HostLimiter, recipe: Recipe, refetch: bool):
+    """Return the text and archive hash of the page a recipe came from."""
+    with app.app_context():
+        if recipe.page_hash and not refetch:
+            try:
+                return archive.get_archive().read(recipe.page_hash), recipe.page_hash
+            except KeyError:
+                pass
+        with limiter.limit(recipe.url):
+            text = imports.fetch_page(recipe.url).text
+        return text, archive.store(text)
+
+
+def read_checkpoint(path: str) -> dict:
+    try:
+        with open(path, encoding="utf8") as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {"last_id": 0, "updated": 0, "unchanged": 0, "failed": 0}
+
+
+def write_checkpoint(path: str, progress: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as outfile:
+        json.dump(progress, outfile)
+    os.replace(tmp_path, path)
+
+
+def reparse_batch(
+    app, batch, fetch_pool, parse_pool, limiter, refetch=False
+) -> tuple[dict, int]:
+    """Re-parse a batch of (recipe, modified) pairs, returning the changes to
+    save by recipe id and the number of recipes that failed."""
+    fetches = [
+        (
+            recipe,
+            modified,
+            fetch_pool.submit(_load_page, app, limiter, recipe, refetch),
+        )
+        for recipe, modified in batch
+    ]
+    parses = []
+    failed = 0
+    for recipe, modified, future in fetches:
+        try:
+            text, page_hash = future.result()
+        except imports.ImportFailed as failure:
+            logger.info("Skipping recipe %s: %s", recipe.id, failure.msg)
+            failed += 1
+            continue
+        except Exception:
+            logger.exception(
+                "Unable to load page of recipe %s (page %s)",
+                recipe.id,
+                recipe.page_hash,
+            )
+            failed += 1
+            continue
+        parses.append(
+            (
+                recipe,
+                modified,
+                page_hash,
+                parse_pool.submit(parsing.parse_recipe_html, text),
+            )
+        )
+
+    changes = {}
+    for recipe, modified, page_hash, future in parses:
+        try:
+            new_recipe = future.result()
+        except parsing.ParseError as error:
+            logger.info("Skipping recipe %s: %s", recipe.id, error)
+            failed += 1
+            continue
+        except Exception:
+            # A parser bug on one page mustn't stop the run, or every resume
+            # from the checkpoint would stop on the same recipe
+            logger.exception(
+                "Unable to re-parse recipe %s (page %s)", recipe.id, page_hash
+            )
+            failed += 1
+            continue
+        new_recipe.page_hash = page_hash
+        fields = changed_fields(recipe, new_recipe, modified)
+        fields.update(identity_changes(recipe, new_recipe, fields))
+        if fields:
+            changes[recipe.id] = fields
+    return changes, failed
+
+
+@click.command("reparse-recipes")
+@click.option("--batch-size", default=100, help="Recipes read and saved at a time")
+@click.option("--processes", type=int, help="Parser processes")
+@click.option("--checkpoint", type=click.Path(), help="Progress file")
+@click.option("--restart", is_flag=True, help="Ignore saved progress")
+@click.option("--dry-run", is_flag=True, help="Report changes without saving")
+@click.option("--refetch", is_flag=True, help="Fetch pages even if archived")
+@with_appcontext
+def reparse_recipes_command(
+    batch_size, processes, checkpoint, restart, dry_run, refetch
+):
+    """Parse imported recipes again, updating fields whose extraction
+    changed."""
+    app = current_app._get_current_object()
+    config = app.config
+    if not checkpoint:
+        os.makedirs(app.instance_path, exist_ok=True)
+        checkpoint = os.path.join(app.instance_path, "reparse-checkpoint.json")
+    progress = read_checkpoint(checkpoint)
+    if restart or dry_run:
+        progress = {"last_id": 0, "updated": 0, "unchanged": 0, "failed": 0}
+    if progress["last_id"]:
+        click.echo(f"Resuming after recipe {progress['last_id']}")
+
+    total = repository.count_recipes_with_url(progress["last_id"])
+    done = 0
+    limiter = HostLimiter(int(config["BULK_PER_HOST"]))
+    with ThreadPoolExecutor(
+        int(config["BULK_FETCH_WORKERS"])
+    ) as fetch_pool, ProcessPoolExecutor(
+        processes or int(config["BULK_PARSE_PROCESSES"]),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as parse_pool:
+        for batch in repository.iter_recipe_batches(progress["last_id"], batch_size):
+            changes, failed = reparse_batch(
+                app, batch, fetch_pool, parse_pool, limiter, refetch
+            )
+            if dry_run:
+                for recipe_id, fields in changes.items():
+                    click.echo(f"{recipe_id}\t{', '.join(fields)}")
+            elif changes:
+                repository.update_recipe_fields(changes)
+
+            done += len(batch)
+            progress["last_id"] = batch[-1][0].id
+            progress["updated"] += len(changes)
+            progress["failed"] += failed
+            progress["unchanged"] += len(batch) - len(changes) - failed
+            if not dry_run:
+                write_checkpoint(checkpoint, progress)
+            click.echo(
+                f"{done}/{total} recipes: {progress['updated']} updated, "
+                f"{progress['unchanged']} unchanged, {progress['failed']} failed"
+            )
+
+    if os.path.exists(checkpoint) and not dry_run:
+        os.remove(checkpoint)
+    click.echo("Done")
+
+
+def init_app(app):
+    app.cli.add_command(reparse_recipes_command)
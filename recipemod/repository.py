@@ -1,12 +1,16 @@
-from dataclasses import asdict
+from dataclasses import asdict, fields as dataclass_fields
 from datetime import datetime
+import functools
 import logging
 
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 import psycopg2.errors
+import psycopg2.extensions
 
-from recipemod.db import get_db
-from recipemod.models import Recipe, Modification
+from recipemod import metrics
+from recipemod.db import get_db, get_pool
+from recipemod.ingredients import parse_ingredients
+from recipemod.models import VERSIONED_FIELDS, ImportJob, Recipe, Modification
 
 from recipemod.db import get_db
 
@@ -21,36 +25,66 @@ class NotFoundError(RepositoryError):
     """Item not found in database"""
 
 
-def _row_to_recipe(row) -> Recipe:
-    recipe = dict(row)
-    for attr, col_name in [
-        ("yield_", "yield"),
-        ("categories", "category"),
-    ]:
-        if col_name in recipe:
-            recipe[attr] = recipe.pop(col_name)
+class ConflictError(RepositoryError):
+    """Item kept changing while being updated"""
 
-    for col_name in ["ratings", "video", "reviews", "cuisine"]:
-        if col_name in recipe:
-            del recipe[col_name]
 
-    return Recipe(**recipe)
+# Columns stored under a different name from the model attribute
+COLUMN_ATTRS = {"yield": "yield_", "category": "categories"}
 
 
-def get_recipe_detail(recipe_id: int) -> Recipe:
-    logger.debug("Fetching recipe detail for ID %s", recipe_id)
+@functools.lru_cache(maxsize=256)
+def _row_builder(model, columns: tuple[str, ...]):
+    """Return a function building a model positionally from a row with these
+    columns, without an intermediate dict. Built once per column layout, and
+    kept for the most recently used layouts. Columns the model has no
+    attribute for are ignored."""
+    positions = {
+        COLUMN_ATTRS.get(column, column): i for i, column in enumerate(columns)
+    }
+    layout = [
+        (positions.get(field.name), field.default) for field in dataclass_fields(model)
+    ]
+
+    def build(row):
+        return model(*[default if i is None else row[i] for i, default in layout])
+
+    return build
+
+
+def _builder(model, cursor):
+    return _row_builder(model, tuple(column.name for column in cursor.description))
+
+
+def _tuple_cursor(conn, name=None):
+    """A cursor returning plain tuples, for rows that go straight into models."""
+    return conn.cursor(name, cursor_factory=psycopg2.extensions.cursor)
+
+
+@metrics.timed("db_get_user_by_username")
+def get_user_by_username(username: str):
     db = get_db()
     with db.cursor() as c:
+        c.execute("SELECT id, username FROM users WHERE username = %s;", (username,))
+        return c.fetchone()
+
+
+@metrics.timed("db_get_recipe_detail")
+def get_recipe_detail(recipe_id: int, user_id: int | None = None) -> Recipe:
+    """A recipe, which must belong to user_id if given."""
+    logger.debug("Fetching recipe detail for ID %s", recipe_id)
+    db = get_db()
+    with _tuple_cursor(db) as c:
         try:
             c.execute(
-                "SELECT r.* "
+                f"SELECT {RECIPE_SELECT} "
                 "FROM recipes r INNER JOIN users u on u.id=r.user_id "
-                "WHERE r.id = %s",
-                (recipe_id,),
+                "WHERE r.id = %s AND (%s IS NULL OR r.user_id = %s)",
+                (recipe_id, user_id, user_id),
             )
             row = c.fetchone()
             if row:
-                return _row_to_recipe(row)
+                return _builder(Recipe, c)(row)
             logger.error("Unable to load recipe with ID %s as not found", recipe_id)
             raise NotFoundError(
                 f"Unable to delete recipe with ID {recipe_id} as not found"
@@ -60,52 +94,487 @@ def get_recipe_detail(recipe_id: int) -> Recipe:
             raise
 
 
-def get_recipes_by_user(user_id: int) -> list[Recipe]:
-    logger.debug("Fetching recipes for user %s", user_id)
+@metrics.timed("db_get_recipe_ingredients")
+def get_recipe_ingredients(recipe_id: int, user_id: int) -> Recipe:
+    """A user's recipe with only its yield and ingredients loaded."""
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                "SELECT id, yield, ingredients, parsed_ingredients FROM recipes "
+                "WHERE id = %s AND user_id = %s;",
+                (recipe_id, user_id),
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error getting ingredients of recipe %s", recipe_id)
+            raise
+        row = c.fetchone()
+        if not row:
+            raise NotFoundError(f"Recipe with ID {recipe_id} not found")
+        return _builder(Recipe, c)(row)
+
+
+@metrics.timed("db_get_recipe_version")
+def get_recipe_version(
+    recipe_id: int, user_id: int | None = None
+) -> tuple[datetime, datetime | None] | None:
+    """The created and updated times of a recipe, or None if it doesn't exist
+    or doesn't belong to user_id, if given."""
     db = get_db()
     with db.cursor() as c:
         try:
-            logger.debug("Fetching recipes for user %s", user_id)
             c.execute(
-                "SELECT r.id, name, description, image_url, url, created "
-                "FROM recipes r "
-                "INNER JOIN users u ON u.id=r.user_id "
-                "WHERE u.id=%s "
-                "ORDER BY r.created DESC;",
-                (str(user_id)),
+                "SELECT created, updated FROM recipes "
+                "WHERE id = %s AND (%s IS NULL OR user_id = %s);",
+                (recipe_id, user_id, user_id),
             )
-            return [_row_to_recipe(row) for row in c.fetchall()]
+        except psycopg2.errors.Error:
+            logger.exception("Error getting version of recipe %s", recipe_id)
+            raise
+        row = c.fetchone()
+    return tuple(row) if row else None
+
+
+# Recipe fields, as named in the API, and the columns they're read from
+RECIPE_COLUMNS = {
+    "id": "id",
+    "name": "name",
+    "description": "description",
+    "user_id": "user_id",
+    "url": "url",
+    "image_url": "image_url",
+    "authors": "authors",
+    "instructions": "instructions",
+    "ingredients": "ingredients",
+    "parsed_ingredients": "parsed_ingredients",
+    "times": "times",
+    "yield": "yield",
+    "categories": "category",
+    "keywords": "keywords",
+    "created": "created",
+    "updated": "updated",
+    "canonical_url": "canonical_url",
+}
+# Every stored recipe column, leaving out the search vectors
+RECIPE_SELECT = ", ".join(
+    f'r."{column}"' for column in [*RECIPE_COLUMNS.values(), "page_hash"]
+)
+
+
+def _field_columns(fields: list[str]) -> str:
+    """The columns to read for some recipe fields, always in the same order
+    whatever order and repeats the fields come in, so each set of fields has
+    one row layout."""
+    wanted = {"id", "created", *fields}
+    return ", ".join(
+        f'"{column}"' for field, column in RECIPE_COLUMNS.items() if field in wanted
+    )
+
+
+@metrics.timed("db_get_recipes_by_user")
+def get_recipes_by_user(
+    user_id: int,
+    limit: int | None = None,
+    after: tuple[datetime, int] | None = None,
+    fields: list[str] | None = None,
+) -> list[Recipe]:
+    """Get a user's recipes, newest first. after is the (created, id) of the
+    last recipe on the previous page, and fields limits the columns read."""
+    logger.debug("Fetching recipes for user %s", user_id)
+    fields = fields or ["name", "description", "image_url", "url"]
+    columns = _field_columns(fields)
+    query = f"SELECT {columns} FROM recipes WHERE user_id = %(user_id)s "
+    if after:
+        query += "AND (created, id) < (%(created)s, %(id)s) "
+    query += "ORDER BY created DESC, id DESC"
+    if limit:
+        query += " LIMIT %(limit)s"
+
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                query + ";",
+                {
+                    "user_id": user_id,
+                    "created": after and after[0],
+                    "id": after and after[1],
+                    "limit": limit,
+                },
+            )
+            build = _builder(Recipe, c)
+            return [build(row) for row in c.fetchall()]
         except psycopg2.errors.Error:
             logger.exception("Error getting recipes for user %s", user_id)
             raise
 
 
-def save_recipe(recipe: Recipe) -> Recipe:
-    """Save recipe to database"""
+@metrics.timed("db_search_recipes")
+def search_recipes(
+    user_id: int,
+    query: str | None = None,
+    ingredients: list[str] | None = None,
+    limit: int | None = None,
+    after: tuple[float, int] | None = None,
+    fields: list[str] | None = None,
+) -> list[tuple[Recipe, float]]:
+    """Search a user's recipes, returning (recipe, rank) pairs, best first.
+
+    query is matched against the name, keywords, ingredients and description,
+    in that order of weight, and every one of ingredients must appear in the
+    ingredient list. after is the (rank, id) of the last result on the
+    previous page.
+    """
+    fields = fields or ["name", "description", "image_url", "url"]
+    columns = _field_columns(fields)
+    conditions = ["user_id = %(user_id)s"]
+    # The rank uses the text query and the ingredients together
+    rank_query = []
+    if query:
+        conditions.append("search_vector @@ websearch_to_tsquery('english', %(query)s)")
+        rank_query.append("websearch_to_tsquery('english', %(query)s)")
+    for i, _ in enumerate(ingredients or []):
+        conditions.append(
+            f"ingredients_vector @@ plainto_tsquery('english', %(ingredient_{i})s)"
+        )
+        rank_query.append(f"plainto_tsquery('english', %(ingredient_{i})s)")
+    rank = f"ts_rank_cd(search_vector, {' && '.join(rank_query)})"
+    query_sql = (
+        f"SELECT * FROM (SELECT {columns}, {rank} AS rank FROM recipes "
+        f"WHERE {' AND '.join(conditions)}) matches "
+    )
+    if after:
+        query_sql += "WHERE (rank, id) < (%(rank)s::real, %(id)s) "
+    query_sql += "ORDER BY rank DESC, id DESC"
+    if limit:
+        query_sql += " LIMIT %(limit)s"
+
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                query_sql + ";",
+                {
+                    "user_id": user_id,
+                    "query": query,
+                    **{
+                        f"ingredient_{i}": ing
+                        for i, ing in enumerate(ingredients or [])
+                    },
+                    "rank": after and after[0],
+                    "id": after and after[1],
+                    "limit": limit,
+                },
+            )
+            build = _builder(Recipe, c)
+            return [(build(row), row[-1]) for row in c.fetchall()]
+        except psycopg2.errors.Error:
+            logger.exception("Error searching recipes for user %s", user_id)
+            raise
+
+
+RECIPE_INSERT_COLUMNS = (
+    "name, description, yield, ingredients, parsed_ingredients, instructions, "
+    "times, user_id, image_url, url, authors, category, keywords, page_hash, "
+    "canonical_url, fingerprint"
+)
+RECIPE_INSERT_VALUES = (
+    "(%(name)s, %(description)s, %(yield_)s, %(ingredients)s, "
+    "%(parsed_ingredients)s, %(instructions)s, %(times)s, %(user_id)s, "
+    "%(image_url)s, %(url)s, %(authors)s, %(categories)s, %(keywords)s, "
+    "%(page_hash)s, %(canonical_url)s, %(fingerprint)s)"
+)
+
+
+def _recipe_payload(recipe: Recipe) -> dict:
+    if recipe.parsed_ingredients is None:
+        recipe.parsed_ingredients = parse_ingredients(recipe.ingredients)
     payload = asdict(recipe)
     for key, value in payload.items():
         if type(value) in (list, dict):
             payload[key] = Json(value)
+    return payload
+
+
+@metrics.timed("db_save_recipe")
+def save_recipe(recipe: Recipe) -> Recipe:
+    """Save recipe to database"""
+    payload = _recipe_payload(recipe)
 
     db = get_db()
     with db.cursor() as c:
         try:
             c.execute(
-                "INSERT INTO recipes (name, description, yield, ingredients, "
-                "instructions, times, user_id, image_url, url, authors, category, keywords) "
-                "VALUES (%(name)s, %(description)s, %(yield_)s, %(ingredients)s, "
-                "%(instructions)s, %(times)s, %(user_id)s, %(image_url)s, "
-                "%(url)s, %(authors)s, %(categories)s, %(keywords)s) RETURNING id;",
+                f"INSERT INTO recipes ({RECIPE_INSERT_COLUMNS}) "
+                f"VALUES {RECIPE_INSERT_VALUES} RETURNING id;",
                 payload,
             )
         except psycopg2.errors.Error:
-            logger.exception("Error writing recipe '%s' to database: '%s'", recipe.url)
+            logger.exception("Error writing recipe '%s' to database", recipe.url)
             raise
         recipe_id = c.fetchone()[0]
         recipe.id = recipe_id
     return recipe
 
 
+@metrics.timed("db_save_recipes")
+def save_recipes(recipes: list[Recipe]) -> list[Recipe]:
+    """Save many recipes to the database with a single multi-row insert"""
+    if not recipes:
+        return []
+
+    db = get_db()
+    with db.cursor() as c:
+        try:
+            rows = execute_values(
+                c,
+                f"INSERT INTO recipes ({RECIPE_INSERT_COLUMNS}) VALUES %s RETURNING id;",
+                [_recipe_payload(recipe) for recipe in recipes],
+                template=RECIPE_INSERT_VALUES,
+                page_size=len(recipes),
+                fetch=True,
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error writing %s recipes to database", len(recipes))
+            raise
+    for recipe, row in zip(recipes, rows):
+        recipe.id = row[0]
+    return recipes
+
+
+def iter_recipe_batches(after_id: int = 0, batch_size: int = 100):
+    """Yield batches of (recipe, modified) pairs for recipes imported from a URL,
+    in id order, where modified is the set of fields the user has changed.
+
+    Rows are streamed with a server-side cursor on a connection of their own,
+    so other queries can run between batches.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        conn.autocommit = False
+        with _tuple_cursor(conn, "recipe_batches") as c:
+            c.itersize = batch_size
+            c.execute(
+                f"SELECT {RECIPE_SELECT}, ARRAY("
+                "SELECT DISTINCT jsonb_object_keys(m.changed_fields) "
+                "FROM modifications m WHERE m.recipe_id = r.id"
+                ") AS modified "
+                "FROM recipes r WHERE r.id > %s AND r.url IS NOT NULL ORDER BY r.id;",
+                (after_id,),
+            )
+            while rows := c.fetchmany(batch_size):
+                # The description is only known once the first rows are fetched
+                build = _builder(Recipe, c)
+                yield [(build(row), set(row[-1])) for row in rows]
+    except psycopg2.errors.Error:
+        logger.exception("Error reading recipes after ID %s", after_id)
+        raise
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = True
+        pool.putconn(conn)
+
+
+@metrics.timed("db_count_recipes_with_url")
+def count_recipes_with_url(after_id: int = 0) -> int:
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "SELECT count(*) FROM recipes WHERE id > %s AND url IS NOT NULL;",
+            (after_id,),
+        )
+        return c.fetchone()[0]
+
+
+# Recipe attributes and the columns they're stored in, for partial updates
+RECIPE_UPDATE_COLUMNS = {
+    "name": "name",
+    "description": "description",
+    "image_url": "image_url",
+    "authors": "authors",
+    "instructions": "instructions",
+    "ingredients": "ingredients",
+    "parsed_ingredients": "parsed_ingredients",
+    "times": "times",
+    "yield_": "yield",
+    "categories": "category",
+    "keywords": "keywords",
+    "page_hash": "page_hash",
+    "canonical_url": "canonical_url",
+    "fingerprint": "fingerprint",
+}
+JSONB_COLUMNS = {
+    "authors",
+    "instructions",
+    "ingredients",
+    "parsed_ingredients",
+    "times",
+    "category",
+    "keywords",
+}
+
+
+@metrics.timed("db_find_referenced_page_hashes")
+def find_referenced_page_hashes(page_hashes: list[str]) -> set[str]:
+    """The subset of page_hashes that some recipe was parsed from."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "SELECT DISTINCT page_hash FROM recipes WHERE page_hash = ANY(%s);",
+            (page_hashes,),
+        )
+        return {row[0] for row in c.fetchall()}
+
+
+@metrics.timed("db_update_recipe_fields")
+def update_recipe_fields(changes: dict[int, dict]):
+    """Update some fields of many recipes, given {recipe_id: {attr: value}}.
+
+    Recipes changing the same set of fields are updated with one statement,
+    and parsed_ingredients is kept in step with ingredients.
+    """
+    groups = {}
+    for recipe_id, fields in changes.items():
+        if "ingredients" in fields:
+            fields = {
+                **fields,
+                "parsed_ingredients": parse_ingredients(fields["ingredients"]),
+            }
+        groups.setdefault(tuple(sorted(fields)), []).append((recipe_id, fields))
+
+    db = get_db()
+    with db.cursor() as c:
+        for attrs, group in groups.items():
+            columns = [RECIPE_UPDATE_COLUMNS[attr] for attr in attrs]
+            template = (
+                "(%s, "
+                + ", ".join(
+                    "%s::jsonb" if column in JSONB_COLUMNS else "%s"
+                    for column in columns
+                )
+                + ")"
+            )
+            rows = [
+                (recipe_id,)
+                + tuple(
+                    Json(fields[attr])
+                    if type(fields[attr]) in (list, dict)
+                    else fields[attr]
+                    for attr in attrs
+                )
+                for recipe_id, fields in group
+            ]
+            assignments = ", ".join(f'"{column}" = v."{column}"' for column in columns)
+            column_list = ", ".join(f'"{column}"' for column in columns)
+            try:
+                execute_values(
+                    c,
+                    f"UPDATE recipes AS r SET {assignments}, "
+                    "updated = CURRENT_TIMESTAMP "
+                    f"FROM (VALUES %s) AS v(id, {column_list}) WHERE r.id = v.id;",
+                    rows,
+                    template=template,
+                    page_size=len(rows),
+                )
+            except psycopg2.errors.Error:
+                logger.exception(
+                    "Error updating fields %s of %s recipes", attrs, len(rows)
+                )
+                raise
+
+
+@metrics.timed("db_find_duplicate_recipe")
+def find_duplicate_recipe(
+    user_id: int,
+    canonical_url: str | None,
+    fingerprint: int | None = None,
+    max_distance: int = 3,
+) -> Recipe | None:
+    """The user's earliest recipe with the same canonical URL or, if given and
+    none has it, a fingerprint differing in at most max_distance bits.
+
+    The URL is looked up on its own first, as that uses the index, and only
+    if it finds nothing are the user's fingerprints scanned."""
+    queries = []
+    if canonical_url is not None:
+        queries.append("canonical_url = %(canonical_url)s")
+    if fingerprint is not None:
+        queries.append(
+            "length(replace(((fingerprint # %(fingerprint)s)::bit(64))::text, "
+            "'0', '')) <= %(max_distance)s"
+        )
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        for condition in queries:
+            try:
+                c.execute(
+                    "SELECT id, name, url, canonical_url, created FROM recipes "
+                    f"WHERE user_id = %(user_id)s AND {condition} "
+                    "ORDER BY id LIMIT 1;",
+                    {
+                        "user_id": user_id,
+                        "canonical_url": canonical_url,
+                        "fingerprint": fingerprint,
+                        "max_distance": max_distance,
+                    },
+                )
+            except psycopg2.errors.Error:
+                logger.exception("Error looking for duplicates of '%s'", canonical_url)
+                raise
+            row = c.fetchone()
+            if row:
+                return _builder(Recipe, c)(row)
+    return None
+
+
+@metrics.timed("db_get_user_ids")
+def get_user_ids() -> list[int]:
+    db = get_db()
+    with db.cursor() as c:
+        c.execute("SELECT id FROM users ORDER BY id;")
+        return [row[0] for row in c.fetchall()]
+
+
+@metrics.timed("db_get_recipe_identities")
+def get_recipe_identities(user_id: int) -> list[tuple[int, str | None, int | None]]:
+    """(id, canonical_url, fingerprint) of each of a user's recipes, by id."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "SELECT id, canonical_url, fingerprint FROM recipes "
+            "WHERE user_id = %s ORDER BY id;",
+            (user_id,),
+        )
+        return c.fetchall()
+
+
+@metrics.timed("db_find_modified_recipe_ids")
+def find_modified_recipe_ids(recipe_ids: list[int]) -> set[int]:
+    """The subset of recipe_ids that the user has edited."""
+    db = get_db()
+    with db.cursor() as c:
+        c.execute(
+            "SELECT DISTINCT recipe_id FROM modifications WHERE recipe_id = ANY(%s);",
+            (recipe_ids,),
+        )
+        return {row[0] for row in c.fetchall()}
+
+
+@metrics.timed("db_delete_recipes")
+def delete_recipes(recipe_ids: list[int]) -> int:
+    db = get_db()
+    with db.cursor() as c:
+        try:
+            c.execute("DELETE FROM recipes WHERE id = ANY(%s);", (recipe_ids,))
+        except psycopg2.errors.Error:
+            logger.exception("Error deleting recipes %s from database", recipe_ids)
+            raise
+        return c.rowcount
+
+
+@metrics.timed("db_delete_recipe")
 def delete_recipe(recipe_id: int) -> None:
     db = get_db()
     with db.cursor() as c:
@@ -123,47 +592,380 @@ def delete_recipe(recipe_id: int) -> None:
             raise
 
 
-def update_recipe(recipe: Recipe):
+# Times an edit is tried before giving up on a recipe that keeps changing
+UPDATE_ATTEMPTS = 3
+
+
+@metrics.timed("db_update_recipe")
+def update_recipe(recipe: Recipe, snapshot_interval: int = 10) -> Modification:
+    """Save the user's edits to a recipe, recording what they changed in
+    modifications.
+
+    The old values are read first, to turn the edit into patches back to them.
+    A second statement then updates the recipe and inserts the modification
+    together, but only if the recipe is still as it was read. If another edit
+    got in between, both are tried again, up to UPDATE_ATTEMPTS times, so
+    concurrent edits are applied one after the other and each records the
+    values it replaced. One in every snapshot_interval modifications of a
+    recipe also keeps a snapshot of the old values. Nothing is written if no
+    field changed, in which case the modification's changed_fields is empty.
+    Raises NotFoundError if the recipe doesn't exist, and ConflictError if it
+    kept changing."""
+    db = get_db()
+    try:
+        with _tuple_cursor(db) as c:
+            for _ in range(UPDATE_ATTEMPTS):
+                c.execute(
+                    "SELECT id, name, ingredients, instructions, updated, ("
+                    "SELECT count(*) FROM modifications m WHERE m.recipe_id = r.id "
+                    "AND m.id > (SELECT coalesce(max(s.id), 0) FROM modifications s "
+                    "WHERE s.recipe_id = r.id AND s.snapshot IS NOT NULL)"
+                    ") AS since_snapshot FROM recipes r WHERE id = %s;",
+                    (recipe.id,),
+                )
+                row = c.fetchone()
+                if not row:
+                    raise NotFoundError(
+                        f"Unable to update recipe with ID {recipe.id} as not found"
+                    )
+                old_recipe = _builder(Recipe, c)(row)
+                mod = Modification.from_recipes(old_recipe, recipe)
+                mod.meta = {}
+                if not mod.changed_fields:
+                    return mod
+                if row[-1] + 1 >= snapshot_interval:
+                    mod.snapshot = {
+                        field: getattr(old_recipe, field) for field in VERSIONED_FIELDS
+                    }
+                c.execute(
+                    """WITH updated AS (
+                        UPDATE recipes SET
+                            name = %(name)s,
+                            ingredients = %(ingredients)s,
+                            parsed_ingredients = coalesce(
+                                %(parsed_ingredients)s, parsed_ingredients
+                            ),
+                            instructions = %(instructions)s,
+                            updated = CURRENT_TIMESTAMP
+                        -- Every change to the edited fields sets updated
+                        WHERE id = %(id)s
+                        AND updated IS NOT DISTINCT FROM %(old_updated)s
+                        RETURNING id
+                    )
+                    INSERT INTO modifications
+                        (recipe_id, changed_fields, meta, delta, snapshot)
+                    SELECT id, %(changed_fields)s, '{}', true, %(snapshot)s
+                    FROM updated
+                    RETURNING id, created;""",
+                    {
+                        "id": recipe.id,
+                        "name": recipe.name,
+                        "ingredients": Json(recipe.ingredients),
+                        # Only parsed again if the ingredients changed
+                        "parsed_ingredients": Json(
+                            parse_ingredients(recipe.ingredients)
+                        )
+                        if "ingredients" in mod.changed_fields
+                        else None,
+                        "instructions": Json(recipe.instructions),
+                        "old_updated": old_recipe.updated,
+                        "changed_fields": Json(mod.changed_fields),
+                        "snapshot": None
+                        if mod.snapshot is None
+                        else Json(mod.snapshot),
+                    },
+                )
+                row = c.fetchone()
+                if row:
+                    mod.id, mod.created = row
+                    return mod
+                logger.debug("Recipe %s changed while editing, retrying", recipe.id)
+    except psycopg2.errors.Error:
+        logger.exception("Error updating recipe with ID %s in database", recipe.id)
+        raise
+    logger.error(
+        "Recipe %s changed during %s attempts to edit it", recipe.id, UPDATE_ATTEMPTS
+    )
+    raise ConflictError(f"Recipe with ID {recipe.id} changed while being updated")
+
+
+MODIFICATION_SELECT = "id, recipe_id, changed_fields, meta, created, delta, snapshot"
+
+
+@metrics.timed("db_get_modifications")
+def get_modifications(recipe_id: int) -> list[Modification]:
+    """All of a recipe's modifications, newest first."""
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                f"SELECT {MODIFICATION_SELECT} FROM modifications "
+                "WHERE recipe_id = %s ORDER BY created DESC, id DESC;",
+                (recipe_id,),
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error getting modifications of recipe %s", recipe_id)
+            raise
+        return list(map(_builder(Modification, c), c.fetchall()))
+
+
+@metrics.timed("db_get_modifications_after")
+def get_modifications_after(recipe_id: int, after: datetime) -> list[Modification]:
+    """The modifications of a recipe needed to rebuild it as it was at after:
+    those made since, newest first, back to the one with the nearest snapshot
+    if there is one."""
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                f"""WITH snapshot AS (
+                    SELECT created, id FROM modifications
+                    WHERE recipe_id = %(recipe_id)s AND created > %(after)s
+                    AND snapshot IS NOT NULL
+                    ORDER BY created, id LIMIT 1
+                )
+                SELECT {MODIFICATION_SELECT} FROM modifications m
+                WHERE recipe_id = %(recipe_id)s AND created > %(after)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM snapshot s
+                    WHERE (m.created, m.id) > (s.created, s.id)
+                )
+                ORDER BY created DESC, id DESC;""",
+                {"recipe_id": recipe_id, "after": after},
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error getting modifications of recipe %s", recipe_id)
+            raise
+        return list(map(_builder(Modification, c), c.fetchall()))
+
+
+@metrics.timed("db_get_recipe_ids_to_compact")
+def get_recipe_ids_to_compact(older_than: float) -> tuple[datetime, list[int]]:
+    """The time older_than seconds ago, and the recipes with more than one
+    modification from before then or any saved without patches."""
     db = get_db()
     with db.cursor() as c:
+        c.execute(
+            "WITH cutoff AS ("
+            "SELECT LOCALTIMESTAMP - make_interval(secs => %s) AS before"
+            ") SELECT before, ARRAY("
+            "SELECT recipe_id FROM modifications WHERE created < before "
+            "GROUP BY recipe_id HAVING count(*) > 1 OR bool_or(NOT delta) "
+            "ORDER BY recipe_id"
+            ") FROM cutoff;",
+            (older_than,),
+        )
+        return tuple(c.fetchone())
+
+
+@metrics.timed("db_squash_modifications")
+def squash_modifications(recipe_id: int, squash) -> int:
+    """Replace some of a recipe's modifications with one, returning how many
+    were removed.
+
+    squash is called with the recipe's current versioned fields and all its
+    modifications, oldest first, and returns the ids of the ones to replace and
+    the modification replacing them, which takes the id of one of them, or
+    None to leave them. The recipe is locked meanwhile so it can't be edited."""
+    db = get_db()
+    try:
+        with db, _tuple_cursor(db) as c:
+            c.execute(
+                f"SELECT {', '.join(VERSIONED_FIELDS)} FROM recipes "
+                "WHERE id = %s FOR UPDATE;",
+                (recipe_id,),
+            )
+            row = c.fetchone()
+            if not row:
+                raise NotFoundError(f"Recipe with ID {recipe_id} not found")
+            fields = dict(zip(VERSIONED_FIELDS, row))
+            c.execute(
+                f"SELECT {MODIFICATION_SELECT} FROM modifications "
+                "WHERE recipe_id = %s ORDER BY created, id;",
+                (recipe_id,),
+            )
+            squashed = squash(
+                fields, list(map(_builder(Modification, c), c.fetchall()))
+            )
+            if not squashed:
+                return 0
+            replaced_ids, mod = squashed
+            c.execute(
+                "DELETE FROM modifications WHERE recipe_id = %s AND id = ANY(%s) "
+                "AND id <> %s;",
+                (recipe_id, replaced_ids, mod.id),
+            )
+            removed = c.rowcount
+            c.execute(
+                "UPDATE modifications SET changed_fields = %s, meta = %s, "
+                "created = %s, delta = %s, snapshot = %s WHERE id = %s;",
+                (
+                    Json(mod.changed_fields),
+                    Json(mod.meta),
+                    mod.created,
+                    mod.delta,
+                    None if mod.snapshot is None else Json(mod.snapshot),
+                    mod.id,
+                ),
+            )
+            return removed
+    except psycopg2.errors.Error:
+        logger.exception("Error squashing modifications of recipe %s", recipe_id)
+        raise
+
+
+@metrics.timed("db_create_import_job")
+def create_import_job(job: ImportJob) -> ImportJob:
+    db = get_db()
+    with _tuple_cursor(db) as c:
         try:
             c.execute(
-                "UPDATE recipes SET "
-                "instructions = %(instructions)s, "
-                "name = %(name)s, "
-                "ingredients = %(ingredients)s, "
-                "updated = %(updated)s "
-                "WHERE id=%(id)s;",
+                "INSERT INTO import_jobs (user_id, url, user_agent, max_attempts, debug) "
+                "VALUES (%(user_id)s, %(url)s, %(user_agent)s, %(max_attempts)s, "
+                "%(debug)s) RETURNING *;",
                 {
-                    "ingredients": Json(recipe.ingredients),
-                    "name": recipe.name,
-                    "instructions": Json(recipe.instructions),
-                    "id": recipe.id,
-                    "updated": datetime.now(),
+                    "user_id": job.user_id,
+                    "url": job.url,
+                    "user_agent": job.user_agent,
+                    "max_attempts": job.max_attempts,
+                    "debug": job.debug,
                 },
             )
         except psycopg2.errors.Error:
-            logger.exception("Error updating recipe with ID %s in database", recipe.id)
+            logger.exception("Error creating import job for URL '%s'", job.url)
+            raise
+        return _builder(ImportJob, c)(c.fetchone())
+
+
+@metrics.timed("db_create_import_jobs")
+def create_import_jobs(jobs: list[ImportJob]) -> list[ImportJob]:
+    """Create many jobs with a single multi-row insert, returning them in
+    order."""
+    if not jobs:
+        return []
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            rows = execute_values(
+                c,
+                "INSERT INTO import_jobs "
+                "(user_id, url, user_agent, status, attempts, max_attempts, debug) "
+                "VALUES %s RETURNING *;",
+                [
+                    (
+                        job.user_id,
+                        job.url,
+                        job.user_agent,
+                        job.status,
+                        job.attempts,
+                        job.max_attempts,
+                        job.debug,
+                    )
+                    for job in jobs
+                ],
+                page_size=len(jobs),
+                fetch=True,
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error creating %s import jobs", len(jobs))
+            raise
+        return list(map(_builder(ImportJob, c), rows))
+
+
+@metrics.timed("db_get_import_job")
+def get_import_job(job_id: int, user_id: int) -> ImportJob:
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                "SELECT * FROM import_jobs WHERE id = %s AND user_id = %s;",
+                (job_id, user_id),
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error getting import job %s", job_id)
             raise
+        row = c.fetchone()
+        if not row:
+            raise NotFoundError(f"Import job with ID {job_id} not found")
+        return _builder(ImportJob, c)(row)
 
 
-def save_modification(mod: Modification):
+@metrics.timed("db_claim_import_job")
+def claim_import_job(stale_after: int) -> ImportJob | None:
+    """Mark the next due job as running and return it, or None if there are no
+    due jobs. Jobs locked by other workers are skipped, and running jobs not
+    updated for stale_after seconds are assumed abandoned and claimed again,
+    unless they have used up their attempts, in which case they are failed,
+    so a page that crashes or hangs workers isn't retried forever."""
+    db = get_db()
+    with _tuple_cursor(db) as c:
+        try:
+            c.execute(
+                "WITH expired AS ("
+                "UPDATE import_jobs SET status = 'failed', "
+                "msg = 'Import did not finish', updated = CURRENT_TIMESTAMP "
+                "WHERE status = 'running' AND attempts >= max_attempts "
+                "AND updated < CURRENT_TIMESTAMP - make_interval(secs => %(stale)s)"
+                ") UPDATE import_jobs SET status = 'running', "
+                "attempts = attempts + 1, updated = CURRENT_TIMESTAMP "
+                "WHERE id = ("
+                "SELECT id FROM import_jobs "
+                "WHERE (status = 'queued' AND run_after <= CURRENT_TIMESTAMP) "
+                "OR (status = 'running' AND attempts < max_attempts "
+                "AND updated < CURRENT_TIMESTAMP - make_interval(secs => %(stale)s)) "
+                "ORDER BY run_after, id "
+                "FOR UPDATE SKIP LOCKED LIMIT 1"
+                ") RETURNING *;",
+                {"stale": stale_after},
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error claiming import job")
+            raise
+        row = c.fetchone()
+        return _builder(ImportJob, c)(row) if row else None
+
+
+@metrics.timed("db_touch_import_jobs")
+def touch_import_jobs(job_ids: list[int]):
+    """Mark running jobs as still being worked on, so they aren't taken for
+    abandoned and claimed again."""
+    db = get_db()
+    with db.cursor() as c:
+        try:
+            c.execute(
+                "UPDATE import_jobs SET updated = CURRENT_TIMESTAMP "
+                "WHERE id = ANY(%s) AND status = 'running';",
+                (job_ids,),
+            )
+        except psycopg2.errors.Error:
+            logger.exception("Error touching %s import jobs", len(job_ids))
+            raise
+
+
+@metrics.timed("db_finish_import_job")
+def finish_import_job(job: ImportJob, retry_in: float = 0):
+    """Save the outcome of a job: done, failed, or queued again to be retried
+    in retry_in seconds."""
     db = get_db()
     with db.cursor() as c:
         try:
             c.execute(
-                """INSERT INTO modifications (recipe_id, changed_fields, meta) 
-                VALUES (%(recipe_id)s,  %(changed_fields)s,  %(meta)s);""",
+                "UPDATE import_jobs SET status = %(status)s, "
+                "recipe_id = %(recipe_id)s, error = %(error)s, msg = %(msg)s, "
+                "trace = %(trace)s, "
+                "run_after = CURRENT_TIMESTAMP + make_interval(secs => %(retry_in)s), "
+                "updated = CURRENT_TIMESTAMP "
+                "WHERE id = %(id)s;",
                 {
-                    "recipe_id": mod.recipe_id,
-                    "changed_fields": Json(mod.changed_fields),
-                    "meta": Json({}),
+                    "status": job.status,
+                    "recipe_id": job.recipe_id,
+                    "error": job.error,
+                    "msg": job.msg,
+                    "trace": job.trace,
+                    "retry_in": retry_in,
+                    "id": job.id,
                 },
             )
         except psycopg2.errors.Error:
-            logger.exception(
-                "Error saving modification to recipe with ID %s and changed fields %s",
-                mod.recipe_id,
-                mod.changed_fields,
-            )
+            logger.exception("Error updating import job %s", job.id)
             raise
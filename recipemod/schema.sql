@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS import_jobs;
+DROP TABLE IF EXISTS page_archive;
 DROP TABLE IF EXISTS recipes;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS modifications;
@@ -6,7 +8,8 @@ DROP TABLE IF EXISTS modifications;
 CREATE TABLE users (
     id SERIAL PRIMARY KEY,
     username text NOT NULL,
-    password text NOT NULL
+    password text NOT NULL,
+    session_version integer NOT NULL DEFAULT 0
 );
 
 CREATE TABLE recipes (
@@ -21,6 +24,7 @@ CREATE TABLE recipes (
     yield text,
     authors jsonb,
     ingredients jsonb,
+    parsed_ingredients jsonb,
     instructions jsonb,
     times jsonb,
     category jsonb,
@@ -28,15 +32,68 @@ CREATE TABLE recipes (
     keywords jsonb,
     ratings jsonb,
     video jsonb,
-    reviews jsonb
+    reviews jsonb,
+    page_hash text,
+    canonical_url text,
+    fingerprint bigint,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A')
+        || setweight(jsonb_to_tsvector('english', coalesce(keywords, '[]'), '["string"]'), 'B')
+        || setweight(jsonb_to_tsvector('english', coalesce(ingredients, '[]'), '["string"]'), 'C')
+        || setweight(to_tsvector('english', coalesce(description, '')), 'D')
+    ) STORED,
+    ingredients_vector tsvector GENERATED ALWAYS AS (
+        jsonb_to_tsvector('english', coalesce(ingredients, '[]'), '["string"]')
+    ) STORED
 );
 
+CREATE INDEX recipes_user_id_created_id_idx ON recipes(user_id, created DESC, id DESC);
+CREATE INDEX recipes_page_hash_idx ON recipes(page_hash);
+CREATE INDEX recipes_user_id_canonical_url_idx ON recipes(user_id, canonical_url);
+CREATE INDEX recipes_user_id_fingerprint_idx ON recipes(user_id, fingerprint);
+CREATE INDEX recipes_search_vector_idx ON recipes USING gin(search_vector);
+CREATE INDEX recipes_ingredients_vector_idx ON recipes USING gin(ingredients_vector);
+
 CREATE TABLE modifications (
     id SERIAL PRIMARY KEY,
     recipe_id integer REFERENCES recipes(id) ON DELETE CASCADE ON UPDATE CASCADE,
     changed_fields jsonb,
     meta jsonb,
-    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    delta boolean NOT NULL DEFAULT false,
+    snapshot jsonb
+);
+
+CREATE INDEX modifications_recipe_id_created_idx ON modifications(recipe_id, created);
+
+CREATE TABLE import_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id integer REFERENCES users(id) ON DELETE CASCADE,
+    url text NOT NULL,
+    user_agent text,
+    status text NOT NULL DEFAULT 'queued',
+    attempts integer NOT NULL DEFAULT 0,
+    max_attempts integer NOT NULL DEFAULT 3,
+    run_after timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    recipe_id integer REFERENCES recipes(id) ON DELETE SET NULL,
+    error text,
+    msg text,
+    debug boolean NOT NULL DEFAULT false,
+    trace text,
+    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX import_jobs_queued_idx ON import_jobs(run_after) WHERE status = 'queued';
+CREATE INDEX import_jobs_running_idx ON import_jobs(updated) WHERE status = 'running';
+
+CREATE TABLE page_archive (
+    sha256 text PRIMARY KEY,
+    compression text NOT NULL,
+    size integer NOT NULL,
+    content bytea NOT NULL,
+    created timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_used timestamp without time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX modifications_recipe_id_idx ON modifications(recipe_id int4_ops);
\ No newline at end of file
+ALTER TABLE page_archive ALTER COLUMN content SET STORAGE EXTERNAL;
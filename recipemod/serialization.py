@@ -0,0 +1,93 @@
+"""JSON encoding of API responses and decoding of jsonb columns.
+
+Responses are encoded with orjson when it's installed, straight to bytes, and
+with the standard library otherwise. Either way dataclasses are turned into
+shallow dicts with their to_json() method instead of being deep-copied by
+dataclasses.asdict, and the output matches Flask's default provider: sorted
+keys, and dates in HTTP date format.
+"""
+import dataclasses
+from datetime import date
+import decimal
+import uuid
+
+from flask.json.provider import DefaultJSONProvider
+import psycopg2.extras
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(o):
+    if isinstance(o, date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if dataclasses.is_dataclass(o):
+        if hasattr(o, "to_json"):
+            return o.to_json()
+        return {field.name: getattr(o, field.name) for field in dataclasses.fields(o)}
+    if hasattr(o, "__html__"):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    ORJSON_OPTIONS = (
+        orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_NON_STR_KEYS
+    )
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider using orjson where available."""
+
+    default = staticmethod(default)
+
+    def _orjson_options(self, indent: bool = False) -> int:
+        options = ORJSON_OPTIONS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(
+            obj, default=self.default, option=self._orjson_options()
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        data = orjson.dumps(
+            obj,
+            default=self.default,
+            option=self._orjson_options(indent) | orjson.OPT_APPEND_NEWLINE,
+        )
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+
+def register_json_typecasters():
+    """Decode json and jsonb columns with orjson, if it's installed."""
+    if orjson is not None:
+        psycopg2.extras.register_default_json(loads=orjson.loads, globally=True)
+        psycopg2.extras.register_default_jsonb(loads=orjson.loads, globally=True)
+
+
+def init_app(app):
+    app.json = JSONProvider(app)
+    register_json_typecasters()
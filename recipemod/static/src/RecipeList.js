@@ -6,80 +6,113 @@ import SearchBox from "./components/SearchBox.js";
 import RecipeCardColumns from "./components/RecipeCardColumns.js";
 import { states } from "./constants.js";
 
+const importPollInterval = 1000;
+
+function filterRecipes(recipes, nameFilterText, siteFilterText) {
+  return recipes.filter(
+    (recipe) =>
+      (!nameFilterText ||
+        recipe.name.toLowerCase().search(nameFilterText.toLowerCase()) > -1) &&
+      (!siteFilterText ||
+        new URL(recipe.url).host.search(siteFilterText.toLowerCase()) > -1)
+  );
+}
+
 function RecipeList() {
   const [recipes, setRecipes] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
   const [submitStatus, setSubmitStatus] = useState(states.INIT);
   const [submitErrorMessage, setSubmitErrorMessage] = useState("");
-  const [filteredRecipes, setFilteredRecipes] = useState([]);
 
   const [addRecipeUrlText, setAddRecipeURLText] = useState("");
   const [nameFilterText, setNameFilterText] = useState("");
   const [siteFilterText, setSiteFilterText] = useState("");
 
+  // Load one page at a time, the first straight away and the rest when asked
+  // for, so a visit doesn't download every recipe
+  function loadPage(cursor) {
+    const params = cursor ? { cursor: cursor } : {};
+    return axios.get("/api/recipes", { params: params }).then((resp) => {
+      // Append to the list as it is now, which may already have recipes
+      // imported while the page was loading
+      setRecipes((prev) =>
+        prev.concat(
+          resp.data.recipes.filter(
+            (recipe) => !prev.some((other) => other.id == recipe.id)
+          )
+        )
+      );
+      setNextCursor(resp.data.next);
+    });
+  }
+
   useEffect(() => {
     setIsLoading(true);
-    axios.get("/api/recipes").then((resp) => {
-      setRecipes(resp.data.recipes);
-      setFilteredRecipes(resp.data.recipes);
-      setIsLoading(false);
-    });
+    loadPage(null).then(() => setIsLoading(false));
   }, []);
-  // should it pass in the recipes array instead?
+
+  function handleLoadMore() {
+    setIsLoadingMore(true);
+    loadPage(nextCursor).finally(() => setIsLoadingMore(false));
+  }
+
   function handleNameFilterChange(event) {
-    const filterText = event.target.value;
-    setNameFilterText(filterText);
-
-    if (filterText) {
-      setFilteredRecipes(
-        recipes.filter(
-          (recipe) =>
-            recipe.name.toLowerCase().search(filterText.toLowerCase()) > -1
-        )
-      );
-    } else {
-      setFilteredRecipes(recipes);
-    }
+    setNameFilterText(event.target.value);
   }
 
   function handleSiteFilterChange(event) {
-    const filterText = event.target.value;
-    setSiteFilterText(filterText);
-    if (filterText) {
-      setFilteredRecipes(
-        recipes.filter(
-          (recipe) =>
-            new URL(recipe.url).host.search(filterText.toLowerCase()) > -1
-        )
-      );
-    } else {
-      setFilteredRecipes(recipes);
-    }
+    setSiteFilterText(event.target.value);
   }
 
   function handleAddURLChange(event) {
     setAddRecipeURLText(event.target.value);
   }
 
+  function handleImportFailed(errorType) {
+    setSubmitStatus(states.ERROR);
+    const errorMessage = errorMessages[errorType];
+    if (errorMessage) {
+      setSubmitErrorMessage(errorMessage);
+    }
+  }
+
+  function pollImportJob(jobId) {
+    axios
+      .get(`/api/imports/${jobId}`)
+      .then((resp) => {
+        const data = resp.data;
+        if (data.job.status == "done") {
+          // Update the list as it is now, not as it was when polling
+          // started. Importing a recipe already saved returns the existing one
+          setRecipes((prev) =>
+            [data.recipe].concat(
+              prev.filter((recipe) => recipe.id != data.recipe.id)
+            )
+          );
+          setSubmitStatus(states.COMPLETE);
+        } else if (data.job.status == "failed") {
+          handleImportFailed(data.job.error);
+        } else {
+          window.setTimeout(() => pollImportJob(jobId), importPollInterval);
+        }
+      })
+      .catch((err) => {
+        handleImportFailed(err.response.data.error);
+      });
+  }
+
   function handleSubmitRecipe(event) {
     let url = addRecipeUrlText;
     setSubmitStatus(states.LOADING);
     axios
       .post("/api/recipes/add", { url: url })
       .then((resp) => {
-        const data = resp.data;
-        const newRecipes = [data.recipe].concat(recipes);
-        setRecipes(newRecipes);
-        setFilteredRecipes(newRecipes);
-        setSubmitStatus(states.COMPLETE);
+        pollImportJob(resp.data.job.id);
       })
       .catch((err) => {
-        setSubmitStatus(states.ERROR);
-        const errorType = err.response.data.error;
-        const errorMessage = errorMessages[errorType];
-        if (errorMessage) {
-          setSubmitErrorMessage(errorMessage);
-        }
+        handleImportFailed(err.response.data.error);
       });
     event.preventDefault();
   }
@@ -87,7 +120,6 @@ function RecipeList() {
   function handleFilterReset() {
     setSiteFilterText("");
     setNameFilterText("");
-    setFilteredRecipes(recipes);
   }
 
   if (isLoading) {
@@ -135,7 +167,21 @@ function RecipeList() {
         handleSiteFilterChange={handleSiteFilterChange}
         handleFilterReset={handleFilterReset}
       />
-      <RecipeCardColumns recipes={filteredRecipes} />
+      <RecipeCardColumns
+        recipes={filterRecipes(recipes, nameFilterText, siteFilterText)}
+      />
+      {nextCursor ? (
+        <div className="text-center mb-3">
+          <button
+            className="btn btn-outline-danger"
+            id="loadMore"
+            onClick={handleLoadMore}
+            disabled={isLoadingMore}
+          >
+            {isLoadingMore ? "Loading..." : "Load more"}
+          </button>
+        </div>
+      ) : null}
     </div>
   );
 }
@@ -0,0 +1,227 @@
+"""Benchmark the recipe parsers over the saved pages in tests/recipe_htmls.
+
+For each page this times parse_recipe_html and whichever of LDJSONParser and
+MicrodataParser apply to it, and reports p50/p95 latency, memory allocated
+while parsing (tracemalloc) and the peak RSS of a process parsing only that
+page. Outputs are checked against tests/target_jsons.
+
+Times depend on the machine and on whatever else it is doing, so each page is
+also timed against a fixed calibration workload, run alternately with it in the
+same process, and the baseline compares the median ratio of the two (p50_rel)
+rather than milliseconds.
+
+Results are compared with tests/benchmark_baseline.json, and the run fails if
+a page got slower or uses more memory than the tolerance allows, or a field
+that matched its target no longer does.
+
+    python tests/benchmark.py                # compare with the baseline
+    python tests/benchmark.py --save         # record a new baseline
+    python tests/benchmark.py --runs 50 --tolerance 1.25
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from recipemod import parsing  # noqa: E402
+from conftest import (  # noqa: E402
+    BASELINE_PATH,
+    html_names,
+    load_baseline,
+    load_html,
+    load_target,
+    mismatched_fields,
+    recipe_fields,
+)
+
+
+def parse_ldjson(html):
+    soup = BeautifulSoup(html, "lxml", parse_only=parsing.ldjson_strainer)
+    tags = soup.find_all("script", type="application/ld+json")
+    return parsing.LDJSONParser(tags).get_recipe()
+
+
+def parse_microdata(html):
+    soup = BeautifulSoup(html, "lxml")
+    tag = soup.find(itemtype=re.compile("https?://schema.org/Recipe"))
+    return parsing.MicrodataParser(tag).get_recipe()
+
+
+def parsers_for(html) -> dict:
+    parsers = {"parse_recipe_html": parsing.parse_recipe_html}
+    if "application/ld+json" in html and quiet(parse_ldjson, html):
+        parsers["LDJSONParser"] = parse_ldjson
+    if re.search("itemtype=[\"']?https?://schema.org/Recipe", html):
+        parsers["MicrodataParser"] = parse_microdata
+    return parsers
+
+
+def quiet(func, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+def percentile(timings: list[float], fraction: float) -> float:
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, round(fraction * (len(timings) - 1)))]
+
+
+# Markup of about the size and shape of a recipe page, without a recipe in it
+CALIBRATION_HTML = "<html><body>%s</body></html>" % "".join(
+    f'<div class="step" id="s{i}"><p>Step {i}: stir <b>{i}</b> g</p>'
+    f'<a href="/r/{i}">next</a></div>'
+    for i in range(200)
+)
+
+
+def calibrate(html: str = CALIBRATION_HTML):
+    BeautifulSoup(html, "lxml").find_all("p")
+
+
+def time_ms(func, html: str) -> float:
+    start = time.perf_counter()
+    quiet(func, html)
+    return (time.perf_counter() - start) * 1000
+
+
+def measure(func, html: str, runs: int) -> dict:
+    quiet(func, html)  # warm up
+    calibrate()
+    # Each run is timed right after the calibration workload, so that both
+    # see the machine under the same load
+    timings, ratios, calibrations = [], [], []
+    for _ in range(runs):
+        calibrations.append(time_ms(calibrate, CALIBRATION_HTML))
+        timings.append(time_ms(func, html))
+        ratios.append(timings[-1] / calibrations[-1])
+
+    tracemalloc.start()
+    quiet(func, html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": round(statistics.median(timings), 2),
+        "p95_ms": round(percentile(timings, 0.95), 2),
+        "p50_rel": round(statistics.median(ratios), 3),
+        "calibration_ms": round(statistics.median(calibrations), 2),
+        "alloc_peak_kb": round(peak / 1024),
+    }
+
+
+def peak_rss_kb(html: str) -> int:
+    """Peak RSS of a fresh process that parses only this page."""
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(_parse_and_report_rss, (html,))
+
+
+def _parse_and_report_rss(html: str) -> int:
+    quiet(parsing.parse_recipe_html, html)
+    # ru_maxrss survives exec on Linux, so it would include the parent's peak
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_page(html_name: str, runs: int) -> dict:
+    html = load_html(html_name)
+    result = {
+        name: measure(func, html, runs) for name, func in parsers_for(html).items()
+    }
+    result["peak_rss_kb"] = peak_rss_kb(html)
+    recipe = recipe_fields(quiet(parsing.parse_recipe_html, html))
+    result["mismatches"] = mismatched_fields(recipe, load_target(html_name))
+    return result
+
+
+def regressions(html_name: str, result: dict, baseline: dict, tolerance: float):
+    found = []
+    for parser, stats in result.items():
+        if not isinstance(stats, dict) or parser not in baseline:
+            continue
+        for metric in ("p50_rel", "alloc_peak_kb"):
+            if metric not in baseline[parser]:
+                continue
+            limit = baseline[parser][metric] * tolerance
+            if stats[metric] > limit:
+                found.append(
+                    f"{html_name}: {parser} {metric} {stats[metric]} "
+                    f"> {limit:.2f} (baseline {baseline[parser][metric]})"
+                )
+    rss_limit = baseline.get("peak_rss_kb", float("inf")) * tolerance
+    if result["peak_rss_kb"] > rss_limit:
+        found.append(
+            f"{html_name}: peak RSS {result['peak_rss_kb']} KB > {rss_limit:.0f} KB"
+        )
+    new_mismatches = set(result["mismatches"]) - set(baseline.get("mismatches", []))
+    if new_mismatches:
+        found.append(f"{html_name}: no longer matches target {sorted(new_mismatches)}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20, help="timed runs per parser")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.5,
+        help="fail if a metric exceeds its baseline by this factor",
+    )
+    parser.add_argument("--save", action="store_true", help="save as new baseline")
+    args = parser.parse_args()
+
+    baseline = load_baseline()
+    results = {}
+    found = []
+    print(
+        f"{'page':<45} {'parser':<18} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p50 rel':>8} {'alloc KB':>9}"
+    )
+    for html_name in html_names():
+        result = benchmark_page(html_name, args.runs)
+        results[html_name] = result
+        for name, stats in result.items():
+            if isinstance(stats, dict):
+                print(
+                    f"{html_name[:45]:<45} {name:<18} {stats['p50_ms']:>8} "
+                    f"{stats['p95_ms']:>8} {stats['p50_rel']:>8} "
+                    f"{stats['alloc_peak_kb']:>9}"
+                )
+        print(
+            f"{'':<45} {'peak RSS KB':<18} {result['peak_rss_kb']:>8}"
+            f"  mismatches: {', '.join(result['mismatches']) or 'none'}"
+        )
+        if html_name in baseline:
+            found += regressions(html_name, result, baseline[html_name], args.tolerance)
+
+    if args.save:
+        with open(BASELINE_PATH, "w", encoding="utf8") as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+        print(f"Saved baseline to {BASELINE_PATH}")
+    elif found:
+        print("\nRegressions:")
+        print("\n".join(found))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
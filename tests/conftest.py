@@ -0,0 +1,86 @@
+import json
+import os
+
+import pytest
+
+from recipemod import parsing
+
+TESTS_DIR = os.path.dirname(__file__)
+HTML_DIR = os.path.join(TESTS_DIR, "recipe_htmls")
+TARGET_DIR = os.path.join(TESTS_DIR, "target_jsons")
+BASELINE_PATH = os.path.join(TESTS_DIR, "benchmark_baseline.json")
+
+# Fields the saved target JSONs have, i.e. everything the parser extracts
+TARGET_FIELDS = [
+    "url",
+    "name",
+    "description",
+    "yield",
+    "image_url",
+    "instructions",
+    "ingredients",
+    "times",
+    "categories",
+    "keywords",
+    "authors",
+]
+
+
+def html_names() -> list[str]:
+    return sorted(name for name in os.listdir(HTML_DIR) if name.endswith(".html"))
+
+
+def target_path(html_name: str) -> str:
+    """Saved pages have a target JSON named after the page title, in dirty/ if
+    the target itself hasn't been checked by hand."""
+    filename = html_name.removesuffix(".html").lower().replace(" ", "_") + ".json"
+    path = os.path.join(TARGET_DIR, filename)
+    if not os.path.exists(path):
+        path = os.path.join(TARGET_DIR, "dirty", filename)
+    return path
+
+
+def load_html(html_name: str) -> str:
+    with open(os.path.join(HTML_DIR, html_name), encoding="utf8") as infile:
+        return infile.read()
+
+
+def load_target(html_name: str) -> dict:
+    with open(target_path(html_name), encoding="utf8") as infile:
+        return json.load(infile)
+
+
+def recipe_fields(recipe) -> dict:
+    return recipe.to_json(TARGET_FIELDS)
+
+
+def mismatched_fields(recipe: dict, target: dict) -> list[str]:
+    """Fields that differ from the target, ignoring url, which the API fills
+    in with the page URL when the page doesn't give one."""
+    return sorted(
+        field
+        for field in target
+        if field != "url" and recipe.get(field) != target[field]
+    )
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, encoding="utf8") as infile:
+        return json.load(infile)
+
+
+@pytest.fixture(params=html_names())
+def html_name(request):
+    return request.param
+
+
+@pytest.fixture
+def recipe(html_name):
+    return recipe_fields(parsing.parse_recipe_html(load_html(html_name)))
+
+
+@pytest.fixture
+def target(html_name):
+    return load_target(html_name)
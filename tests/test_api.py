@@ -0,0 +1,90 @@
+from datetime import datetime
+
+from flask import Flask, g
+import pytest
+
+from recipemod import api
+from recipemod.models import Recipe
+
+RECIPES = [
+    Recipe(
+        id=id_,
+        name=f"Recipe {id_}",
+        created=datetime(2024, 1, id_),
+        updated=datetime(2024, 2, id_),
+    )
+    for id_ in [3, 2, 1]
+]
+
+
+def test_cursor_round_trip():
+    recipe = Recipe(id=12, created=datetime(2024, 1, 2, 3, 4, 5, 678))
+    assert api.decode_cursor(api.encode_cursor(recipe)) == (recipe.created, 12)
+
+
+def test_search_cursor_round_trip():
+    rank = 0.1 + 0.2
+    cursor = api.encode_search_cursor(rank, Recipe(id=12))
+    assert api.decode_search_cursor(cursor) == (rank, 12)
+
+
+def test_page_etag():
+    etag = api.page_etag(["name"], RECIPES)
+    assert etag == api.page_etag(["name"], list(RECIPES))
+    assert etag != api.page_etag(["name", "url"], RECIPES)
+    assert etag != api.page_etag(["name"], RECIPES[:2])
+    edited = [Recipe(id=3, created=RECIPES[0].created, updated=datetime(2024, 3, 1))]
+    assert etag != api.page_etag(["name"], edited + RECIPES[1:])
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    """The fields each get_recipes_by_user call asks for."""
+    calls = []
+
+    def get_recipes_by_user(user_id, limit=None, after=None, fields=None):
+        calls.append(fields)
+        return RECIPES[:limit]
+
+    monkeypatch.setattr(api.repository, "get_recipes_by_user", get_recipes_by_user)
+    return calls
+
+
+def get_recipes(path, headers=None):
+    app = Flask(__name__)
+    with app.test_request_context(path, headers=headers):
+        g.user = {"id": 1}
+        # Past login_required, which checks the session in the database
+        return api.recipes.__wrapped__()
+
+
+def test_recipes_reads_page_once(queries):
+    response = get_recipes("/api/recipes?limit=2&fields=name")
+    assert queries == [["name", "updated"]]
+    assert response.status_code == 200
+    assert response.json["recipes"] == [{"name": "Recipe 3"}, {"name": "Recipe 2"}]
+    assert api.decode_cursor(response.json["next"]) == (RECIPES[1].created, 2)
+    assert response.get_etag()[0] == api.page_etag(["name"], RECIPES)
+
+
+def test_recipes_not_modified(queries):
+    etag = api.page_etag(["name"], RECIPES)
+    response = get_recipes(
+        "/api/recipes?limit=2&fields=name", {"If-None-Match": f'"{etag}"'}
+    )
+    assert response.status_code == 304
+    assert queries == [["updated"]]
+
+
+def test_recipes_stale_etag(queries):
+    response = get_recipes(
+        "/api/recipes?limit=2&fields=name", {"If-None-Match": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert queries == [["updated"], ["name", "updated"]]
+
+
+def test_recipes_invalid_cursor(queries):
+    response, status = get_recipes("/api/recipes?cursor=nonsense")
+    assert status == 400
+    assert queries == []
@@ -0,0 +1,24 @@
+import pytest
+
+from recipemod import archive
+
+
+def test_file_archive_round_trip(tmp_path):
+    page_archive = archive.FileArchive(str(tmp_path))
+    text = "<html><body>Crème brûlée</body></html>" * 1000
+    key = page_archive.put(text)
+    assert page_archive.read(key) == text
+    with page_archive.open(key) as page:
+        assert page.read(6) == b"<html>"
+
+
+def test_file_archive_deduplicates(tmp_path):
+    page_archive = archive.FileArchive(str(tmp_path))
+    assert page_archive.put("same page") == page_archive.put("same page")
+    assert len([path for path in tmp_path.rglob("*") if path.is_file()]) == 1
+
+
+def test_missing_page(tmp_path):
+    with pytest.raises(KeyError):
+        archive.FileArchive(str(tmp_path)).open("0" * 64)
+    assert archive.NullArchive().put("page") is None
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from recipemod import cache
+from recipemod.models import Recipe
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def parse_cache(request, tmp_path):
+    if request.param == "memory":
+        return cache.LRUCache(max_size=2, ttl=60)
+    return cache.SQLiteCache(str(tmp_path / "cache.sqlite3"), max_size=2, ttl=60)
+
+
+def test_normalize_url():
+    assert (
+        cache.normalize_url("HTTPS://Example.com/recipe?b=2&a=1#comments")
+        == "https://example.com/recipe?a=1&b=2"
+    )
+
+
+def test_make_key_prefers_validators():
+    url = "https://example.com/recipe"
+    assert cache.make_key(url, {"ETag": '"abc"'}, b"one") == cache.make_key(
+        url, {"ETag": '"abc"'}, b"two"
+    )
+    assert cache.make_key(url, {}, b"one") != cache.make_key(url, {}, b"two")
+
+
+def test_get_returns_copy(parse_cache):
+    parse_cache.set("key", Recipe(name="Toast", ingredients=["bread"]))
+    recipe = parse_cache.get("key")
+    recipe.user_id = 1
+    recipe.ingredients.append("butter")
+    assert parse_cache.get("key") == Recipe(name="Toast", ingredients=["bread"])
+    assert parse_cache.get("missing") is None
+    stats = parse_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 1, 1)
+
+
+def test_evicts_least_recently_used(parse_cache):
+    for key in ("a", "b"):
+        parse_cache.set(key, Recipe(name=key))
+        time.sleep(0.01)
+    parse_cache.get("a")
+    time.sleep(0.01)
+    parse_cache.set("c", Recipe(name="c"))
+    assert parse_cache.get("b") is None
+    assert parse_cache.get("a").name == "a"
+    assert parse_cache.get("c").name == "c"
+
+
+def test_expired_entries_are_misses(parse_cache):
+    parse_cache.ttl = 0
+    parse_cache.set("key", Recipe(name="Toast"))
+    time.sleep(0.01)
+    assert parse_cache.get("key") is None
@@ -0,0 +1,67 @@
+import pytest
+
+from recipemod import dedupe
+
+INGREDIENTS = [
+    "2 cups plain flour",
+    "1 tsp baking soda",
+    "1/2 tsp salt",
+    "1 cup butter, softened",
+    "3/4 cup white sugar",
+    "2 large eggs",
+    "2 cups chocolate chips",
+]
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "https://example.com/recipes/cookies",
+        "http://www.example.com/recipes/cookies/",
+        "https://example.com:443/recipes/cookies?utm_source=x&fbclid=y#comments",
+        "https://amp.example.com/recipes/cookies/amp/",
+        "https://m.Example.com/amp/recipes/cookies",
+    ],
+)
+def test_canonical_url(url):
+    assert dedupe.canonical_url(url) == "https://example.com/recipes/cookies"
+
+
+def test_canonical_url_keeps_other_params():
+    assert (
+        dedupe.canonical_url("https://example.com/r?b=2&utm_medium=x&a=1")
+        == "https://example.com/r?a=1&b=2"
+    )
+
+
+def test_fingerprint_close_for_small_edits():
+    original = dedupe.fingerprint("Chocolate Chip Cookies", INGREDIENTS)
+    edited = dedupe.fingerprint(
+        "Chocolate chip cookies!", INGREDIENTS[:-1] + ["2 cups chocolate chips."]
+    )
+    other = dedupe.fingerprint(
+        "Tomato Soup", ["1 onion", "2 cans chopped tomatoes", "500ml vegetable stock"]
+    )
+    assert -(2**63) <= original < 2**63
+    assert dedupe.distance(original, edited) <= dedupe.FINGERPRINT_DISTANCE
+    assert dedupe.distance(original, other) > dedupe.FINGERPRINT_DISTANCE
+    assert dedupe.fingerprint("Toast", ["bread"]) is None
+
+
+def test_duplicate_groups():
+    cookies = dedupe.fingerprint("Chocolate Chip Cookies", INGREDIENTS)
+    soup = dedupe.fingerprint(
+        "Tomato Soup", ["1 onion", "2 cans chopped tomatoes", "500ml vegetable stock"]
+    )
+    rows = [
+        (1, "https://a.com/cookies", cookies),
+        (2, "https://a.com/soup", soup),
+        (3, "https://b.com/cookies", cookies ^ 1),
+        (4, "https://a.com/soup", None),
+        (5, "https://c.com/bread", None),
+    ]
+    assert dedupe.duplicate_groups(rows) == [[1, 3], [2, 4]]
+    index = dedupe.DuplicateIndex(rows)
+    assert index.find("https://a.com/soup", cookies) == 2
+    assert index.find("https://d.com/cookies", cookies ^ 2) == 1
+    assert index.find("https://d.com/cake", None) is None
@@ -0,0 +1,122 @@
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import pytest
+
+from recipemod import fetcher
+
+PAGE = "<html><body>Crème brûlée</body></html>".encode("utf8")
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/big":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.end_headers()
+            self.wfile.write(b"x" * 2048)
+            return
+        if self.path == "/slow":
+            self.send_response(200)
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            try:
+                for _ in range(100):
+                    self.wfile.write(b"x")
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except OSError:
+                pass
+            return
+        if self.path == "/gzip":
+            body = gzip.compress(PAGE * 1000)
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def test_fetch_revalidates_known_page(server):
+    page = fetcher.fetch(server + "/recipe")
+    assert page and not page.revalidated
+    assert page.text == PAGE.decode("utf8")
+
+    page = fetcher.fetch(server + "/recipe")
+    assert page.revalidated
+    assert page.status_code == 200
+    assert page.text == PAGE.decode("utf8")
+
+
+def test_fetch_enforces_size_limit(server, monkeypatch):
+    monkeypatch.setitem(fetcher.DEFAULTS, "FETCH_MAX_BYTES", 1024)
+    with pytest.raises(fetcher.FetchError):
+        fetcher.fetch(server + "/big")
+
+
+def test_fetch_enforces_total_timeout_on_slow_body(server, monkeypatch):
+    monkeypatch.setitem(fetcher.DEFAULTS, "FETCH_TOTAL_TIMEOUT", 0.5)
+    start = time.monotonic()
+    with pytest.raises(fetcher.FetchError):
+        fetcher.fetch(server + "/slow")
+    assert time.monotonic() - start < 1.5
+
+
+def test_fetch_decodes_compressed_body(server):
+    assert fetcher.fetch(server + "/gzip").content == PAGE * 1000
+
+
+def test_remembered_pages_bounded_by_bytes(monkeypatch):
+    monkeypatch.setitem(fetcher.DEFAULTS, "FETCH_REVALIDATE_BYTES", 250)
+    monkeypatch.setattr(fetcher, "_pages", fetcher.OrderedDict())
+    monkeypatch.setattr(fetcher, "_pages_bytes", 0)
+    for i in range(5):
+        page = fetcher.Page(f"http://x/{i}", 200, b"x" * 100, None, {"ETag": "1"})
+        fetcher._remember(f"x/{i}", page)
+    assert list(fetcher._pages) == ["x/3", "x/4"]
+    assert fetcher._pages_bytes == 200
+
+
+def test_fetch_connection_error():
+    with pytest.raises(fetcher.FetchError):
+        fetcher.fetch("http://127.0.0.1:9/recipe")
+
+
+@pytest.mark.parametrize(
+    "content_type, content, expected",
+    [
+        # requests would decode these as ISO-8859-1
+        ("text/html", PAGE, "utf-8"),
+        ("text/html; charset=ISO-8859-1", PAGE, "utf-8"),
+        ("text/html", '<meta charset="latin-1">Crème'.encode("latin-1"), "iso8859-1"),
+        ("text/html; charset=cp1252", "Crème".encode("cp1252"), "cp1252"),
+    ],
+)
+def test_choose_encoding(content_type, content, expected):
+    encoding = fetcher.choose_encoding("http://example.com", content_type, content)
+    assert encoding == expected
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+
+from recipemod import history, patches
+from recipemod.models import Modification, Recipe
+
+INGREDIENTS = ["2 cups flour", "1 tsp salt", "1 cup milk", "2 eggs"]
+
+
+@pytest.mark.parametrize(
+    "src, dst",
+    [
+        (INGREDIENTS, INGREDIENTS[:2] + ["1 cup oat milk"] + INGREDIENTS[3:]),
+        (INGREDIENTS, ["1/2 cup sugar"] + INGREDIENTS),
+        (INGREDIENTS, INGREDIENTS[:1] + INGREDIENTS[3:]),
+        ({"type": "steps", "steps": ["Mix", "Bake"]}, {"type": "steps", "steps": []}),
+        ({"a/b": 1, "c~d": [1]}, {"a/b": 2, "e": None}),
+        ("Toast", None),
+    ],
+)
+def test_patch_round_trip(src, dst):
+    assert patches.apply_patch(src, patches.make_patch(src, dst)) == dst
+
+
+def test_patch_stores_only_the_change():
+    dst = INGREDIENTS[:2] + ["1 cup oat milk"] + INGREDIENTS[3:]
+    assert patches.make_patch(INGREDIENTS, dst) == [
+        {"op": "replace", "path": "/2", "value": "1 cup oat milk"}
+    ]
+    assert patches.make_patch(INGREDIENTS, INGREDIENTS) == []
+    with pytest.raises(patches.PatchError):
+        patches.apply_patch(INGREDIENTS, [{"op": "remove", "path": "/9"}])
+
+
+def edit(versions: list[dict], mod_id: int, day: int, **changes) -> Modification:
+    old = Recipe(**versions[-1])
+    versions.append({**versions[-1], **changes})
+    mod = Modification.from_recipes(old, Recipe(**versions[-1]))
+    mod.id, mod.recipe_id, mod.created = mod_id, 1, datetime(2024, 1, day)
+    return mod
+
+
+def test_rebuild_and_squash():
+    versions = [{"name": "Pancakes", "ingredients": INGREDIENTS, "instructions": None}]
+    mods = [
+        edit(versions, 1, 1, name="Crepes"),
+        edit(versions, 2, 2, ingredients=INGREDIENTS + ["1 tbsp butter"]),
+        edit(versions, 3, 3, name="Pancakes"),
+        edit(versions, 4, 4, instructions={"type": "steps", "steps": ["Fry"]}),
+    ]
+    mods[1].snapshot = versions[1]
+    current = versions[-1]
+    for i in range(len(mods)):
+        assert history.rebuild(current, reversed(mods[i:])) == versions[i]
+
+    replaced, squashed = history.squash(current, mods, before=datetime(2024, 1, 4))
+    assert replaced == [1, 2, 3]
+    assert (squashed.id, squashed.snapshot) == (3, versions[0])
+    # The name was changed back, but is still recorded as edited
+    assert squashed.changed_fields["name"] == []
+    assert history.rebuild(current, [mods[3], squashed]) == versions[0]
+    assert history.squash(current, mods, before=datetime(2024, 1, 2)) is None
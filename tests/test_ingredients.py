@@ -0,0 +1,54 @@
+import pytest
+
+from recipemod import ingredients
+
+
+@pytest.mark.parametrize(
+    "line, quantity, quantity_max, unit, item, note",
+    [
+        ("1 1/2 cups plain flour, sifted", 1.5, None, "cup", "plain flour", "sifted"),
+        ("2-3 cloves garlic, minced", 2.0, 3.0, "clove", "garlic", "minced"),
+        ("½ tsp salt", 0.5, None, "teaspoon", "salt", None),
+        ("1 T butter", 1.0, None, "tablespoon", "butter", None),
+        ("200g caster sugar", 200.0, None, "gram", "caster sugar", None),
+        ("1 (14 oz) can tomatoes", 1.0, None, "can", "tomatoes", "14 oz"),
+        ("a pinch of salt", 1.0, None, "pinch", "salt", None),
+        ("two onions, chopped", 2.0, None, None, "onions", "chopped"),
+        ("Salt to taste", None, None, None, "Salt to taste", None),
+    ],
+)
+def test_parse_ingredient(line, quantity, quantity_max, unit, item, note):
+    assert ingredients.parse_ingredient(line) == {
+        "text": line,
+        "quantity": quantity,
+        "quantity_max": quantity_max,
+        "unit": unit,
+        "item": item,
+        "note": note,
+    }
+
+
+def test_parse_ingredient_cached_by_normalized_line():
+    ingredients.parse_ingredient("1  cup\tmilk")
+    hits = ingredients._parse_normalized.cache_info().hits
+    parsed = ingredients.parse_ingredient(" 1 cup milk")
+    assert ingredients._parse_normalized.cache_info().hits == hits + 1
+    assert parsed["text"] == " 1 cup milk"
+
+
+@pytest.mark.parametrize(
+    "recipe_yield, servings",
+    [("4", 4.0), ("Serves 4-6", 4.0), ('["6", "6 servings"]', 6.0), (None, None)],
+)
+def test_parse_yield(recipe_yield, servings):
+    assert ingredients.parse_yield(recipe_yield) == servings
+
+
+def test_scale_ingredients():
+    parsed = ingredients.parse_ingredients(["1/3 cup milk", "2-3 eggs", "Salt"])
+    scaled = ingredients.scale_ingredients(parsed, 1.5)
+    assert [(i["quantity"], i["quantity_max"]) for i in scaled] == [
+        (0.5, None),
+        (3.0, 4.5),
+        (None, None),
+    ]
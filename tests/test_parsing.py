@@ -4,12 +4,198 @@ import urllib
 import pytest
 import requests
 
-from recipemod import parsing    
+from recipemod import parsing
+
+from conftest import load_baseline, mismatched_fields
+
 
 def url_to_filepath(url):
-    url_split = urllib.parse.urlsplit(url) 
-    return url_split.netloc + url_split.path.replace('/', '_')
+    url_split = urllib.parse.urlsplit(url)
+    return url_split.netloc + url_split.path.replace("/", "_")
+
 
 def test_same_keys(recipe, target):
     assert recipe.keys() == target.keys()
-    
\ No newline at end of file
+
+
+LDJSON_HTML = """<html><head>
+<script type="application/ld+json">
+{"@context": "https://schema.org", "@type": "Recipe", "name": "Toast",
+ "recipeIngredient": ["1 slice bread"], "recipeInstructions": ["Toast the bread."]}
+</script>
+</head><body><h1>Toast</h1></body></html>"""
+
+MICRODATA_HTML = """<html><head>
+<script type="application/ld+json">{"@type": "WebSite", "name": "Example"}</script>
+</head><body>
+<div itemscope itemtype="https://schema.org/Recipe">
+  <h1 itemprop="name">Toast</h1>
+  <ul><li itemprop="recipeIngredient">1 slice bread</li></ul>
+  <ol><li itemprop="recipeInstructions">Toast the bread.</li></ol>
+</div>
+</body></html>"""
+
+
+def test_parse_ldjson_recipe():
+    recipe = parsing.parse_recipe_html(LDJSON_HTML)
+    assert recipe.name == "Toast"
+    assert recipe.ingredients == ["1 slice bread"]
+    assert recipe.instructions == {"type": "steps", "steps": ["Toast the bread."]}
+
+
+def test_parse_falls_back_to_microdata():
+    recipe = parsing.parse_recipe_html(MICRODATA_HTML)
+    assert recipe.name == "Toast"
+    assert recipe.ingredients == ["1 slice bread"]
+    assert recipe.instructions == {"type": "steps", "steps": ["Toast the bread."]}
+
+
+def test_parse_no_recipe():
+    with pytest.raises(parsing.ParseError):
+        parsing.parse_recipe_html("<html><body><p>Nothing here</p></body></html>")
+
+
+MULTI_RECIPE_HTML = """<html><head>
+<script type="application/ld+json">{"@type": "Recipe", "name": broken</script>
+<script type="application/ld+json">
+{"@context": "https://schema.org", "@graph": [
+  {"@type": "BreadcrumbList", "itemListElement": [{"@type": "ListItem"}]},
+  {"@type": "Recipe", "name": "Toast"},
+  {"@type": "WebPage", "mainEntity": {"@type": ["Recipe"], "name": "Jam"}}
+]}
+</script>
+</head><body></body></html>"""
+
+
+def test_parse_multi_recipe_page():
+    recipes = parsing.parse_recipes_html(MULTI_RECIPE_HTML)
+    assert [recipe.name for recipe in recipes] == ["Toast", "Jam"]
+    assert parsing.parse_recipe_html(MULTI_RECIPE_HTML).name == "Toast"
+
+
+def test_trace_records_parse_decisions():
+    html = (
+        '<script type="application/ld+json">{"@type": "WebPage"}</script>'
+        "<p>Nothing here</p>"
+    )
+    with parsing.trace() as lines, pytest.raises(parsing.ParseError):
+        parsing.parse_recipe_html(html)
+    assert lines == [
+        "Found 1 LD+JSON script tags",
+        "Found LD+JSON node of type WebPage",
+        "No LD+JSON recipe found, looking for Microdata",
+        "No recipe microdata element found",
+    ]
+    # Nothing is captured once the block has exited
+    recipe = '<script type="application/ld+json">{"@type": "Recipe", "name": "x"}'
+    parsing.parse_recipe_html(recipe + "</script>")
+    assert len(lines) == 4
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "Plain text",
+        "Salt &amp; pepper",
+        "<p>Preheat the oven<br/>to 180C</p>",
+        "Line one\r\nline two",
+        "<script>var x = 1;</script>Stir",
+        "5 &lt; 6 and a < b",
+        "Unterminated <b",
+        '<a title="a>b">x</a>',
+        "<img alt='1 > 2'/>Stir",
+        '<a b=c"d>e</a>',
+        'Unterminated <a title="x>y',
+    ],
+)
+def test_clean_text_matches_beautifulsoup(text):
+    expected = parsing.fix_text(parsing.BeautifulSoup(text, "lxml").text.strip())
+    assert parsing.clean_text(text) == expected
+
+
+@pytest.mark.parametrize("fix_encoding", [True, False])
+def test_clean_texts_matches_clean_text(fix_encoding):
+    texts = [
+        "caf&Atilde;&copy;",
+        "Salt &amp; pepper",
+        "Plain",
+        "5 &lt; 6, it&rsquo;s &eacute;",
+        "Line one\nCafÃ©",
+        "",
+        "Line\u2028break",
+        "itâ€™s",
+    ]
+    token = parsing._fix_encoding.set(fix_encoding)
+    try:
+        for remove_newlines in [False, True]:
+            assert parsing.clean_texts(texts, remove_newlines) == [
+                parsing.clean_text(text, remove_newlines) for text in texts
+            ]
+            # Without the text that adds a line break, all in one batch
+            assert parsing.clean_texts(texts[:6], remove_newlines) == [
+                parsing.clean_text(text, remove_newlines) for text in texts[:6]
+            ]
+    finally:
+        parsing._fix_encoding.reset(token)
+
+
+def test_microdata_props_skip_nested_items():
+    html = """<div itemscope itemtype="https://schema.org/Recipe">
+    <span itemprop="name">Toast</span>
+    <div itemprop="author" itemscope itemtype="https://schema.org/Person">
+      <span itemprop="name">Jane</span>
+    </div>
+    </div>"""
+    tag = parsing.BeautifulSoup(html, "lxml").find(itemtype=True)
+    parser = parsing.MicrodataParser(tag)
+    assert parser.extract_text_props("name") == ["Toast"]
+    assert [tag.name for tag in parser.find_props("author")] == ["div"]
+
+
+def test_microdata_props_deeply_nested():
+    html = (
+        '<div itemscope itemtype="https://schema.org/Recipe">'
+        + "<div>" * 2000
+        + '<span itemprop="name">Toast</span>'
+        + "</div>" * 2000
+        + "</div>"
+    )
+    tag = parsing.BeautifulSoup(html, "lxml").find(itemtype=True)
+    parser = parsing.MicrodataParser(tag)
+    assert parser.extract_text_props("name", single_result=True) == "Toast"
+
+
+def test_matches_target(html_name, recipe, target):
+    """Fields that match the saved target must keep matching. Known
+    differences are recorded in the benchmark baseline."""
+    known = load_baseline().get(html_name, {}).get("mismatches", [])
+    assert set(mismatched_fields(recipe, target)) <= set(known)
+
+
+def test_mojibake_repaired_only_where_found():
+    html = (
+        '<script type="application/ld+json">{"@type": "Recipe",'
+        ' "name": "Caf\\u00c3\\u00a9", "description": "It’s ﬁne",'
+        ' "recipeIngredient": ["1 cup caf&Atilde;&copy;"]}</script>'
+    )
+    recipe = parsing.parse_recipe_html(html)
+    assert recipe.name == "Café"
+    assert recipe.ingredients == ["1 cup café"]
+    assert recipe.description == "It's fine"
+    assert not parsing.has_mojibake("Crème brûlée, it’s “fine”")
+
+
+@pytest.mark.parametrize(
+    "head, url",
+    [
+        (
+            '<link rel="canonical" href="https://example.com/toast">',
+            "https://example.com/toast",
+        ),
+        ("<LINK HREF='/toast?a=1&amp;b=2' REL='canonical'>", "/toast?a=1&b=2"),
+        ('<link rel="alternate" href="https://example.com/amp">', None),
+    ],
+)
+def test_canonical_link(head, url):
+    recipe = parsing.parse_recipe_html(LDJSON_HTML.replace("<head>", "<head>" + head))
+    assert recipe.canonical_url == url
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from recipemod import dedupe, reparse
+from recipemod.models import Recipe
+
+
+def test_changed_fields():
+    old = Recipe(id=1, name="Stew", ingredients=["beef"], yield_="4", keywords=["a"])
+    new = Recipe(name="Beef stew", ingredients=["beef", "salt"], yield_=4, keywords=[])
+    assert reparse.changed_fields(old, new, set()) == {
+        "name": "Beef stew",
+        "ingredients": ["beef", "salt"],
+    }
+
+
+def test_changed_fields_skips_modified():
+    old = Recipe(id=1, name="My stew", ingredients=["beef"], yield_="2")
+    new = Recipe(name="Stew", ingredients=["beef", "salt"], yield_=["4", "4 bowls"])
+    assert reparse.changed_fields(old, new, {"name", "yield"}) == {
+        "ingredients": ["beef", "salt"]
+    }
+
+
+def test_changed_fields_stores_yield_as_text():
+    old = Recipe(id=1, yield_="4")
+    assert reparse.changed_fields(old, Recipe(yield_=["4", "4 bowls"]), set()) == {
+        "yield_": '["4", "4 bowls"]'
+    }
+
+
+def test_identity_changes():
+    old = Recipe(
+        id=1,
+        name="Stew",
+        url="https://example.com/stew?utm_source=x",
+        ingredients=["beef"],
+        canonical_url="https://example.com/stew",
+    )
+    new = Recipe(canonical_url="/beef-stew")
+    changes = {"ingredients": ["beef", "salt", "carrots", "onions", "stock"]}
+    assert reparse.identity_changes(old, new, changes) == {
+        "canonical_url": "https://example.com/beef-stew",
+        "fingerprint": dedupe.fingerprint("Stew", changes["ingredients"]),
+    }
+    assert reparse.identity_changes(old, Recipe(), {"description": "Hearty"}) == {}
+
+
+def test_reparse_batch_skips_parser_errors(monkeypatch):
+    def parse(text):
+        if text == "bad":
+            raise KeyError("name")
+        return Recipe(name=text)
+
+    monkeypatch.setattr(
+        reparse,
+        "_load_page",
+        lambda app, limiter, recipe, refetch: (recipe.description, "h"),
+    )
+    monkeypatch.setattr(reparse.parsing, "parse_recipe_html", parse)
+    batch = [
+        (Recipe(id=id_, description=text, url=url, canonical_url=url), set())
+        for id_, text, url in [
+            (1, "bad", "https://a.com/1"),
+            (2, "Stew", "https://a.com/2"),
+        ]
+    ]
+    with ThreadPoolExecutor(1) as pool:
+        changes, failed = reparse.reparse_batch(None, batch, pool, pool, None)
+    assert failed == 1
+    assert changes == {2: {"name": "Stew", "page_hash": "h", "fingerprint": None}}
@@ -0,0 +1,130 @@
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+
+from recipemod import repository
+from recipemod.models import Recipe
+
+Column = namedtuple("Column", "name")
+
+OLD_COLUMNS = ["id", "name", "ingredients", "instructions", "updated", "since_snapshot"]
+OLD_ROW = (1, "Stew", ["beef"], ["Cook"], datetime(2024, 1, 1), 0)
+
+
+class FakeCursor:
+    """Answers each execute with the next of results, a (columns, row) pair,
+    and records the statements run."""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.executed = []
+        self.description = None
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, params=None):
+        self.executed.append((query, params))
+        columns, self.row = self.results.pop(0)
+        self.description = [Column(column) for column in columns]
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.fake_cursor = cursor
+
+    def cursor(self, name=None, cursor_factory=None):
+        return self.fake_cursor
+
+
+@pytest.fixture
+def use_cursor(monkeypatch):
+    def use(results):
+        cursor = FakeCursor(results)
+        monkeypatch.setattr(repository, "get_db", lambda: FakeConnection(cursor))
+        return cursor
+
+    return use
+
+
+def test_update_recipe_without_changes(use_cursor):
+    cursor = use_cursor([(OLD_COLUMNS, OLD_ROW)])
+    recipe = Recipe(id=1, name="Stew", ingredients=["beef"], instructions=["Cook"])
+    mod = repository.update_recipe(recipe)
+    assert mod.changed_fields == {}
+    assert mod.id is None
+    assert len(cursor.executed) == 1
+
+
+def test_update_recipe(use_cursor):
+    created = datetime(2024, 1, 2)
+    cursor = use_cursor([(OLD_COLUMNS, OLD_ROW), (["id", "created"], (7, created))])
+    recipe = Recipe(id=1, name="Beef stew", ingredients=["beef"], instructions=["Cook"])
+    mod = repository.update_recipe(recipe)
+    assert (mod.id, mod.created) == (7, created)
+    assert list(mod.changed_fields) == ["name"]
+    assert mod.snapshot is None
+    params = cursor.executed[1][1]
+    assert params["old_updated"] == OLD_ROW[4]
+    # The ingredients didn't change, so aren't parsed again
+    assert params["parsed_ingredients"] is None
+
+
+def test_update_recipe_snapshot(use_cursor):
+    use_cursor([(OLD_COLUMNS, OLD_ROW[:-1] + (9,)), (["id", "created"], (7, None))])
+    recipe = Recipe(id=1, name="Beef stew", ingredients=["beef"], instructions=["Cook"])
+    mod = repository.update_recipe(recipe, snapshot_interval=10)
+    assert mod.snapshot == {
+        "name": "Stew",
+        "ingredients": ["beef"],
+        "instructions": ["Cook"],
+    }
+
+
+def test_update_recipe_retries_after_concurrent_edit(use_cursor):
+    newer_row = (1, "Lamb stew", ["lamb"], ["Cook"], datetime(2024, 1, 3), 1)
+    cursor = use_cursor(
+        [
+            (OLD_COLUMNS, OLD_ROW),
+            (["id", "created"], None),
+            (OLD_COLUMNS, newer_row),
+            (["id", "created"], (8, None)),
+        ]
+    )
+    recipe = Recipe(id=1, name="Beef stew", ingredients=["beef"], instructions=["Cook"])
+    mod = repository.update_recipe(recipe)
+    assert mod.id == 8
+    # The modification patches back to the values the edit actually replaced
+    assert sorted(mod.changed_fields) == ["ingredients", "name"]
+    assert cursor.executed[3][1]["old_updated"] == newer_row[4]
+    assert cursor.executed[3][1]["parsed_ingredients"] is not None
+
+
+def test_update_recipe_conflict(use_cursor):
+    cursor = use_cursor(
+        [(OLD_COLUMNS, OLD_ROW), (["id", "created"], None)] * repository.UPDATE_ATTEMPTS
+    )
+    recipe = Recipe(id=1, name="Beef stew", ingredients=["beef"], instructions=["Cook"])
+    with pytest.raises(repository.ConflictError):
+        repository.update_recipe(recipe)
+    assert len(cursor.executed) == 2 * repository.UPDATE_ATTEMPTS
+
+
+def test_update_recipe_not_found(use_cursor):
+    use_cursor([(OLD_COLUMNS, None)])
+    with pytest.raises(repository.NotFoundError):
+        repository.update_recipe(Recipe(id=1, name="Stew"))
+
+
+def test_field_columns_ignore_order_and_repeats():
+    columns = repository._field_columns(["url", "name"])
+    assert columns == repository._field_columns(["name", "url", "name"])
+    assert columns == '"id", "name", "url", "created"'
@@ -0,0 +1,47 @@
+from datetime import datetime
+import json
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import pytest
+
+from recipemod import serialization
+from recipemod.models import ImportJob, Recipe
+
+RECIPE = Recipe(
+    id=1,
+    name="Crème brûlée",
+    ingredients=["cream", "sugar"],
+    instructions=[{"steps": ["Bake"]}],
+    yield_="4",
+    created=datetime(2024, 5, 1, 12, 30),
+)
+
+
+@pytest.fixture(params=["orjson", "json"])
+def app(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(serialization, "orjson", None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+    app = Flask(__name__)
+    app.json = serialization.JSONProvider(app)
+    return app
+
+
+def test_response_matches_default_provider(app):
+    data = {"recipes": [RECIPE.to_json()], "job": ImportJob(url="u", user_id=1)}
+    with app.app_context():
+        body = app.json.response(data).get_data()
+    expected = DefaultJSONProvider(app).dumps(
+        {"recipes": [RECIPE.to_json()], "job": ImportJob(url="u", user_id=1).to_json()}
+    )
+    assert json.loads(body) == json.loads(expected)
+    assert json.loads(body)["recipes"][0]["created"] == "Wed, 01 May 2024 12:30:00 GMT"
+
+
+def test_dataclasses_use_to_json(app):
+    with app.app_context():
+        data = json.loads(app.json.dumps({"recipe": RECIPE}))
+    assert data["recipe"]["yield"] == "4"
+    assert app.json.loads(app.json.dumps([1, "a"])) == [1, "a"]